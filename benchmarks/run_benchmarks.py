@@ -0,0 +1,358 @@
+"""
+Throughput and memory benchmarks for the converter on a synthetic Muse XML corpus.
+
+Usage:
+    python benchmarks/run_benchmarks.py                            # run and print
+    python benchmarks/run_benchmarks.py --save-baseline            # store results as baseline
+    python benchmarks/run_benchmarks.py --compare                  # fail on regressions against the baseline
+
+Every case reports the best and mean wall time per call and the peak Python heap
+allocation (tracemalloc) of one call. The end-to-end case runs the CLI in a
+subprocess and reports files/s and the peak RSS of the child.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import warnings
+import xml.etree.ElementTree as ET
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import numpy as np
+import pydicom
+from pydicom import dataset
+
+from synthetic_muse_xml import generate_muse_xml, write_corpus
+from ecg_dicom_converter.api import convert_xml_to_dicom
+from ecg_dicom_converter.deflate import DEFAULT_DEFLATE_LEVEL, DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN, deflate_dicom
+from ecg_dicom_converter.extract_ecg_and_metadata import decode_waveform_data, extract_muse_xml_data, lxml_etree
+from ecg_dicom_converter.lead_derivation import LIMB_LEAD_DERIVATION
+from ecg_dicom_converter.read_dicom import read_waveform
+from ecg_dicom_converter.verify import verify_dicom
+from ecg_dicom_converter.load_to_dicom import (
+    ConverterSession, DEFAULT_ANNOTATIONS, WRITER_ENGINES, add_patient_study_info, add_waveform_data, build_dicom_ecg,
+    create_dicom_ecg, create_file_meta
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# zlib levels compared in the deflate size/time benchmark
+DEFLATE_BENCHMARK_LEVELS = [0, 1, 3, 6, 9]
+
+
+def measure(fn, repeat, number):
+    """Return best and mean seconds per call and the peak traced allocation of one call."""
+    fn()  # warm up
+    timings = [t / number for t in timeit.Timer(fn).repeat(repeat=repeat, number=number)]
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'best_s': min(timings), 'mean_s': sum(timings) / len(timings), 'peak_bytes': peak}
+
+
+@contextlib.contextmanager
+def quiet():
+    # Incomplete synthetic records warn about every missing tag; the library functions print nothing
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def build_cases(workdir, options):
+    """Return (name, callable) pairs for the library level benchmarks."""
+    xml_path = os.path.join(workdir, 'sample.xml')
+    with open(xml_path, 'w', encoding='ISO-8859-1') as file:
+        file.write(generate_muse_xml(seed=1, **options))
+    output_file = os.path.join(workdir, 'sample.dcm')
+
+    rhythm_leads, median_leads, metadata = extract_muse_xml_data(xml_path)
+    lead_text = first_lead_text(xml_path)
+    session = ConverterSession(DEFAULT_ANNOTATIONS)
+    with open(xml_path, 'rb') as file:
+        xml_bytes = file.read()
+    dicom_path = os.path.join(workdir, 'read_sample.dcm')
+    create_dicom_ecg(rhythm_leads, median_leads, metadata, dicom_path, DEFAULT_ANNOTATIONS)
+
+    def dcmread_rhythm():
+        item = pydicom.dcmread(dicom_path).WaveformSequence[0]
+        return np.frombuffer(item.WaveformData, dtype=np.int16).reshape(item.NumberOfWaveformSamples, -1).sum()
+
+    def patient_study_info():
+        file_meta = create_file_meta()
+        ds = dataset.FileDataset(output_file, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        add_patient_study_info(ds, metadata, file_meta)
+
+    stored_leads = {lead: rhythm_leads[lead] for lead in ('I', 'II')}
+
+    def extract_decoded():
+        # extract_muse_xml_data scales the leads on first access; this case reads all of them
+        record = extract_muse_xml_data(xml_path, backend='etree')
+        for leads in (record.rhythm, record.median):
+            for lead in leads:
+                leads[lead]
+
+    def waveform_data():
+        add_waveform_data(dataset.Dataset(), {"Rhythm": rhythm_leads, "Median": median_leads}, metadata)
+
+    return [
+        ('decode_waveform_data', lambda: decode_waveform_data(lead_text, 4.88)),
+        ('extract_muse_xml_data', lambda: extract_muse_xml_data(xml_path, backend='etree')),
+        ('extract_muse_xml_data_lxml', lambda: extract_muse_xml_data(xml_path, backend='lxml')),
+        ('extract_muse_xml_data_decoded', extract_decoded),
+        ('derive_limb_leads', lambda: LIMB_LEAD_DERIVATION.apply(dict(stored_leads))),
+        ('add_waveform_data', waveform_data),
+        ('add_patient_study_info', patient_study_info),
+        ('create_dicom_ecg', lambda: create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, DEFAULT_ANNOTATIONS)),
+        ('create_dicom_ecg_session', lambda: session.create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file)),
+        ('create_dicom_ecg_fast', lambda: session.create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file,
+                                                                   engine='fast')),
+        ('read_rhythm_dcmread', dcmread_rhythm),
+        ('read_rhythm_mmap', lambda: read_waveform(dicom_path, 'RHYTHM').sum()),
+        ('verify_dicom', lambda: verify_dicom(dicom_path, rhythm_leads, median_leads, metadata, DEFAULT_ANNOTATIONS)),
+        ('convert_xml_to_dicom_memory', lambda: convert_xml_to_dicom(xml_bytes, session=session, engine='fast')),
+    ]
+
+
+# Attributes that differ between two conversions of the same record
+VOLATILE_KEYWORDS = ['SOPInstanceUID', 'SeriesInstanceUID', 'StudyInstanceUID', 'InstanceCreationDate', 'InstanceCreationTime']
+
+
+def check_fast_writer(xml_paths, workdir):
+    """Differential check: the fast writer must produce the same dataset as the pydicom writer."""
+    session = ConverterSession(DEFAULT_ANNOTATIONS)
+    mismatches = []
+    for xml_path in xml_paths:
+        rhythm_leads, median_leads, metadata = extract_muse_xml_data(xml_path)
+        decoded = []
+        for engine in WRITER_ENGINES:
+            output_file = os.path.join(workdir, f'check_{engine}.dcm')
+            session.create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, engine=engine)
+            ds = pydicom.dcmread(output_file)
+            for keyword in VOLATILE_KEYWORDS:
+                delattr(ds, keyword)
+            # The group length depends on the length of the random SOPInstanceUID
+            del ds.file_meta.MediaStorageSOPInstanceUID
+            del ds.file_meta.FileMetaInformationGroupLength
+            decoded.append((ds.file_meta.to_json_dict(), ds.to_json_dict()))
+        if decoded[0] != decoded[1]:
+            mismatches.append(xml_path)
+    return mismatches
+
+
+def check_lead_derivation(xml_paths):
+    """Differential check: the matrix lead derivation must equal the per-lead formulas."""
+    mismatches = []
+    for xml_path in xml_paths:
+        rhythm_leads, median_leads, _ = extract_muse_xml_data(xml_path)
+        for leads in (rhythm_leads, median_leads):
+            lead_1, lead_2 = leads['I'], leads['II']
+            expected = {'III': np.subtract(lead_2, lead_1), 'aVR': -(lead_1 + lead_2) / 2,
+                        'aVL': lead_1 - (lead_2 / 2), 'aVF': lead_2 - (lead_1 / 2)}
+            if not all(np.array_equal(leads[lead], samples) for lead, samples in expected.items()):
+                mismatches.append(xml_path)
+                break
+    return mismatches
+
+
+def check_xml_backends(xml_paths):
+    """Differential check: lxml and the standard library parser must return the same leads and metadata."""
+    mismatches = []
+    for xml_path in xml_paths:
+        rhythm_etree, median_etree, metadata_etree = extract_muse_xml_data(xml_path, backend='etree')
+        rhythm_lxml, median_lxml, metadata_lxml = extract_muse_xml_data(xml_path, backend='lxml')
+        same_leads = all(list(a) == list(b) and all(np.array_equal(a[lead], b[lead]) for lead in a)
+                         for a, b in ((rhythm_etree, rhythm_lxml), (median_etree, median_lxml)))
+        if not same_leads or metadata_etree != metadata_lxml:
+            mismatches.append(xml_path)
+    return mismatches
+
+
+def check_deflate(xml_paths):
+    """Differential check: deflate_dicom at the default level must write the same bytes as pydicom."""
+    session = ConverterSession(DEFAULT_ANNOTATIONS)
+    mismatches = []
+    for xml_path in xml_paths:
+        rhythm_leads, median_leads, metadata = extract_muse_xml_data(xml_path)
+        ds = build_dicom_ecg(rhythm_leads, median_leads, metadata, session.annotations, session)
+        explicit, deflated = io.BytesIO(), io.BytesIO()
+        ds.save_as(explicit, little_endian=True, implicit_vr=False)
+        ds.file_meta.TransferSyntaxUID = DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN
+        ds.save_as(deflated, little_endian=True, implicit_vr=False)
+        if deflate_dicom(explicit.getvalue(), DEFAULT_DEFLATE_LEVEL) != deflated.getvalue():
+            mismatches.append(xml_path)
+    return mismatches
+
+
+def run_deflate_levels(workdir, options, repeat, number):
+    """Return time and output size of deflating one converted file at every level of DEFLATE_BENCHMARK_LEVELS."""
+    xml_path = os.path.join(workdir, 'deflate_sample.xml')
+    with open(xml_path, 'w', encoding='ISO-8859-1') as file:
+        file.write(generate_muse_xml(seed=2, **options))
+    with open(xml_path, 'rb') as file:
+        data = convert_xml_to_dicom(file.read(), engine='fast')
+
+    results = {}
+    for level in DEFLATE_BENCHMARK_LEVELS:
+        name = f'deflate_level{level}'
+        results[name] = measure(lambda: deflate_dicom(data, level), repeat, number)
+        results[name]['input_bytes'] = len(data)
+        results[name]['output_bytes'] = len(deflate_dicom(data, level))
+    return results
+
+
+def first_lead_text(xml_path):
+    return ET.parse(xml_path).getroot().find('.//WaveFormData').text
+
+
+def run_cli(corpus_dir, output_dir, count, jobs):
+    """Convert the corpus with the CLI in a subprocess and return files/s and peak child RSS."""
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''), PYTHONWARNINGS='ignore')
+    command = [sys.executable, '-m', 'ecg_dicom_converter.cli', corpus_dir, output_dir, '-r',
+               '--jobs', str(jobs), '--no-manifest']
+    start = time.perf_counter()
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    result = {'seconds': elapsed, 'files_per_s': count / elapsed}
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux; it is the maximum over all children so far
+        result['peak_child_rss_bytes'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return result
+
+
+def run(args):
+    options = {'leads': args.leads, 'duration': args.duration, 'sampling_rate': args.sampling_rate,
+               'completeness': args.completeness}
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='ecg_bench_')
+    try:
+        with quiet():
+            check_paths = write_corpus(os.path.join(workdir, 'check'), 5, seed=100, **dict(options, completeness=0.5))
+            mismatches = check_fast_writer(check_paths, workdir)
+            if mismatches:
+                raise RuntimeError(f"Fast writer output differs from the pydicom writer for {mismatches}")
+            mismatches = check_lead_derivation(check_paths)
+            if mismatches:
+                raise RuntimeError(f"Lead derivation differs from the lead formulas for {mismatches}")
+            if lxml_etree is not None:
+                mismatches = check_xml_backends(check_paths)
+                if mismatches:
+                    raise RuntimeError(f"lxml and ElementTree results differ for {mismatches}")
+            else:
+                print('lxml is not installed, skipping the XML backend check and benchmark', file=sys.stderr)
+            mismatches = check_deflate(check_paths)
+            if mismatches:
+                raise RuntimeError(f"Deflated output differs from pydicom's for {mismatches}")
+            for name, fn in build_cases(workdir, options):
+                if name.endswith('_lxml') and lxml_etree is None:
+                    continue
+                results[name] = measure(fn, args.repeat, args.number)
+                print(f"{name:32s} best {results[name]['best_s'] * 1000:9.3f} ms   "
+                      f"mean {results[name]['mean_s'] * 1000:9.3f} ms   "
+                      f"peak {results[name]['peak_bytes'] / 2 ** 20:8.2f} MiB", file=sys.stderr)
+            for name, result in run_deflate_levels(workdir, options, args.repeat, args.number).items():
+                results[name] = result
+                print(f"{name:32s} best {result['best_s'] * 1000:9.3f} ms   "
+                      f"size {result['output_bytes'] / 1024:9.1f} KiB ({result['output_bytes'] / result['input_bytes']:.1%})",
+                      file=sys.stderr)
+
+        if args.files:
+            corpus_dir = os.path.join(workdir, 'corpus')
+            write_corpus(corpus_dir, args.files, **options)
+            for jobs in args.jobs:
+                name = f'cli_end_to_end_jobs{jobs}'
+                results[name] = run_cli(corpus_dir, os.path.join(workdir, 'out'), args.files, jobs)
+                print(f"{name:32s} {results[name]['files_per_s']:9.1f} files/s", file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pydicom': pydicom.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+        },
+        'options': dict(options, files=args.files, repeat=args.repeat, number=args.number),
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Return a list of regression messages (time or memory more than `threshold` above baseline)."""
+    regressions = []
+    for name, current in report['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            continue
+        for key in ('best_s', 'peak_bytes', 'seconds'):
+            if key in current and key in previous and previous[key] > 0:
+                ratio = current[key] / previous[key]
+                if ratio > 1 + threshold:
+                    regressions.append(f"{name} {key}: {previous[key]:.6g} -> {current[key]:.6g} ({ratio:.2f}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ECG DICOM converter on synthetic data.')
+    parser.add_argument('--leads', type=int, default=8, help='Stored leads per file')
+    parser.add_argument('--duration', type=float, default=10.0, help='Rhythm strip length in seconds')
+    parser.add_argument('--sampling-rate', type=int, default=500, help='Samples per second')
+    parser.add_argument('--completeness', type=float, default=1.0, help='Probability of optional metadata fields')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing repetitions per case')
+    parser.add_argument('--number', type=int, default=10, help='Calls per repetition')
+    parser.add_argument('--files', type=int, default=200, help='Corpus size for the end-to-end CLI case (0 to skip)')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, os.cpu_count() or 1], help='Worker counts for the CLI case')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+    parser.add_argument('--save-baseline', nargs='?', const=DEFAULT_BASELINE, default=None, help='Store the report as baseline')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, default=None, help='Compare against a stored baseline')
+    parser.add_argument('--threshold', type=float, default=0.15, help='Allowed relative slowdown before a regression is reported')
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            file.write(text)
+        print(f'Baseline saved to {args.save_baseline}', file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(report, baseline, args.threshold)
+        for message in regressions:
+            print(f'REGRESSION {message}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline.', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Generator for synthetic GE MUSE resting ECG XML files.
+
+The files follow the layout of real MUSE exports (demographics, measurements,
+diagnosis, QRS times, a Median and a Rhythm waveform with base64 encoded int16
+leads) but contain no patient data, so benchmarks can be reproduced anywhere.
+
+Usage:
+    python benchmarks/synthetic_muse_xml.py output_dir --count 100 --duration 10
+"""
+import argparse
+import base64
+import os
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+# Leads stored by MUSE; III, aVR, aVL and aVF are derived by the converter
+STORED_LEADS = ['I', 'II', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+EXTRA_LEADS = ['V3R', 'V4R', 'V5R', 'V7', 'V8', 'V9']
+
+AMPLITUDE_UNITS_PER_BIT = 4.88
+MEDIAN_DURATION = 1.2  # seconds
+
+FIRST_NAMES = ['Alex', 'Kim', 'Robin', 'Sam', 'Charlie', 'Jo', 'Mika', 'Toni']
+LAST_NAMES = ['Muster', 'Beispiel', 'Example', 'Probe', 'Sample', 'Test']
+DIAGNOSES = ['Normal sinus rhythm', 'Normal ECG', 'Sinus bradycardia', 'Left axis deviation',
+             'Incomplete right bundle branch block', 'Borderline ECG', 'Nonspecific T wave abnormality']
+
+
+def synthetic_lead(rng, num_samples, sampling_rate, heart_rate, lead_index):
+    """Build one lead as a train of Gaussian P, QRS and T waves plus baseline wander and noise (in uV)."""
+    t = np.arange(num_samples) / sampling_rate
+    beat_interval = 60.0 / heart_rate
+    phase = np.mod(t, beat_interval)
+    gain = 0.6 + 0.15 * lead_index
+    signal = (
+        120 * np.exp(-((phase - 0.16) / 0.025) ** 2)
+        - 90 * np.exp(-((phase - 0.28) / 0.008) ** 2)
+        + 1000 * gain * np.exp(-((phase - 0.30) / 0.012) ** 2)
+        - 180 * np.exp(-((phase - 0.32) / 0.01) ** 2)
+        + 280 * gain * np.exp(-((phase - 0.55) / 0.05) ** 2)
+    )
+    signal += 50 * np.sin(2 * np.pi * 0.3 * t + lead_index)
+    signal += rng.normal(0, 8, num_samples)
+    return np.clip(np.round(signal / AMPLITUDE_UNITS_PER_BIT), -32768, 32767).astype('<i2')
+
+
+def encode_lead(samples):
+    # MUSE wraps the base64 text into lines
+    return base64.encodebytes(samples.tobytes()).decode('ascii')
+
+
+def waveform_xml(rng, waveform_type, leads, num_samples, sampling_rate, heart_rate):
+    parts = [
+        '<Waveform>',
+        f'<WaveformType>{waveform_type}</WaveformType>',
+        '<WaveformStartTime>0</WaveformStartTime>',
+        f'<NumberofLeads>{len(leads)}</NumberofLeads>',
+        '<SampleType>CONTINUOUS_SAMPLES</SampleType>',
+        f'<SampleBase>{sampling_rate}</SampleBase>',
+        '<SampleExponent>0</SampleExponent>',
+        '<HighPassFilter>16</HighPassFilter>',
+        '<LowPassFilter>150</LowPassFilter>',
+        '<BaseLineFilter>Y</BaseLineFilter>',
+        '<ACFilter>50</ACFilter>',
+    ]
+    for lead_index, lead_id in enumerate(leads):
+        samples = synthetic_lead(rng, num_samples, sampling_rate, heart_rate, lead_index)
+        parts += [
+            '<LeadData>',
+            f'<LeadByteCountTotal>{samples.nbytes}</LeadByteCountTotal>',
+            '<LeadTimeOffset>0</LeadTimeOffset>',
+            f'<LeadSampleCountTotal>{num_samples}</LeadSampleCountTotal>',
+            f'<LeadAmplitudeUnitsPerBit>{AMPLITUDE_UNITS_PER_BIT}</LeadAmplitudeUnitsPerBit>',
+            '<LeadAmplitudeUnits>MICROVOLTS</LeadAmplitudeUnits>',
+            '<LeadHighLimit>32767</LeadHighLimit>',
+            '<LeadLowLimit>-32768</LeadLowLimit>',
+            f'<LeadID>{lead_id}</LeadID>',
+            '<LeadOffsetFirstSample>0</LeadOffsetFirstSample>',
+            '<FirstSampleBaseline>0</FirstSampleBaseline>',
+            '<LeadSampleSize>2</LeadSampleSize>',
+            '<LeadOff>FALSE</LeadOff>',
+            '<BaselineSway>FALSE</BaselineSway>',
+            f'<WaveFormData>{encode_lead(samples)}</WaveFormData>',
+            '</LeadData>',
+        ]
+    parts.append('</Waveform>')
+    return '\n'.join(parts)
+
+
+def section_xml(tag, fields, rng, completeness, required=()):
+    """Render a flat section; optional fields are kept with probability `completeness`."""
+    lines = [f'<{tag}>']
+    for name, value in fields:
+        if name in required or rng.random() < completeness:
+            lines.append(f'<{name}>{escape(str(value))}</{name}>')
+    lines.append(f'</{tag}>')
+    return '\n'.join(lines)
+
+
+def generate_muse_xml(seed=0, leads=8, duration=10.0, sampling_rate=500, completeness=1.0):
+    """
+    Return the text of one synthetic MUSE XML file.
+
+    leads: number of stored leads (8 = I, II, V1-V6; more adds right-sided/posterior leads)
+    duration: rhythm strip length in seconds
+    sampling_rate: samples per second
+    completeness: probability (0-1) that each optional metadata field is present
+    """
+    rng = np.random.default_rng(seed)
+    lead_ids = (STORED_LEADS + EXTRA_LEADS)[:leads]
+    heart_rate = int(rng.integers(50, 100))
+    rr = int(round(60000 / heart_rate))
+    qt = int(rng.integers(360, 440))
+    acquisition_date = f'{int(rng.integers(1, 13)):02d}-{int(rng.integers(1, 29)):02d}-{int(rng.integers(2000, 2024))}'
+    acquisition_time = f'{int(rng.integers(0, 24)):02d}:{int(rng.integers(0, 60)):02d}:{int(rng.integers(0, 60)):02d}'
+
+    demographics = section_xml('PatientDemographics', [
+        ('PatientID', f'{int(rng.integers(10 ** 7, 10 ** 8))}'),
+        ('PatientAge', int(rng.integers(18, 95))),
+        ('AgeUnits', 'YEARS'),
+        ('DateofBirth', f'{int(rng.integers(1, 13)):02d}-{int(rng.integers(1, 29)):02d}-{int(rng.integers(1930, 2000))}'),
+        ('Gender', rng.choice(['MALE', 'FEMALE'])),
+        ('PatientLastName', rng.choice(LAST_NAMES)),
+        ('PatientFirstName', rng.choice(FIRST_NAMES)),
+    ], rng, completeness, required=('PatientID',))
+
+    test = section_xml('TestDemographics', [
+        ('DataType', 'RESTING'),
+        ('Site', int(rng.integers(1, 10))),
+        ('SiteName', 'Synthetic Site'),
+        ('AcquisitionDevice', 'MAC5500'),
+        ('Status', 'CONFIRMED'),
+        ('LocationName', 'Cardiology'),
+        ('AcquisitionTime', acquisition_time),
+        ('AcquisitionDate', acquisition_date),
+    ], rng, completeness, required=('AcquisitionTime', 'AcquisitionDate'))
+
+    order = section_xml('Order', [
+        ('AdmitDate', acquisition_date),
+        ('AdmitTime', acquisition_time),
+        ('EditDate', acquisition_date),
+        ('EditTime', acquisition_time),
+    ], rng, completeness)
+
+    measurements = section_xml('RestingECGMeasurements', [
+        ('VentricularRate', heart_rate),
+        ('AtrialRate', heart_rate),
+        ('PRInterval', int(rng.integers(120, 200))),
+        ('QRSDuration', int(rng.integers(80, 120))),
+        ('QTInterval', qt),
+        ('QTCorrected', int(qt / np.sqrt(rr / 1000.0))),
+        ('PAxis', int(rng.integers(0, 75))),
+        ('RAxis', int(rng.integers(-30, 90))),
+        ('TAxis', int(rng.integers(0, 90))),
+        ('QRSCount', int(duration * heart_rate / 60)),
+        ('QOnset', 218),
+        ('QOffset', 264),
+        ('POnset', 158),
+        ('POffset', 208),
+        ('TOffset', 414),
+        ('ECGSampleBase', sampling_rate),
+        ('ECGSampleExponent', 0),
+    ], rng, completeness, required=('ECGSampleBase', 'ECGSampleExponent'))
+
+    statements = rng.choice(DIAGNOSES, size=int(rng.integers(1, 4)), replace=False)
+    diagnosis = '<Diagnosis>\n<Modality>RESTING</Modality>\n' + '\n'.join(
+        f'<DiagnosisStatement><StmtFlag>ENDSLINE</StmtFlag><StmtText>{escape(str(s))}</StmtText></DiagnosisStatement>'
+        for s in statements
+    ) + '\n</Diagnosis>'
+
+    beat_samples = int(sampling_rate * 60 / heart_rate)
+    qrs_times = '<QRSTimesTypes>\n' + '\n'.join(
+        f'<QRS><Number>{n + 1}</Number><Type>0</Type><Time>{n * beat_samples + beat_samples // 2}</Time></QRS>'
+        for n in range(int(duration * heart_rate / 60))
+    ) + f'\n<GlobalRR>{rr}</GlobalRR>\n<QTRGGR>{qt}</QTRGGR>\n</QRSTimesTypes>'
+
+    median = waveform_xml(rng, 'Median', lead_ids, int(MEDIAN_DURATION * sampling_rate), sampling_rate, heart_rate)
+    rhythm = waveform_xml(rng, 'Rhythm', lead_ids, int(duration * sampling_rate), sampling_rate, heart_rate)
+
+    return '\n'.join([
+        '<?xml version="1.0" encoding="ISO-8859-1"?>',
+        '<!DOCTYPE RestingECG SYSTEM "restecg.dtd">',
+        '<RestingECG>',
+        '<MuseInfo><MuseVersion>9.0.9.18167</MuseVersion></MuseInfo>',
+        demographics, test, order, measurements, diagnosis, qrs_times, median, rhythm,
+        '</RestingECG>',
+        '',
+    ])
+
+
+def write_corpus(output_dir, count, seed=0, **options):
+    """Write `count` synthetic files to output_dir and return their paths."""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(output_dir, f'synthetic_{i:06d}.xml')
+        with open(path, 'w', encoding='ISO-8859-1') as file:
+            file.write(generate_muse_xml(seed=seed + i, **options))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic Muse XML files.')
+    parser.add_argument('output_dir', type=str, help='Directory for the generated files')
+    parser.add_argument('--count', type=int, default=10, help='Number of files')
+    parser.add_argument('--leads', type=int, default=8, help='Number of stored leads (8-14)')
+    parser.add_argument('--duration', type=float, default=10.0, help='Rhythm strip length in seconds')
+    parser.add_argument('--sampling-rate', type=int, default=500, help='Samples per second')
+    parser.add_argument('--completeness', type=float, default=1.0, help='Probability that an optional metadata field is present')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first file')
+    args = parser.parse_args()
+
+    paths = write_corpus(args.output_dir, args.count, seed=args.seed, leads=args.leads, duration=args.duration,
+                         sampling_rate=args.sampling_rate, completeness=args.completeness)
+    print(f'Wrote {len(paths)} file(s) to {args.output_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+
+from ecg_dicom_converter.extract_ecg_and_metadata import extract_data, get_xml_backend
+from ecg_dicom_converter.instrumentation import measure_stage
+from ecg_dicom_converter.load_to_dicom import ConverterSession, create_dicom_ecg
+from ecg_dicom_converter.output_layout import OutputLayout
+
+
+def convert_xml_to_dicom(xml, annotations=None, session=None, engine='pydicom', output=None, metrics=None,
+                         deflate_level=None):
+    """
+    Convert one Muse XML document to DICOM entirely in memory.
+
+    xml: the XML as bytes or a readable binary file-like object.
+    annotations: annotation dictionary, ignored if a session is given (defaults to DEFAULT_ANNOTATIONS).
+    session: ConverterSession to reuse across calls; created per call if omitted.
+    output: optional writable binary file-like object. If given, the DICOM is written
+            into it and it is returned; otherwise the DICOM is returned as bytes.
+    deflate_level: zlib level (0-9) for Deflated Explicit VR Little Endian output; defaults to the
+                   deflate_level of the session (uncompressed if None).
+    """
+    if session is None:
+        session = ConverterSession(annotations)
+    if deflate_level is None:
+        deflate_level = session.deflate_level
+
+    rhythm_leads, median_leads, metadata = extract_data(xml, metrics)
+    if output is None:
+        return encode_dicom(rhythm_leads, median_leads, metadata, session, engine, deflate_level, metrics)
+
+    create_dicom_ecg(rhythm_leads, median_leads, metadata, output, session.annotations, session=session,
+                     metrics=metrics, engine=engine, deflate_level=deflate_level)
+    return output
+
+
+def encode_dicom(rhythm_leads, median_leads, metadata, session, engine='pydicom', deflate_level=None, metrics=None):
+    """Return the DICOM of an extracted record as bytes, timed into metrics like create_dicom_ecg."""
+    if engine == 'fast':
+        # The fast writer produces the bytes directly, no intermediate buffer needed
+        with measure_stage(metrics, 'dataset_build'):
+            return session.fast_writer.encode(rhythm_leads, median_leads, metadata, deflate_level, metrics)
+    buffer = io.BytesIO()
+    create_dicom_ecg(rhythm_leads, median_leads, metadata, buffer, session.annotations, session=session,
+                     metrics=metrics, engine=engine, deflate_level=deflate_level)
+    return buffer.getvalue()
+
+
+# Sessions of an executor worker process, created on first use per configuration
+_process_sessions = {}
+
+
+def _process_session(annotations, deflate_level):
+    key = (repr(annotations), deflate_level)
+    session = _process_sessions.get(key)
+    if session is None:
+        session = _process_sessions[key] = ConverterSession(annotations, deflate_level)
+    return session
+
+
+def _convert_task(name, xml, layout, annotations, engine, deflate_level, xml_backend, session=None, metrics=None):
+    """
+    Executor side of convert_many_async: return (dicom_bytes, output path relative to the layout or None).
+    Without a session (process executors) the session of the worker process is used.
+    """
+    if session is None:
+        session = _process_session(annotations, deflate_level)
+    rhythm_leads, median_leads, metadata = extract_data(xml, metrics, backend=xml_backend)
+    dicom = encode_dicom(rhythm_leads, median_leads, metadata, session, engine, session.deflate_level, metrics)
+    relative_path = layout.relative_path(name, metadata) if layout is not None else None
+    return dicom, relative_path
+
+
+def _read_file(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+async def _iterate(sources):
+    if hasattr(sources, '__aiter__'):
+        async for source in sources:
+            yield source
+    else:
+        for source in sources:
+            yield source
+
+
+async def convert_many_async(sources, output_dir=None, annotations=None, engine='pydicom', deflate_level=None,
+                             executor=None, max_in_flight=8):
+    """
+    Convert many Muse XML documents from an event loop, yielding (source, result, error) in completion order.
+
+    sources: iterable or async iterable of XML file paths or (name, xml_bytes) pairs.
+    output_dir: an OutputLayout or a directory the DICOM files are written to (flat, replacing existing
+                files); result is then the path of the written file. Without it, result is the DICOM as bytes.
+    executor: concurrent.futures executor for parsing and serialization (default: the loop's thread pool).
+              A ProcessPoolExecutor avoids the GIL; its workers build their own ConverterSession once.
+    max_in_flight: at most this many documents are read, converted or written at the same time; the next
+                   source is only taken once a result has been consumed.
+
+    Reading and writing files happen on threads, so the event loop is never blocked. If the consumer
+    stops iterating or is cancelled, conversions not yet finished are cancelled; files are written
+    atomically, so no partial output is left behind. error is the message of a failed conversion, in
+    which case result is None.
+    """
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least 1")
+    loop = asyncio.get_event_loop()
+    if output_dir is not None and not isinstance(output_dir, OutputLayout):
+        output_dir = OutputLayout(output_dir, on_collision='overwrite')
+    # Thread executors share one session, process executors build one per worker process
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        session = None
+    else:
+        session = ConverterSession(annotations, deflate_level)
+    xml_backend = get_xml_backend()
+
+    async def convert_one(source):
+        if isinstance(source, (str, os.PathLike)):
+            name, xml = os.fspath(source), None
+        else:
+            name, xml = source
+        try:
+            # Files are read and written on the loop's default thread pool
+            if xml is None:
+                xml = await loop.run_in_executor(None, _read_file, name)
+            dicom, relative_path = await loop.run_in_executor(
+                executor, _convert_task, name, xml, output_dir, annotations, engine, deflate_level, xml_backend,
+                session)
+            if output_dir is None:
+                return name, dicom, None
+            output_file = await loop.run_in_executor(None, output_dir.write, relative_path,
+                                                     lambda file: file.write(dicom))
+            return name, output_file, None
+        except Exception as e:
+            return name, None, str(e)
+
+    pending = set()
+    source_iterator = _iterate(sources).__aiter__()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    source = await source_iterator.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(convert_one(source)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        await source_iterator.aclose()
@@ -0,0 +1,82 @@
+import io
+import os
+import tarfile
+import time
+import zipfile
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Streaming tarfile write mode per extension
+_TAR_WRITE_MODES = [
+    (('.tar.gz', '.tgz'), 'w|gz'),
+    (('.tar.bz2', '.tbz2'), 'w|bz2'),
+    (('.tar.xz', '.txz'), 'w|xz'),
+    (('.tar',), 'w|'),
+]
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_xml_members(archive_path):
+    """
+    Yield (member_name, content) for every XML member of a zip or tar archive.
+    Members are read one at a time; nothing is extracted to disk.
+    """
+    if archive_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.xml'):
+                    yield info.filename, archive.read(info)
+    else:
+        # 'r|*' reads the tar as a stream of any compression, without seeking for a member index
+        with tarfile.open(archive_path, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith('.xml'):
+                    yield member.name, archive.extractfile(member).read()
+
+
+class ArchiveWriter:
+    """
+    Writes files into a new zip or tar archive as they are produced, creating its directory if needed.
+    The archive type is taken from the extension; tar archives are written as a stream.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._zip = None
+        self._tar = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        lower = path.lower()
+        if lower.endswith('.zip'):
+            self._zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            for extensions, mode in _TAR_WRITE_MODES:
+                if lower.endswith(extensions):
+                    self._tar = tarfile.open(path, mode)
+                    break
+            else:
+                raise ValueError(f"Unsupported archive type: {path}")
+
+    def add(self, name, data):
+        if self._zip is not None:
+            self._zip.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self._tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
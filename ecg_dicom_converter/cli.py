@@ -1,71 +1,608 @@
 import argparse
+import io
 import os
-from ecg_dicom_converter.extract_ecg_and_metadata import extract_data
-from ecg_dicom_converter.load_to_dicom import create_dicom_ecg, DEFAULT_ANNOTATIONS, load_annotations_from_csv, merge_annotations
+import posixpath
+import sys
+import tarfile
+import zipfile
+from multiprocessing import Pool
+from ecg_dicom_converter.extract_ecg_and_metadata import XML_BACKENDS, extract_data, get_xml_backend, set_xml_backend
+from ecg_dicom_converter.load_to_dicom import create_dicom_ecg, ConverterSession, DEFAULT_ANNOTATIONS, WRITER_ENGINES, load_annotations_from_csv, merge_annotations
+from ecg_dicom_converter.instrumentation import FileMetrics, RunMetrics, measure_stage, profile_files
+from ecg_dicom_converter.deflate import DEFAULT_DEFLATE_LEVEL, check_deflate_level
+from ecg_dicom_converter.dedup import DEDUP_INDEX_FILENAME, DEDUP_MODES, DedupIndex, is_duplicate, record_fingerprint
+from ecg_dicom_converter.verify import should_verify, verify_dicom
+from ecg_dicom_converter.diagnostics import DiagnosticsCollector, capture_diagnostics
+from ecg_dicom_converter.discovery import ORDERS, largest_first, read_file_list, scan_files
+from ecg_dicom_converter.archives import ArchiveWriter, is_archive, iter_xml_members
+from ecg_dicom_converter.export_npy import DEFAULT_SHARD_SIZE, NpyExport, build_export_record
+from ecg_dicom_converter.manifest import ConversionManifest, file_fingerprint, STATUS_DONE, STATUS_FAILED
+from ecg_dicom_converter.output_layout import (COLLISION_POLICIES, OUTPUT_LAYOUTS, OutputCollisionError, OutputLayout,
+                                               candidate_names, remove_all_extensions)
 
 class AnnotationsFileNotFoundError(Exception):
     pass
 
-def process_file(input_file, output_dir, annotations):
+def process_file(input_file, output_dir, annotations, session=None, metrics=None, engine='pydicom', export=False,
+                 replace=None, dedup=None, verify=0.0):
+    """
+    Convert one file and return the output path, or (output path, export record) with export=True.
+    output_dir is an OutputLayout, or a directory the file is written to flat, replacing an existing one.
+    replace: an existing output file the result may replace (see OutputLayout.write).
+    dedup: a DedupIndex; a recording converted before from another file is not written again, the
+           path of the earlier DICOM (or of a link to it) is returned and the export record is None.
+    verify: fraction (0.0-1.0) of the files that are read back and compared with the extracted data
+            (see should_verify); a difference raises ValueError.
+    """
+    layout = output_dir if isinstance(output_dir, OutputLayout) else OutputLayout(output_dir, on_collision='overwrite')
+
+    # Extract ECG data and metadata
+    with measure_stage(metrics, 'extract'):
+        rhythm_leads, median_leads, metadata = extract_data(input_file, metrics)
+    if metrics is not None:
+        metrics.add_bytes('xml_parse', bytes_in=os.path.getsize(input_file))
+
+    relative_path = layout.relative_path(input_file, metadata)
+    duplicate = None
+    if dedup is not None:
+        record_id = record_fingerprint(rhythm_leads, median_leads, metadata)
+        duplicate = dedup.find_duplicate(record_id, input_file)
+
+    if duplicate is None:
+        # Create DICOM file, written to a temporary file first and renamed to its place in the layout
+        output_file = layout.write(relative_path,
+                                   lambda file: create_dicom_ecg(rhythm_leads, median_leads, metadata, file, annotations,
+                                                                 session=session, metrics=metrics, engine=engine),
+                                   replace, input_file)
+        if dedup is not None:
+            # Another worker may have converted the same recording in the meantime
+            duplicate = dedup.find_duplicate(record_id, input_file, output_file)
+        if duplicate is None and should_verify(input_file, verify):
+            # Compared with the leads still in memory, the XML is not parsed again
+            with measure_stage(metrics, 'verify'):
+                verify_dicom(output_file, rhythm_leads, median_leads, metadata,
+                             session.annotations if session is not None else annotations)
+    if duplicate is not None:
+        output_file = duplicate[0]
+        if dedup.mode == 'link':
+            output_file = layout.link(relative_path, duplicate[0], replace, input_file)
+        return (output_file, None) if export else output_file
+
+    if export:
+        return output_file, build_export_record(rhythm_leads, median_leads, metadata)
+    return output_file
+
+# Annotations, session and writer engine of the current worker process, set once by _init_worker
+_worker_annotations = None
+_worker_session = None
+_worker_engine = 'pydicom'
+_worker_dedup = None
+_worker_verify = 0.0
+
+def _init_worker(annotations, engine='pydicom', xml_backend=None, deflate_level=None, dedup=None, verify=0.0):
+    """dedup: (index path, mode) of a DedupIndex, opened by every worker, or None."""
+    global _worker_annotations, _worker_session, _worker_engine, _worker_dedup, _worker_verify
+    if xml_backend is not None:
+        # The parser chosen in the main process, also for start methods that do not fork
+        set_xml_backend(xml_backend)
+    _worker_annotations = annotations
+    # Files are deflated by the workers, the main process only moves the finished bytes
+    _worker_session = ConverterSession(annotations, deflate_level)
+    _worker_engine = engine
+    _worker_dedup = DedupIndex(*dedup) if dedup is not None else None
+    _worker_verify = verify
+
+def convert_file(input_file, output_dir, annotations, session=None, fingerprint=None, collect_metrics=False,
+                 engine='pydicom', export=False, replace=None, dedup=None, verify=0.0):
+    """
+    Convert one file and return (input_file, output_file, error, fingerprint, metrics, export_record, events).
+    Errors are returned instead of raised so one bad XML cannot stop a batch run, and warnings are
+    returned as diagnostic events instead of being printed.
+    With fingerprint='stat' the (size, mtime_ns, None) of the input is included for the manifest,
+    with fingerprint='sha256' (size, mtime_ns, sha256), with collect_metrics=True the per-stage FileMetrics as a dict and with export=True the
+    waveforms and index fields for the NumPy export.
+    """
+    input_fingerprint = None
+    if fingerprint:
+        try:
+            input_fingerprint = file_fingerprint(input_file, content_hash=fingerprint == 'sha256')
+        except OSError:
+            input_fingerprint = (None, None, None)
+    metrics = FileMetrics(input_file) if collect_metrics else None
+    export_record = None
+    with capture_diagnostics() as events:
+        try:
+            if export:
+                output_file, export_record = process_file(input_file, output_dir, annotations, session, metrics, engine,
+                                                          export=True, replace=replace, dedup=dedup,
+                                                          verify=verify)
+            else:
+                output_file = process_file(input_file, output_dir, annotations, session, metrics, engine,
+                                           replace=replace, dedup=dedup, verify=verify)
+            error = None
+        except Exception as e:
+            output_file = None
+            error = str(e)
+    return (input_file, output_file, error, input_fingerprint, metrics.to_dict() if metrics is not None else None,
+            export_record, events)
+
+def _process_file_in_worker(task):
+    input_file, output_dir, fingerprint, collect_metrics, export, replace = task
+    return convert_file(input_file, output_dir, _worker_annotations, _worker_session, fingerprint, collect_metrics,
+                        _worker_engine, export, replace, _worker_dedup, _worker_verify)
+
+def convert_xml_bytes(name, data, annotations, session=None, collect_metrics=False, engine='pydicom', export=False,
+                      layout=None):
+    """
+    Convert one XML document held in memory and return
+    (name, output_name, dicom_bytes, error, metrics, export_record, events).
+    output_name is the '/'-separated path of the DICOM in the OutputLayout layout (its basename if None).
+    Used for archive members, which are never written to disk as XML.
+    """
+    metrics = FileMetrics(name) if collect_metrics else None
+    export_record = None
+    output_name = None
+    with capture_diagnostics() as events:
+        try:
+            with measure_stage(metrics, 'extract'):
+                rhythm_leads, median_leads, metadata = extract_data(data, metrics)
+            if metrics is not None:
+                metrics.add_bytes('xml_parse', bytes_in=len(data))
+            buffer = io.BytesIO()
+            create_dicom_ecg(rhythm_leads, median_leads, metadata, buffer, annotations, session=session, metrics=metrics,
+                             engine=engine)
+            dicom = buffer.getvalue()
+            if layout is not None:
+                output_name = layout.relative_path(name, metadata)
+            else:
+                output_name = remove_all_extensions(posixpath.basename(name)) + '.dcm'
+            if export:
+                export_record = build_export_record(rhythm_leads, median_leads, metadata)
+            error = None
+        except Exception as e:
+            dicom = None
+            error = str(e)
+    return name, output_name, dicom, error, metrics.to_dict() if metrics is not None else None, export_record, events
+
+def _convert_xml_bytes_in_worker(task):
+    name, data, collect_metrics, export, layout = task
+    return convert_xml_bytes(name, data, _worker_annotations, _worker_session, collect_metrics, _worker_engine, export,
+                             layout)
+
+def process_archive(archive_path, annotations, jobs=1, chunksize=16, collect_metrics=False, engine='pydicom',
+                    export=False, layout=None, deflate_level=None):
+    """Convert the XML members of an archive, yielding the convert_xml_bytes result per member."""
+    members = iter_xml_members(archive_path)
+    if jobs > 1:
+        tasks = ((name, data, collect_metrics, export, layout) for name, data in members)
+        with Pool(processes=jobs, initializer=_init_worker,
+                  initargs=(annotations, engine, get_xml_backend(), deflate_level)) as pool:
+            for result in pool.imap_unordered(_convert_xml_bytes_in_worker, tasks, chunksize=chunksize):
+                yield result
+    else:
+        session = ConverterSession(annotations, deflate_level)
+        for name, data in members:
+            yield convert_xml_bytes(name, data, annotations, session, collect_metrics, engine, export, layout)
+
+def convert_archive(args, annotations):
+    """Archive input mode of main: DICOMs go to the output directory, or into an archive if output_dir is one."""
+    if args.resume or args.profile_slowest or args.dedup or args.verify:
+        print("Error: --resume, --profile-slowest, --dedup and --verify are not supported for archive input")
+        return
+    if args.jobs < 1 or args.chunksize < 1:
+        print("Error: --jobs and --chunksize must be at least 1")
+        return
+
+    output_archive = None
+    if is_archive(args.output_dir):
+        output_archive = ArchiveWriter(args.output_dir)
+        # Inside an output archive the member paths of the input are kept by default
+        layout = OutputLayout(args.output_dir, args.layout or 'mirror', args.on_collision)
+        archive_names = set()
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        layout = OutputLayout(args.output_dir, args.layout or 'flat', args.on_collision)
+    run_metrics = RunMetrics(args.metrics, keep_slowest=0) if args.metrics else None
+    npy_export = NpyExport(args.export_npy, args.shard_size * 2 ** 20) if args.export_npy else None
+    diagnostics = DiagnosticsCollector(args.diagnostics, args.progress_interval)
+
+    converted = 0
+    failed = []
     try:
-        # Extract ECG data and metadata
-        rhythm_leads, median_leads, metadata = extract_data(input_file)
-
-        # Create output file path
-        output_file = os.path.join(output_dir, remove_all_extensions(os.path.basename(input_file)) + '.dcm')
-
-        # Create DICOM file
-        create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, annotations)
-
-    except Exception as e:
-        print(f"Error processing file {input_file}: {str(e)}")
-        raise
-def remove_all_extensions(filename):
-    while True:
-        filename, ext = os.path.splitext(filename)
-        if ext == '':
-            return filename
-def main():
-    parser = argparse.ArgumentParser(description='Convert ECG data to DICOM format.')
-    parser.add_argument('input', type=str, help='Path to the input ECG file (.xml) or directory')
-    parser.add_argument('output_dir', type=str, help='Path to the output directory')
-    parser.add_argument('--annotations', type=str, help='Path to the annotations CSV file', default=None)
-    parser.add_argument('-r', '--recursive', action='store_true', help='Process all files in the input directory')
+        results = process_archive(args.input, annotations, args.jobs, args.chunksize, run_metrics is not None,
+                                  args.writer, npy_export is not None, layout, args.deflate)
+        for name, output_name, dicom, error, file_metrics, export_record, events in results:
+            if error is None:
+                try:
+                    if output_archive is not None:
+                        output_file = add_to_archive(output_archive, archive_names, output_name, dicom, args.on_collision)
+                    else:
+                        output_file = layout.write(output_name, lambda file: file.write(dicom))
+                except (OSError, ValueError) as e:
+                    error = str(e)
+            if error is None:
+                converted += 1
+                if npy_export is not None:
+                    npy_export.add(export_record, f'{args.input}!{name}', output_file)
+            elif len(failed) < MAX_LISTED_FAILURES:
+                failed.append((name, error))
+            diagnostics.add(name, events, error)
+            if run_metrics is not None:
+                run_metrics.add(file_metrics, error)
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        print(f"Error reading archive {args.input}: {e}")
+    finally:
+        if output_archive is not None:
+            output_archive.close()
+        if run_metrics is not None:
+            run_metrics.close()
+        if npy_export is not None:
+            npy_export.close()
+        diagnostics.close()
+
+    if run_metrics is not None:
+        print(run_metrics.format_summary())
+    if output_archive is not None:
+        print(f"DICOM files written to {args.output_dir}")
+    print_run_summary(converted, diagnostics, failed, args.diagnostics)
+
+def add_to_archive(output_archive, names, name, data, on_collision='error'):
+    """Add a member to the output archive, applying the collision policy to the names already added."""
+    if on_collision == 'overwrite' or name not in names:
+        # Archives can hold a name twice; extracting them keeps the last one
+        names.add(name)
+        output_archive.add(name, data)
+        return name
+    if on_collision == 'error':
+        raise OutputCollisionError(f"Output member {name} already exists")
+    for candidate in candidate_names(name):
+        if candidate not in names:
+            names.add(candidate)
+            output_archive.add(candidate, data)
+            return candidate
+
+# Number of failed files listed at the end of a batch run; all of them are in the diagnostics report
+MAX_LISTED_FAILURES = 20
+
+def print_run_summary(converted, diagnostics, failed, report_path=None, dedup=None, verified=None):
+    if diagnostics.counts:
+        print(diagnostics.format_summary())
+    print(f"Converted {converted} file(s), {diagnostics.failed} failed.")
+    if verified is not None:
+        print(f"Verified {verified} written file(s) against their source data.")
+    if dedup is not None:
+        duplicates = diagnostics.counts.get('duplicate_record', 0)
+        action = 'linked' if dedup.mode == 'link' else 'skipped'
+        print(f"{duplicates} of them duplicate(s) of earlier recordings, {action}; "
+              f"{dedup.count()} distinct recording(s) in the index.")
+    for input_file, error in failed:
+        print(f"  {input_file}: {error}")
+    if diagnostics.failed > len(failed):
+        print(f"  ... and {diagnostics.failed - len(failed)} more")
+    if report_path:
+        print(f"Diagnostics report written to {report_path}")
+
+def discover_input_files(args, events=None):
+    """
+    Return the input files of a recursive run in the order they are converted.
+    Diagnostic events of the directory scan are appended to the list events.
+    """
+    order = args.order
+    if order == 'auto':
+        # Ordering needs the complete list before the first conversion, which only pays off for a pool
+        order = 'largest-first' if args.jobs > 1 else 'discovery'
+    with_size = order == 'largest-first'
+    if args.file_list:
+        input_files = read_file_list(args.file_list, args.input, with_size)
+    else:
+        input_files = scan_files(args.input, args.include, args.exclude, with_size, events)
+    if with_size:
+        return largest_first(input_files, args.chunksize if args.jobs > 1 else 1)
+    return input_files
 
-    args = parser.parse_args()
+def report_discovery_events(diagnostics, events):
+    """Hand the events of the input discovery, which may run in a pool's task feeder thread, to diagnostics."""
+    while events:
+        event = events.pop(0)
+        diagnostics.add_events(event['field'], [event])
 
+def process_files_serial(input_files, output_dir, annotations, fingerprint=None, collect_metrics=False,
+                         engine='pydicom', export=False, previous_output=None, deflate_level=None, dedup=None,
+                         verify=0.0):
+    """
+    Convert the files one after another, yielding the convert_file result per file.
+    previous_output: optional function returning the output file of an input from an earlier run,
+    which the new output may replace.
+    deflate_level: zlib level for Deflated Explicit VR Little Endian output, None for uncompressed files.
+    dedup: a DedupIndex to skip or link recordings converted before.
+    verify: fraction of the written files that are read back and checked.
+    """
+    session = ConverterSession(annotations, deflate_level)
+    for input_file in input_files:
+        replace = previous_output(input_file) if previous_output is not None else None
+        yield convert_file(input_file, output_dir, annotations, session, fingerprint, collect_metrics, engine, export,
+                           replace, dedup, verify)
+
+def process_files_parallel(input_files, output_dir, annotations, jobs, chunksize=16, fingerprint=None,
+                           collect_metrics=False, engine='pydicom', export=False, previous_output=None,
+                           deflate_level=None, dedup=None, verify=0.0):
+    """Convert the files on a pool of worker processes, yielding the convert_file result per file."""
+    tasks = ((input_file, output_dir, fingerprint, collect_metrics, export,
+              previous_output(input_file) if previous_output is not None else None) for input_file in input_files)
+    # Every worker opens the index itself, SQLite connections cannot be shared between processes
+    dedup = (dedup.path, dedup.mode) if dedup is not None else None
+    with Pool(processes=jobs, initializer=_init_worker,
+              initargs=(annotations, engine, get_xml_backend(), deflate_level, dedup, verify)) as pool:
+        for result in pool.imap_unordered(_process_file_in_worker, tasks, chunksize=chunksize):
+            yield result
+
+def load_annotations(annotations_file):
+    """Return the default annotations, updated from the CSV file if one is given (None if it is missing)."""
     # Load default annotations
     annotations = DEFAULT_ANNOTATIONS.copy()
 
     # If a CSV file is provided, load it and update the default annotations
-    if args.annotations:
+    if annotations_file:
         try:
-            csv_annotations = load_annotations_from_csv(args.annotations)
+            csv_annotations = load_annotations_from_csv(annotations_file)
             annotations = merge_annotations(annotations, csv_annotations)
         except FileNotFoundError:
-            print(f"Error: Provided annotations CSV file not found: {args.annotations}")
-            return
+            print(f"Error: Provided annotations CSV file not found: {annotations_file}")
+            return None
+    return annotations
+
+def watch_main(argv):
+    parser = argparse.ArgumentParser(prog='ecg_dicom_converter watch',
+                                     description='Watch a directory and convert ECG files as they arrive.')
+    parser.add_argument('input_dir', type=str, help='Directory the XML files are dropped into')
+    parser.add_argument('output_dir', type=str, help='Path to the output directory')
+    parser.add_argument('--done-dir', type=str, default=None, help='Where converted XML files are moved (default: <input_dir>/done)')
+    parser.add_argument('--failed-dir', type=str, default=None, help='Where failing XML files are moved (default: <input_dir>/failed)')
+    parser.add_argument('--annotations', type=str, help='Path to the annotations CSV file', default=None)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--writer', choices=WRITER_ENGINES, default='pydicom', help='DICOM writer engine; "fast" encodes the bytes directly')
+    parser.add_argument('--settle', type=float, default=1.0, help='Seconds a file must stay unchanged before it is converted')
+    parser.add_argument('--polling', action='store_true', help='Poll instead of using inotify (e.g. for network shares)')
+    parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between polls in polling mode')
+    parser.add_argument('--xml-parser', choices=XML_BACKENDS, default='auto', help='XML parser; "auto" uses lxml if it is installed')
+    parser.add_argument('--layout', choices=OUTPUT_LAYOUTS, default='flat',
+                        help='Output file layout: flat, mirror (input directories), hash (hash prefix directories) or patient (PatientID/StudyDate)')
+    parser.add_argument('--on-collision', choices=COLLISION_POLICIES, default='error',
+                        help='What to do if an output file already exists')
+    parser.add_argument('--deflate', type=int, nargs='?', const=DEFAULT_DEFLATE_LEVEL, default=None, metavar='LEVEL',
+                        help=f'Write Deflated Explicit VR Little Endian with this zlib level 0-9 (default {DEFAULT_DEFLATE_LEVEL})')
+    parser.add_argument('--dedup', choices=DEDUP_MODES, default=None,
+                        help='Skip recordings converted before (same waveforms and demographics), or link them to the earlier DICOM')
+    parser.add_argument('--dedup-index', type=str, default=None,
+                        help=f'Fingerprint index of --dedup (default: <output_dir>/{DEDUP_INDEX_FILENAME})')
+    args = parser.parse_args(argv)
+
+    from ecg_dicom_converter.watch import watch_folder
+
+    if not os.path.isdir(args.input_dir):
+        print(f"Error: {args.input_dir} is not a directory")
+        return
+    if args.jobs < 1:
+        print("Error: --jobs must be at least 1")
+        return
+    try:
+        set_xml_backend(args.xml_parser)
+        if args.deflate is not None:
+            check_deflate_level(args.deflate)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    annotations = load_annotations(args.annotations)
+    if annotations is None:
+        return
+    done_dir = args.done_dir or os.path.join(args.input_dir, 'done')
+    failed_dir = args.failed_dir or os.path.join(args.input_dir, 'failed')
+    watch_folder(args.input_dir, args.output_dir, annotations, done_dir, failed_dir, jobs=args.jobs, engine=args.writer,
+                 settle=args.settle, poll_interval=args.poll_interval, polling=args.polling, layout=args.layout,
+                 on_collision=args.on_collision, deflate_level=args.deflate, dedup=args.dedup,
+                 dedup_index=args.dedup_index)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'watch':
+        return watch_main(argv[1:])
+
+    parser = argparse.ArgumentParser(description='Convert ECG data to DICOM format. '
+                                                 'Use "ecg_dicom_converter watch --help" for the watch-folder daemon.')
+    parser.add_argument('input', type=str, help='Path to the input ECG file (.xml), directory or .zip/.tar(.gz) archive')
+    parser.add_argument('output_dir', type=str, help='Path to the output directory, or a .zip/.tar(.gz) archive for archive input')
+    parser.add_argument('--annotations', type=str, help='Path to the annotations CSV file', default=None)
+    parser.add_argument('-r', '--recursive', action='store_true', help='Process all files in the input directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes used in recursive mode')
+    parser.add_argument('--chunksize', type=int, default=16, help='Number of files handed to a worker process at once')
+    parser.add_argument('--include', action='append', default=None, metavar='PATTERN',
+                        help='Glob of the input files in recursive mode, case-insensitive (default *.xml); may be repeated')
+    parser.add_argument('--exclude', action='append', default=None, metavar='PATTERN',
+                        help='Glob of files and directories to skip in recursive mode; may be repeated')
+    parser.add_argument('--file-list', type=str, default=None,
+                        help='Convert the files listed in this file (one per line, "-" for stdin) instead of scanning the input directory; relative paths are relative to input')
+    parser.add_argument('--order', choices=ORDERS, default='auto',
+                        help='Conversion order: largest-first keeps all workers busy until the end, discovery starts at once; auto uses largest-first with --jobs > 1')
+    parser.add_argument('--resume', action='store_true', help='Skip files already converted and unchanged according to the manifest')
+    parser.add_argument('--no-manifest', action='store_true', help='Do not write the checkpoint manifest in recursive mode')
+    parser.add_argument('--writer', choices=WRITER_ENGINES, default='pydicom', help='DICOM writer engine; "fast" encodes the bytes directly')
+    parser.add_argument('--metrics', type=str, default=None, help='Write per-stage timings per file as JSON lines to this file (recursive mode)')
+    parser.add_argument('--profile-slowest', type=int, default=0, help='Profile the N slowest files with cProfile and tracemalloc after the run')
+    parser.add_argument('--profile-dir', type=str, default=None, help='Directory for the profiles (default: <output_dir>/profiles)')
+    parser.add_argument('--xml-parser', choices=XML_BACKENDS, default='auto', help='XML parser; "auto" uses lxml if it is installed')
+    parser.add_argument('--diagnostics', type=str, default=None, help='Write all warnings and errors as JSON lines with a summary to this file')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='Seconds between progress summaries on the console')
+    parser.add_argument('--layout', choices=OUTPUT_LAYOUTS, default=None,
+                        help='Output file layout: flat, mirror (input directories), hash (hash prefix directories) or '
+                             'patient (PatientID/StudyDate); default flat, mirror for output archives')
+    parser.add_argument('--on-collision', choices=COLLISION_POLICIES, default=None,
+                        help='What to do if an output file already exists; default error, overwrite for a single input file')
+    parser.add_argument('--deflate', type=int, nargs='?', const=DEFAULT_DEFLATE_LEVEL, default=None, metavar='LEVEL',
+                        help=f'Write Deflated Explicit VR Little Endian with this zlib level 0-9 (default {DEFAULT_DEFLATE_LEVEL})')
+    parser.add_argument('--dedup', choices=DEDUP_MODES, default=None,
+                        help='Skip recordings converted before (same waveforms and demographics), or link them to the earlier DICOM (recursive mode)')
+    parser.add_argument('--dedup-index', type=str, default=None,
+                        help=f'Fingerprint index of --dedup, may be shared by several runs (default: <output_dir>/{DEDUP_INDEX_FILENAME})')
+    parser.add_argument('--verify', type=float, nargs='?', const=1.0, default=0.0, metavar='FRACTION',
+                        help='Read this fraction of the written files back (default all) and compare them with the source waveforms, UIDs and annotations')
+    parser.add_argument('--export-npy', type=str, default=None, help='Also append the waveforms to .npy shards with an index.csv in this directory, as int16 microvolt (not the ADC units of the DICOM files)')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE // 2 ** 20, help='Size of the .npy shards in MiB')
+
+    args = parser.parse_args(argv)
 
-    if args.recursive:
+    try:
+        set_xml_backend(args.xml_parser)
+        if args.deflate is not None:
+            check_deflate_level(args.deflate)
+        if not 0.0 <= args.verify <= 1.0:
+            raise ValueError(f"--verify takes a fraction between 0 and 1, got {args.verify}")
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    annotations = load_annotations(args.annotations)
+    if annotations is None:
+        return
+
+    if args.on_collision is None:
+        # Converting a single file again replaces its output, as before the collision policies
+        single_file = not (args.recursive or args.file_list) and not is_archive(args.input)
+        args.on_collision = 'overwrite' if single_file else 'error'
+
+    if os.path.isfile(args.input) and is_archive(args.input):
+        convert_archive(args, annotations)
+    elif args.recursive or args.file_list:
         if not os.path.isdir(args.input):
             print(f"Error: {args.input} is not a directory")
             return
+        if args.jobs < 1 or args.chunksize < 1:
+            print("Error: --jobs and --chunksize must be at least 1")
+            return
+
+        if args.resume and args.no_manifest:
+            print("Error: --resume requires the manifest")
+            return
+
+        manifest = None
+        discovery_events = []
+        input_files = discover_input_files(args, discovery_events)
+        skipped = 0
+        previous_output = None
+        claims = None
+        if not args.no_manifest:
+            os.makedirs(args.output_dir, exist_ok=True)
+            manifest = ConversionManifest(args.output_dir)
+            claims = manifest.claims
+            # Output files of an earlier run are replaced by the output of the same input, not collisions
+            previous_output = manifest.previous_output
+            if args.resume:
+                def pending(input_files):
+                    nonlocal skipped
+                    for input_file in input_files:
+                        if manifest.is_done(input_file):
+                            skipped += 1
+                        else:
+                            yield input_file
+                input_files = pending(input_files)
+
+        layout = OutputLayout(args.output_dir, args.layout or 'flat', args.on_collision, input_root=args.input,
+                              claims=claims)
+        dedup = None
+        if args.dedup:
+            os.makedirs(args.output_dir, exist_ok=True)
+            dedup = DedupIndex(args.dedup_index or os.path.join(args.output_dir, DEDUP_INDEX_FILENAME), args.dedup)
+
+        fingerprint = None
+        if manifest is not None:
+            # Reading every input a second time for its hash only pays off when the run is resumed
+            fingerprint = 'sha256' if args.resume else 'stat'
+        collect_metrics = bool(args.metrics or args.profile_slowest)
+        run_metrics = RunMetrics(args.metrics, keep_slowest=args.profile_slowest) if collect_metrics else None
+        npy_export = NpyExport(args.export_npy, args.shard_size * 2 ** 20) if args.export_npy else None
+        export = npy_export is not None
+        diagnostics = DiagnosticsCollector(args.diagnostics, args.progress_interval)
+        if args.jobs > 1:
+            results = process_files_parallel(input_files, layout, annotations, args.jobs, args.chunksize,
+                                             fingerprint, collect_metrics, args.writer, export, previous_output,
+                                             args.deflate, dedup, args.verify)
+        else:
+            results = process_files_serial(input_files, layout, annotations, fingerprint, collect_metrics,
+                                           args.writer, export, previous_output, args.deflate, dedup, args.verify)
+
+        converted = 0
+        verified = 0
+        failed = []
+        try:
+            for input_file_path, output_file, error, input_fingerprint, file_metrics, export_record, events in results:
+                if error is None:
+                    converted += 1
+                    if should_verify(input_file_path, args.verify) and not is_duplicate(events):
+                        verified += 1
+                    # Duplicates have no export record, their recording is in the export already
+                    if npy_export is not None and export_record is not None:
+                        npy_export.add(export_record, input_file_path, output_file)
+                elif len(failed) < MAX_LISTED_FAILURES:
+                    failed.append((input_file_path, error))
+                diagnostics.add(input_file_path, events, error)
+                if manifest is not None:
+                    status = STATUS_DONE if error is None else STATUS_FAILED
+                    manifest.record(input_file_path, status, output_file, input_fingerprint, error)
+                if run_metrics is not None:
+                    run_metrics.add(file_metrics, error)
+                report_discovery_events(diagnostics, discovery_events)
+            report_discovery_events(diagnostics, discovery_events)
+            if manifest is not None:
+                # Every output of the run is recorded now, its claims are not needed any more
+                manifest.commit()
+                manifest.claims.clear()
+        finally:
+            if manifest is not None:
+                manifest.close()
+            if run_metrics is not None:
+                run_metrics.close()
+            if npy_export is not None:
+                npy_export.close()
+            diagnostics.close()
+
+        if run_metrics is not None:
+            print(run_metrics.format_summary())
+            if args.profile_slowest:
+                profile_dir = args.profile_dir or os.path.join(args.output_dir, 'profiles')
+                slowest = [input_file_path for _, input_file_path in run_metrics.slowest()]
+                profile_files(slowest,
+                              lambda input_file, output_dir: process_file(input_file, output_dir, annotations,
+                                                                          engine=args.writer),
+                              profile_dir)
+                print(f"Profiles of the {len(slowest)} slowest file(s) written to {profile_dir}")
 
-        for root, _, files in os.walk(args.input):
-            for file in files:
-                if file.endswith('.xml'):
-                    input_file_path = os.path.join(root, file)
-                    try:
-                        process_file(input_file_path, args.output_dir, annotations)
-                    except Exception:
-                        print(f"Skipping file {input_file_path} due to error.")
+        if args.resume:
+            print(f"Skipped {skipped} file(s) already converted.")
+        print_run_summary(converted, diagnostics, failed, args.diagnostics, dedup,
+                          verified if args.verify else None)
+        if dedup is not None:
+            dedup.close()
     else:
         if not os.path.isfile(args.input):
             print(f"Error: {args.input} is not a valid file")
             return
+        layout = OutputLayout(args.output_dir, args.layout or 'flat', args.on_collision,
+                              input_root=os.path.dirname(args.input))
+        session = ConverterSession(annotations, args.deflate)
         try:
-            process_file(args.input, args.output_dir, annotations)
-        except Exception:
+            if args.export_npy:
+                output_file, export_record = process_file(args.input, layout, annotations, session, engine=args.writer,
+                                                          export=True, verify=args.verify)
+                with NpyExport(args.export_npy, args.shard_size * 2 ** 20) as npy_export:
+                    npy_export.add(export_record, args.input, output_file)
+            else:
+                output_file = process_file(args.input, layout, annotations, session, engine=args.writer,
+                                           verify=args.verify)
+            print(f"DICOM file saved as {output_file}")
+            if should_verify(args.input, args.verify):
+                print(f"Verified {output_file} against the source data.")
+        except Exception as e:
+            print(f"Error processing file {args.input}: {str(e)}")
             print(f"Skipping file {args.input} due to error.")
 
 if __name__ == '__main__':
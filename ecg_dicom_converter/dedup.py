@@ -0,0 +1,128 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from ecg_dicom_converter.diagnostics import warn
+from ecg_dicom_converter.ecg_record import LazyLeads
+from ecg_dicom_converter.load_to_dicom import LEAD_ORDER
+
+DEDUP_INDEX_FILENAME = '.ecg_dicom_converter_dedup.sqlite'
+
+# skip: a duplicate is not written, link: a symbolic link to the existing DICOM is created in its place
+DEDUP_MODES = ['skip', 'link']
+
+# Demographics that, together with the recorded waveforms, identify a recording
+FINGERPRINT_FIELDS = ['PatientID', 'DateofBirth', 'Gender', 'AcquisitionDate', 'AcquisitionTime']
+
+
+def record_fingerprint(rhythm_leads, median_leads, metadata):
+    """
+    Return the SHA-256 hex digest of the key demographics and the samples of every recorded lead.
+    Leads of a LazyLeads are hashed as their int16 samples and amplitude units as decoded from the
+    XML, without scaling them; derived leads are skipped, they follow from their source leads. Other
+    leads (e.g. plain dicts) are hashed as float64 samples.
+    Re-exports of the same recording under another file name or folder have the same fingerprint;
+    edits of the interpretation or measurements do not change it.
+    """
+    hash_object = hashlib.sha256()
+    for field in FINGERPRINT_FIELDS:
+        hash_object.update(f'{field}={metadata.get(field) or ""}\n'.encode('utf-8'))
+    for group, leads in (('rhythm', rhythm_leads), ('median', median_leads)):
+        lazy = isinstance(leads, LazyLeads)
+        for lead in LEAD_ORDER:
+            if not leads or lead not in leads or (lazy and leads.is_derived(lead)):
+                continue
+            raw = leads.integer_samples(lead) if lazy else None
+            if raw is not None:
+                samples = np.ascontiguousarray(raw[0], dtype='<i2')
+                hash_object.update(f'{group}.{lead}:{len(samples)}:{raw[1]!r}\n'.encode('ascii'))
+            else:
+                samples = np.ascontiguousarray(leads[lead], dtype='<f8')
+                hash_object.update(f'{group}.{lead}:{len(samples)}\n'.encode('ascii'))
+            hash_object.update(samples.data)
+    return hash_object.hexdigest()
+
+
+class DedupIndex:
+    """
+    Persistent index of the records converted so far: fingerprint -> DICOM file and input file,
+    stored as a SQLite file. Several processes may use the same index; a fingerprint is claimed
+    with a single INSERT, so of two workers converting the same recording only one keeps its file.
+    """
+
+    def __init__(self, path, mode='skip'):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode {mode!r}, expected one of {', '.join(DEDUP_MODES)}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            'fingerprint TEXT PRIMARY KEY, '
+            'output_file TEXT, '
+            'input_file TEXT, '
+            'created REAL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS records_output_file ON records (output_file)')
+
+    def get(self, fingerprint):
+        """Return (output_file, input_file) of a fingerprint, or None."""
+        with self._lock:
+            return self._connection.execute(
+                'SELECT output_file, input_file FROM records WHERE fingerprint = ?', (fingerprint,)
+            ).fetchone()
+
+    def claim(self, fingerprint, output_file, input_file):
+        """Record a converted file; return False if the fingerprint was claimed by another file before."""
+        output_file = os.path.abspath(output_file)
+        with self._lock:
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?)',
+                (fingerprint, output_file, os.path.abspath(input_file), time.time())
+            )
+            if cursor.rowcount != 1:
+                return False
+            # The file may have held another recording before (its input changed and was converted again)
+            self._connection.execute('DELETE FROM records WHERE output_file = ? AND fingerprint != ?',
+                                     (output_file, fingerprint))
+            return True
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def find_duplicate(self, fingerprint, input_file, output_file=None):
+        """
+        Return the entry (output_file, input_file) of an earlier conversion of the same recording, or None.
+        Before the DICOM is written (output_file None) this only looks the fingerprint up. Afterwards the
+        fingerprint is claimed for output_file; if another file claimed it in the meantime, output_file is
+        removed and that file's entry returned. An input converted again is not its own duplicate.
+        """
+        existing = self.get(fingerprint)
+        if existing is None:
+            if output_file is None or self.claim(fingerprint, output_file, input_file):
+                return None
+            existing = self.get(fingerprint)
+        if existing[1] == os.path.abspath(input_file) or (output_file is not None and
+                                                         os.path.abspath(output_file) == existing[0]):
+            return None
+        if output_file is not None:
+            os.remove(output_file)
+        warn('duplicate_record', f"Same recording as {existing[1]}, converted to {existing[0]}", 'fingerprint')
+        return existing
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def is_duplicate(events):
+    """True if the diagnostic events of a conversion report it as a duplicate."""
+    return any(event['code'] == 'duplicate_record' for event in events)
@@ -0,0 +1,80 @@
+import struct
+import zlib
+
+# Deflated Explicit VR Little Endian (PS3.5 A.5): the file meta information stays uncompressed,
+# everything after it is the Explicit VR Little Endian dataset compressed as a raw deflate stream.
+# The waveform samples are small int16 values and typically shrink to a third of their size.
+
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1.99'
+DEFAULT_DEFLATE_LEVEL = 6  # zlib's default, also used by pydicom when it writes deflated files
+DEFLATE_LEVELS = range(0, 10)
+
+_META_START = 128 + 4  # preamble and 'DICM'
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+
+def check_deflate_level(level):
+    if level not in DEFLATE_LEVELS:
+        raise ValueError(f"Deflate level must be between 0 and 9, got {level}")
+
+
+def deflate_dataset(data, level=DEFAULT_DEFLATE_LEVEL):
+    """Compress an encoded dataset (without file meta) the way PS3.5 A.5 requires, padded to even length."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    return deflated + b'\0' if len(deflated) % 2 else deflated
+
+
+def _encode_meta_element(group, element, vr, value):
+    if vr in _LONG_VRS:
+        return struct.pack('<HH2sHL', group, element, vr, 0, len(value)) + value
+    return struct.pack('<HH2sH', group, element, vr, len(value)) + value
+
+
+def deflate_dicom(data, level=DEFAULT_DEFLATE_LEVEL):
+    """
+    Convert a complete Explicit VR Little Endian DICOM file (bytes, with preamble) to Deflated Explicit
+    VR Little Endian: the TransferSyntaxUID and the group length of the file meta information are
+    rewritten and the dataset is compressed with the given zlib level (0-9).
+    """
+    check_deflate_level(level)
+    data = memoryview(data)
+    if bytes(data[128:132]) != b'DICM':
+        raise ValueError("Not a DICOM file with preamble")
+
+    elements = []
+    offset = _META_START
+    meta_end = None
+    transfer_syntax = None
+    while meta_end is None or offset < meta_end:
+        group, element, vr = struct.unpack_from('<HH2s', data, offset)
+        if group != 0x0002:
+            break
+        if vr in _LONG_VRS:
+            length, = struct.unpack_from('<L', data, offset + 8)
+            value_offset = offset + 12
+        else:
+            length, = struct.unpack_from('<H', data, offset + 6)
+            value_offset = offset + 8
+        value = bytes(data[value_offset:value_offset + length])
+        offset = value_offset + length
+        if element == 0x0000:
+            meta_end = offset + struct.unpack('<L', value)[0]
+            continue
+        if element == 0x0010:
+            transfer_syntax = value.rstrip(b'\0 ').decode('ascii')
+            value = DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN.encode('ascii')
+            if len(value) % 2:
+                value += b'\0'
+        elements.append(_encode_meta_element(group, element, vr, value))
+
+    if transfer_syntax != EXPLICIT_VR_LITTLE_ENDIAN:
+        raise ValueError(f"Only Explicit VR Little Endian files can be deflated, got transfer syntax {transfer_syntax}")
+    meta = b''.join(elements)
+    return b''.join([
+        bytes(data[:_META_START]),
+        _encode_meta_element(0x0002, 0x0000, b'UL', struct.pack('<L', len(meta))),
+        meta,
+        deflate_dataset(data[offset:], level),
+    ])
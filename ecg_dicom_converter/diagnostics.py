@@ -0,0 +1,119 @@
+import contextlib
+import json
+import os
+import time
+import warnings
+
+SEVERITY_WARNING = 'warning'
+SEVERITY_ERROR = 'error'
+
+
+class ConversionWarning(UserWarning):
+    """A warning about one converted record, with a stable code and the affected field."""
+
+    def __init__(self, message, code, field=None):
+        super().__init__(message)
+        self.code = code
+        self.field = field
+
+
+def warn(code, message, field=None):
+    """Issue a ConversionWarning; batch runs collect these as structured events."""
+    warnings.warn(ConversionWarning(message, code, field), stacklevel=2)
+
+
+def make_event(code, message, field=None, severity=SEVERITY_WARNING):
+    return {'code': code, 'field': field, 'severity': severity, 'message': message}
+
+
+@contextlib.contextmanager
+def capture_diagnostics():
+    """Collect the warnings raised inside the block as a list of events instead of printing them."""
+    events = []
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            yield events
+        finally:
+            for warning in caught:
+                message = warning.message
+                if isinstance(message, ConversionWarning):
+                    events.append(make_event(message.code, str(message), message.field))
+                else:
+                    events.append(make_event(warning.category.__name__, str(message)))
+
+
+class DiagnosticsCollector:
+    """
+    Aggregates the diagnostic events of a batch run.
+    Every event (and every failed file as an error event) is written as one JSON line to report_path,
+    followed by a summary line with the counts per code and field. On the console only the first
+    occurrence of every code and a progress summary at most every `console_interval` seconds are printed.
+    """
+
+    def __init__(self, report_path=None, console_interval=10.0):
+        self.report_path = report_path
+        self.console_interval = console_interval
+        self.files = 0
+        self.failed = 0
+        self.files_with_warnings = 0
+        self.counts = {}
+        self.field_counts = {}
+        self._last_print = time.monotonic()
+        self._file = None
+        if report_path:
+            # The report may go into the output directory, which is only created by the first output file
+            os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+            self._file = open(report_path, 'w')
+
+    def add(self, input_file, events=(), error=None):
+        self.files += 1
+        if events:
+            self.files_with_warnings += 1
+        if error is not None:
+            self.failed += 1
+            events = list(events) + [make_event('conversion_error', error, severity=SEVERITY_ERROR)]
+        self.add_events(input_file, events)
+
+    def add_events(self, source, events):
+        """Add events of source without counting it as a file, e.g. those of the input discovery."""
+        for event in events:
+            code = event['code']
+            if code not in self.counts:
+                print(f"[{event['severity']}] {code}: {event['message']} ({source}; further occurrences are counted)")
+            self.counts[code] = self.counts.get(code, 0) + 1
+            key = (code, event['field'])
+            self.field_counts[key] = self.field_counts.get(key, 0) + 1
+            if self._file is not None:
+                self._file.write(json.dumps(dict(event, type='event', file=source)) + '\n')
+
+        now = time.monotonic()
+        if now - self._last_print >= self.console_interval:
+            self._last_print = now
+            print(self.format_progress())
+
+    def format_progress(self):
+        counts = ', '.join(f'{code} {count}' for code, count in sorted(self.counts.items(), key=lambda item: -item[1]))
+        return f"{self.files} file(s), {self.failed} failed" + (f"; {counts}" if counts else '')
+
+    def summary(self):
+        return {
+            'files': self.files,
+            'failed': self.failed,
+            'files_with_warnings': self.files_with_warnings,
+            'counts': dict(sorted(self.counts.items())),
+            'counts_by_field': [{'code': code, 'field': field, 'count': count}
+                                for (code, field), count in sorted(self.field_counts.items(), key=lambda item: (item[0][0], str(item[0][1])))],
+        }
+
+    def format_summary(self):
+        lines = [f"{'code':36s} {'field':28s} {'count':>9s}"]
+        for (code, field), count in sorted(self.field_counts.items(), key=lambda item: -item[1]):
+            lines.append(f"{code:36s} {field or '':28s} {count:9d}")
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(json.dumps(dict(self.summary(), type='summary')) + '\n')
+            self._file.close()
+            self._file = None
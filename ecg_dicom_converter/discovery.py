@@ -0,0 +1,139 @@
+import fnmatch
+import os
+import re
+import sys
+
+from ecg_dicom_converter.diagnostics import make_event, warn
+
+# Discovery of the input files of a recursive run.
+# Patterns are case-insensitive shell globs; a pattern containing '/' is matched against the path
+# relative to the input root, any other pattern against the file or directory name. A directory
+# matching an exclude pattern is not descended into.
+
+DEFAULT_INCLUDE = ['*.xml']
+ORDERS = ['auto', 'largest-first', 'discovery']
+
+# Bytes read to find the root element; prolog, DOCTYPE and comments of Muse exports are far shorter
+SNIFF_SIZE = 4096
+MUSE_ROOT_ELEMENT = 'RestingECG'
+
+_COMMENT = re.compile(r'<!--.*?(-->|$)', re.DOTALL)
+_FIRST_ELEMENT = re.compile(r'<([A-Za-z_][\w.:-]*)')
+
+
+def _compile_patterns(patterns):
+    return [(re.compile(fnmatch.translate(pattern.lower())), '/' in pattern) for pattern in patterns or ()]
+
+
+def _matches(compiled, name, relative_path):
+    name, relative_path = name.lower(), relative_path.lower()
+    return any(pattern.match(relative_path if is_path else name) for pattern, is_path in compiled)
+
+
+def scan_files(root, include=None, exclude=None, with_size=False, events=None):
+    """
+    Yield the files below root matching include (default DEFAULT_INCLUDE) and no exclude pattern,
+    as paths, or as (path, size) with with_size=True. Uses os.scandir, so the file type comes from
+    the directory listing and only with_size needs a stat per file. Directories that cannot be read
+    are skipped with an 'unreadable_directory' warning, or event appended to the list events.
+    """
+    include = _compile_patterns(include or DEFAULT_INCLUDE)
+    exclude = _compile_patterns(exclude)
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, relative_dir) if relative_dir else root) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            directory = os.path.join(root, relative_dir)
+            message = f"Cannot read directory {directory}: {e}"
+            if events is not None:
+                events.append(make_event('unreadable_directory', message, directory))
+            else:
+                warn('unreadable_directory', message, directory)
+            continue
+        subdirectories = []
+        for entry in entries:
+            relative_path = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+            if exclude and _matches(exclude, entry.name, relative_path):
+                continue
+            try:
+                if entry.is_dir():
+                    subdirectories.append(relative_path)
+                elif entry.is_file() and _matches(include, entry.name, relative_path):
+                    yield (entry.path, entry.stat().st_size) if with_size else entry.path
+            except OSError:
+                continue
+        # Depth first in name order
+        stack.extend(reversed(subdirectories))
+
+
+def read_file_list(list_path, root=None, with_size=False):
+    """
+    Yield the files listed in list_path ('-' for stdin), one per line; empty lines and lines
+    starting with '#' are skipped, relative paths are taken relative to root.
+    Files that cannot be stat'ed are yielded with size 0, their conversion reports the error.
+    """
+    file = sys.stdin if list_path == '-' else open(list_path, encoding='utf-8')
+    try:
+        for line in file:
+            path = line.rstrip('\r\n')
+            if not path.strip() or path.lstrip().startswith('#'):
+                continue
+            if root is not None and not os.path.isabs(path):
+                path = os.path.join(root, path)
+            if not with_size:
+                yield path
+                continue
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                size = 0
+            yield path, size
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def largest_first(files_with_size, chunksize=1):
+    """
+    Return the paths ordered by decreasing size, so long conversions start first and the workers
+    of a pool finish together. For a pool that hands out `chunksize` consecutive tasks at once, the
+    files are interleaved so that every chunk takes one file of each size stratum: chunks have
+    about the same total size and are still handed out largest first.
+    """
+    paths = [path for path, _ in sorted(files_with_size, key=lambda item: -item[1])]
+    if chunksize <= 1:
+        return paths
+    # The pool cuts the sequence into consecutive chunks of exactly chunksize, only the smallest
+    # leftover files form the last, shorter chunk
+    chunks = len(paths) // chunksize
+    interleaved = [paths[chunk + stratum * chunks] for chunk in range(chunks) for stratum in range(chunksize)]
+    return interleaved + paths[chunks * chunksize:]
+
+
+def root_element(head):
+    """Return the name of the first element in the beginning of an XML document, or None."""
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        text = head.decode('utf-16', errors='ignore')
+    else:
+        # Element names of Muse XML are ASCII in every ASCII compatible encoding
+        text = head.decode('latin-1')
+    match = _FIRST_ELEMENT.search(_COMMENT.sub('', text))
+    return match.group(1) if match else None
+
+
+def check_muse_xml(head, source=''):
+    """
+    Raise ValueError if the first bytes of a document show a root element other than RestingECG.
+    Documents whose root element is not within the first SNIFF_SIZE bytes are left to the parser.
+    """
+    name = root_element(bytes(head[:SNIFF_SIZE]))
+    if name is not None and name.split(':')[-1] != MUSE_ROOT_ELEMENT:
+        raise ValueError(f"{source} is not a Muse XML file: root element is <{name}>, expected <{MUSE_ROOT_ELEMENT}>")
+
+
+def check_muse_xml_file(path):
+    with open(path, 'rb') as file:
+        check_muse_xml(file.read(SNIFF_SIZE), path)
@@ -0,0 +1,226 @@
+from collections.abc import MutableMapping
+
+import numpy as np
+
+# Metadata keys of extract_data and the typed fields of ECGRecord holding them
+METADATA_ATTRIBUTES = {
+    'PatientID': 'patient_id',
+    'PatientName': 'patient_name',
+    'PatientAge': 'patient_age',
+    'Gender': 'gender',
+    'DateofBirth': 'date_of_birth',
+    'AcquisitionDate': 'acquisition_date',
+    'AcquisitionTime': 'acquisition_time',
+    'AcquisitionDevice': 'acquisition_device',
+    'SiteName': 'site_name',
+    'LocationName': 'location_name',
+    'AdmitDate': 'admit_date',
+    'AdmitTime': 'admit_time',
+    'EditDate': 'edit_date',
+    'EditTime': 'edit_time',
+    'SampleFrequency': 'sample_frequency',
+    'measurements': 'measurements',
+    'diagnosis': 'diagnosis',
+    'QRSTimes': 'qrs_times',
+    'RRInterval': 'rr_interval',
+    'qtrggr': 'qtrggr',
+}
+
+# Metadata keys built from the waveform groups instead of stored fields
+GROUP_KEYS = ('RhythmLeadFilters', 'RhythmCount', 'MedianLeadFilters', 'MedianCount')
+
+_FIELD_ATTRIBUTES = frozenset(METADATA_ATTRIBUTES.values())
+
+
+def scale_waveform_samples(samples, amplitude_units_per_bit):
+    # Single float64 allocation, scaled in place
+    data_points_uV = np.multiply(samples, amplitude_units_per_bit, dtype=np.float64)
+    data_points_uV *= 0.001
+    return data_points_uV
+
+
+class LazyLeads(MutableMapping):
+    """
+    The leads of one waveform group: lead ID -> float64 samples in mV, in the order of the XML
+    followed by the derived leads. The int16 samples decoded from the XML are only scaled when a
+    lead is first read (and kept for integer_samples); the derived leads are computed together
+    when one of them is first read. filters and sample_counts map lead IDs to the filter settings
+    (one dict shared by all leads of a Waveform) and to LeadSampleCountTotal.
+    """
+
+    __slots__ = ('_raw', '_leads', '_order', '_derivation', '_derived', 'filters', 'sample_counts')
+
+    def __init__(self):
+        self._raw = {}  # lead ID -> (int16 samples, amplitude units per bit)
+        self._leads = {}
+        self._order = []
+        self._derivation = None
+        self._derived = set()  # leads of the derivation not replaced since
+        self.filters = {}
+        self.sample_counts = {}
+
+    def add_raw(self, lead_id, samples, amplitude_units_per_bit, filters, sample_count):
+        """Add a recorded lead from its int16 samples; it replaces a lead of the same ID."""
+        if lead_id not in self._order:
+            self._order.append(lead_id)
+        self._raw[lead_id] = (samples, amplitude_units_per_bit)
+        self._leads.pop(lead_id, None)
+        self._derived.discard(lead_id)
+        self.filters[lead_id] = filters
+        self.sample_counts[lead_id] = sample_count
+
+    def derive_with(self, derivation):
+        """Add the leads of a LeadDerivation, replacing recorded leads of the same ID."""
+        self._derivation = derivation
+        for lead_id in derivation.derived_leads:
+            if lead_id not in self._order:
+                self._order.append(lead_id)
+            self._raw.pop(lead_id, None)
+            self._leads.pop(lead_id, None)
+            self._derived.add(lead_id)
+            self.filters[lead_id] = self.filters.get(derivation.filter_sources[lead_id], {})
+
+    def is_decoded(self, lead_id):
+        return lead_id in self._leads
+
+    def is_derived(self, lead_id):
+        """True for a lead of the derivation, i.e. computed from the source leads rather than recorded."""
+        return lead_id in self._derived
+
+    def integer_samples(self, lead_id):
+        """
+        Return (integer samples, amplitude units per bit) of a lead without going through floats: the
+        int16 samples of a recorded lead as decoded from the XML, or the int32 samples of a derived lead
+        computed from those of its source leads at the finer resolution of its integer scale (see
+        LeadDerivation.derive_scaled). None if the lead or one of its sources was assigned as floats, or
+        if the sources differ in amplitude units.
+        """
+        raw = self._raw.get(lead_id)
+        if raw is not None or lead_id not in self._derived:
+            return raw
+        sources = [self._raw.get(source) for source in self._derivation.source_leads]
+        if any(source is None for source in sources) or len({units for _, units in sources}) != 1:
+            return None
+        samples = self._derivation.derive_scaled(lead_id, dict(zip(self._derivation.source_leads,
+                                                                    (samples for samples, _ in sources))))
+        if samples is None:
+            return None
+        return samples, sources[0][1] / self._derivation.integer_scales[lead_id]
+
+    def __getitem__(self, lead_id):
+        samples = self._leads.get(lead_id)
+        if samples is not None:
+            return samples
+        if lead_id not in self._order:
+            raise KeyError(lead_id)
+        if lead_id in self._raw:
+            samples = self._leads[lead_id] = scale_waveform_samples(*self._raw[lead_id])
+            return samples
+        # A derived lead: all of them at once, from the scaled source leads
+        for derived_id, samples in self._derivation.derive(self).items():
+            self._leads.setdefault(derived_id, samples)
+        return self._leads[lead_id]
+
+    def __setitem__(self, lead_id, samples):
+        if lead_id not in self._order:
+            self._order.append(lead_id)
+        self._raw.pop(lead_id, None)
+        self._derived.discard(lead_id)
+        self._leads[lead_id] = samples
+
+    def __delitem__(self, lead_id):
+        self._order.remove(lead_id)
+        self._raw.pop(lead_id, None)
+        self._derived.discard(lead_id)
+        self._leads.pop(lead_id, None)
+
+    def __contains__(self, lead_id):
+        return lead_id in self._order
+
+    def __iter__(self):
+        return iter(list(self._order))
+
+    def __len__(self):
+        return len(self._order)
+
+    def __repr__(self):
+        leads = ', '.join(lead_id if self.is_decoded(lead_id) else f'{lead_id}*' for lead_id in self._order)
+        return f'LazyLeads([{leads}])'
+
+
+class ECGRecord:
+    """
+    One extracted Muse XML record: the rhythm and median LazyLeads and the metadata as typed fields
+    (see METADATA_ATTRIBUTES; fields missing from the XML read as None). Metadata keys without a
+    field are kept in `extra`.
+
+    For code written against the former return value of extract_data, the record unpacks (and
+    indexes) like the tuple (rhythm_leads, median_leads, metadata):
+
+        rhythm_leads, median_leads, metadata = extract_data(path)
+    """
+
+    __slots__ = ('rhythm', 'median', 'extra') + tuple(METADATA_ATTRIBUTES.values())
+
+    def __init__(self, rhythm=None, median=None, patient_id=''):
+        self.rhythm = rhythm if rhythm is not None else LazyLeads()
+        self.median = median if median is not None else LazyLeads()
+        self.extra = {}
+        self.patient_id = patient_id
+
+    @classmethod
+    def from_metadata(cls, rhythm, median, metadata):
+        """Build a record from LazyLeads and a metadata dict as extract_metadata fills it."""
+        record = cls(rhythm, median)
+        for key, value in metadata.items():
+            attribute = METADATA_ATTRIBUTES.get(key)
+            if attribute is not None:
+                setattr(record, attribute, value)
+            elif key not in GROUP_KEYS:
+                record.extra[key] = value
+        return record
+
+    def __getattr__(self, name):
+        # Only called for unset slots: fields missing from the XML
+        if name in _FIELD_ATTRIBUTES:
+            return None
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def has_field(self, attribute):
+        """True if the field was set, i.e. its element was present in the XML."""
+        try:
+            object.__getattribute__(self, attribute)
+        except AttributeError:
+            return False
+        return True
+
+    @property
+    def metadata(self):
+        """The metadata as the dict extract_data used to return; a new dict on every access."""
+        metadata = {
+            'PatientID': self.patient_id,
+            'RhythmLeadFilters': self.rhythm.filters,
+            'RhythmCount': self.rhythm.sample_counts,
+            'MedianLeadFilters': self.median.filters,
+            'MedianCount': self.median.sample_counts,
+        }
+        for key, attribute in METADATA_ATTRIBUTES.items():
+            if self.has_field(attribute):
+                metadata[key] = getattr(self, attribute)
+        metadata.update(self.extra)
+        return metadata
+
+    def as_tuple(self):
+        return self.rhythm, self.median, self.metadata
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def __getitem__(self, index):
+        return self.as_tuple()[index]
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return f'ECGRecord(patient_id={self.patient_id!r}, rhythm={self.rhythm!r}, median={self.median!r})'
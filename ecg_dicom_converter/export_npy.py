@@ -0,0 +1,153 @@
+import csv
+import glob
+import os
+import struct
+
+import numpy as np
+
+from ecg_dicom_converter.load_to_dicom import CHANNEL_SENSITIVITY_UV, LEAD_ORDER, format_datetime, interleave_leads
+
+# Export of the converted waveforms as memory-mappable NumPy shards.
+# Every waveform group ('rhythm', 'median') is appended to its own series of .npy files
+# <group>-00000.npy, <group>-00001.npy, ... holding int16 (rows, 12) arrays in LEAD_ORDER, in microvolt
+# (sensitivity_uv of index.csv per step) whatever the ADC resolution of the DICOM waveforms is.
+# A record occupies `length` consecutive rows starting at `offset` in its shard; index.csv lists
+# one record per line, so a loader can do
+#     shard = np.load(os.path.join(export_dir, row['rhythm_shard']), mmap_mode='r')
+#     samples = shard[row['rhythm_offset']:row['rhythm_offset'] + row['rhythm_length']]
+
+INDEX_FILENAME = 'index.csv'
+WAVEFORM_GROUPS = ['rhythm', 'median']
+MEASUREMENT_COLUMNS = ['VentricularRate', 'AtrialRate', 'PRInterval', 'QRSDuration', 'QTInterval', 'QTCorrected',
+                       'PAxis', 'RAxis', 'TAxis', 'QRSCount', 'QOnset', 'QOffset', 'POnset', 'POffset', 'TOffset',
+                       'RRInterval']
+INDEX_COLUMNS = (['record', 'patient_id', 'acquisition_datetime', 'sample_frequency', 'sensitivity_uv'] +
+                 MEASUREMENT_COLUMNS +
+                 [f'{group}_{field}' for group in WAVEFORM_GROUPS for field in ('shard', 'offset', 'length')] +
+                 ['input_file', 'dicom_file'])
+
+DEFAULT_SHARD_SIZE = 256 * 2 ** 20
+# Fixed .npy header size, so the final shape can be written over the placeholder when a shard is closed
+_NPY_HEADER_SIZE = 128
+
+
+def _npy_header(rows, columns):
+    header = "{'descr': '<i2', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, columns)
+    header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def build_export_record(rhythm_leads, median_leads, metadata):
+    """Return the waveforms (int16, LEAD_ORDER) and index fields of one converted record."""
+    measurements = metadata.get('measurements', {})
+    record = {
+        'patient_id': metadata.get('PatientID', ''),
+        'acquisition_datetime': format_datetime(metadata.get('AcquisitionDate'), metadata.get('AcquisitionTime')),
+        'sample_frequency': metadata.get('SampleFrequency', ''),
+        'sensitivity_uv': CHANNEL_SENSITIVITY_UV,
+        'rhythm': None,
+        'median': None,
+    }
+    for column in MEASUREMENT_COLUMNS:
+        value = metadata.get(column) if column == 'RRInterval' else measurements.get(column)
+        record[column] = '' if value is None else value
+    for group, leads in (('rhythm', rhythm_leads), ('median', median_leads)):
+        if leads:
+            record[group] = interleave_leads(leads, len(next(iter(leads.values()))))
+    return record
+
+
+class ShardWriter:
+    """Appends int16 (rows, columns) arrays to .npy shards of at most `shard_rows` rows."""
+
+    def __init__(self, export_dir, prefix, shard_rows, columns=len(LEAD_ORDER)):
+        self.export_dir = export_dir
+        self.prefix = prefix
+        self.shard_rows = shard_rows
+        self.columns = columns
+        # Continue after the shards of an earlier run into the same directory
+        self.shard_number = len(glob.glob(os.path.join(export_dir, f'{prefix}-*.npy')))
+        self._file = None
+        self._rows = 0
+
+    @property
+    def shard_name(self):
+        return f'{self.prefix}-{self.shard_number:05d}.npy'
+
+    def append(self, data):
+        """Append the rows of data and return (shard name, row offset)."""
+        if self._file is not None and self._rows + len(data) > self.shard_rows:
+            self._close_shard()
+            self.shard_number += 1
+        if self._file is None:
+            self._file = open(os.path.join(self.export_dir, self.shard_name), 'wb')
+            self._file.write(_npy_header(0, self.columns))
+            self._rows = 0
+        offset = self._rows
+        self._file.write(np.ascontiguousarray(data, dtype='<i2').tobytes())
+        self._rows += len(data)
+        return self.shard_name, offset
+
+    def _close_shard(self):
+        self._file.seek(0)
+        self._file.write(_npy_header(self._rows, self.columns))
+        self._file.close()
+        self._file = None
+
+    def close(self):
+        if self._file is not None:
+            self._close_shard()
+            self.shard_number += 1
+
+
+class NpyExport:
+    """
+    Collects the records of a conversion run into waveform shards and index.csv in export_dir.
+    An existing export in the same directory is extended.
+    """
+
+    def __init__(self, export_dir, shard_size=DEFAULT_SHARD_SIZE):
+        os.makedirs(export_dir, exist_ok=True)
+        self.export_dir = export_dir
+        shard_rows = max(1, shard_size // (2 * len(LEAD_ORDER)))
+        self.shards = {group: ShardWriter(export_dir, group, shard_rows) for group in WAVEFORM_GROUPS}
+        index_path = os.path.join(export_dir, INDEX_FILENAME)
+        new_index = not os.path.exists(index_path) or os.path.getsize(index_path) == 0
+        columns = INDEX_COLUMNS
+        if not new_index:
+            with open(index_path, newline='', encoding='utf-8') as file:
+                # An index of an older version is extended with its own columns
+                columns = next(csv.reader(file), None) or INDEX_COLUMNS
+                self.records = sum(1 for _ in file)
+        self._index_file = open(index_path, 'a', newline='', encoding='utf-8')
+        self._index = csv.DictWriter(self._index_file, fieldnames=columns, extrasaction='ignore')
+        if new_index:
+            self._index.writeheader()
+            self.records = 0
+
+    def add(self, record, input_file, dicom_file=None):
+        row = {column: record.get(column, '') for column in INDEX_COLUMNS}
+        row['record'] = self.records
+        row['input_file'] = input_file
+        row['dicom_file'] = dicom_file or ''
+        for group in WAVEFORM_GROUPS:
+            data = record[group]
+            if data is None:
+                row[f'{group}_shard'], row[f'{group}_offset'], row[f'{group}_length'] = '', '', 0
+            else:
+                row[f'{group}_shard'], row[f'{group}_offset'] = self.shards[group].append(data)
+                row[f'{group}_length'] = len(data)
+        self._index.writerow(row)
+        self.records += 1
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -1,16 +1,70 @@
 import xml.etree.ElementTree as ET
 import base64
-import struct
+import io
+import os
 import numpy as np
-import warnings
-import logging
+from ecg_dicom_converter.diagnostics import warn
+from ecg_dicom_converter.discovery import check_muse_xml, check_muse_xml_file
+from ecg_dicom_converter.ecg_record import ECGRecord, LazyLeads, scale_waveform_samples
+from ecg_dicom_converter.instrumentation import measure_stage
+from ecg_dicom_converter.lead_derivation import LIMB_LEAD_DERIVATION
 
-logging.basicConfig(level=logging.INFO)
-def decode_waveform_data(waveform_data, amplitude_units_per_bit):
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # optional dependency, the standard library parser is used instead
+    lxml_etree = None
+
+# 'auto' uses lxml if it is installed and xml.etree.ElementTree ('etree') otherwise
+XML_BACKENDS = ['auto', 'lxml', 'etree']
+_xml_backend = 'auto'
+
+
+def set_xml_backend(backend):
+    """Select the XML parser used when no backend is passed explicitly."""
+    global _xml_backend
+    resolve_xml_backend(backend)
+    _xml_backend = backend
+
+
+def get_xml_backend():
+    return _xml_backend
+
+
+def resolve_xml_backend(backend=None):
+    """Return 'lxml' or 'etree' for a backend name (None: the one selected with set_xml_backend)."""
+    if backend is None:
+        backend = _xml_backend
+    if backend not in XML_BACKENDS:
+        raise ValueError(f"Unknown XML backend {backend!r}, expected one of {XML_BACKENDS}")
+    if backend == 'auto':
+        return 'lxml' if lxml_etree is not None else 'etree'
+    if backend == 'lxml' and lxml_etree is None:
+        raise ValueError("The lxml XML backend was selected but lxml is not installed")
+    return backend
+
+
+def iterparse_events(source, backend=None):
+    """Start and end events of the XML source with the given parser backend."""
+    if resolve_xml_backend(backend) == 'lxml':
+        # huge_tree lifts the libxml2 limit on the size of text nodes such as long base64 leads
+        return lxml_etree.iterparse(source, events=('start', 'end'), huge_tree=True)
+    return ET.iterparse(source, events=('start', 'end'))
+def decode_waveform_samples(waveform_data):
+    """Decode base64 waveform text into a read-only little-endian int16 view, without copying."""
     decoded_data = base64.b64decode(waveform_data.strip())
-    data_points = struct.unpack('<' + 'h' * (len(decoded_data) // 2), decoded_data)
-    data_points_uV = np.array(data_points) * amplitude_units_per_bit * 0.001
-    return data_points_uV
+    return np.frombuffer(decoded_data, dtype='<i2', count=len(decoded_data) // 2)
+
+
+def decode_waveform_data(waveform_data, amplitude_units_per_bit, raw=False):
+    """
+    Decode a base64 lead into scaled float64 samples.
+    With raw=True the int16 samples and the scale factor are returned instead,
+    so the float array is only built once scale_waveform_samples is called.
+    """
+    samples = decode_waveform_samples(waveform_data)
+    if raw:
+        return samples, amplitude_units_per_bit
+    return scale_waveform_samples(samples, amplitude_units_per_bit)
 
 
 def convert_to_float(value):
@@ -22,190 +76,211 @@ def convert_to_float(value):
         return float('nan')
 
 
-def extract_muse_xml_data(file_path):
-    try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        rhythm_leads = {}
-        rhythm_lead_filters = {}
-        rhythm_lead_sample_count = {}
-        found_rhythm_waveform = False
-
-        median_leads = {}
-        median_lead_filters = {}
-        median_lead_sample_count = {}
-        found_median_waveform = False
-
-        for waveform in root.findall('.//Waveform'):
-            waveform_type = waveform.find('WaveformType')
-            if waveform_type is not None and waveform_type.text == "Rhythm":
-                found_rhythm_waveform = True
-                for lead in waveform.findall('LeadData'):
-                    lead_id = lead.find('LeadID').text
-                    amplitude_units = convert_to_float(lead.find('LeadAmplitudeUnitsPerBit').text)
-                    waveform_data = lead.find('WaveFormData').text
-                    data_points = decode_waveform_data(waveform_data, amplitude_units)
-                    rhythm_leads[lead_id] = data_points
-
-                    rhythm_lead_filters[lead_id] = {
-                        'HighPassFilter': waveform.findtext('HighPassFilter', '0'),
-                        'LowPassFilter': waveform.findtext('LowPassFilter', '0'),
-                        'ACFilter': waveform.findtext('ACFilter', '0')
-                    }
-
-                    rhythm_lead_sample_count[lead_id] = int(lead.findtext('LeadSampleCountTotal', 0))
-
-            elif waveform_type is not None and waveform_type.text == "Median":
-                found_median_waveform = True
-                for lead in waveform.findall('LeadData'):
-                    lead_id = lead.find('LeadID').text
-                    amplitude_units = convert_to_float(lead.find('LeadAmplitudeUnitsPerBit').text)
-                    waveform_data = lead.find('WaveFormData').text
-                    data_points = decode_waveform_data(waveform_data, amplitude_units)
-                    median_leads[lead_id] = data_points
-
-                    median_lead_filters[lead_id] = {
-                        'HighPassFilter': waveform.findtext('HighPassFilter', '0'),
-                        'LowPassFilter': waveform.findtext('LowPassFilter', '0'),
-                        'ACFilter': waveform.findtext('ACFilter', '0')
-                    }
-
-                    median_lead_sample_count[lead_id] = int(lead.findtext('LeadSampleCountTotal', 0))
-
-        # Derived leads (only if I and II are present)
-        if found_rhythm_waveform:
-            if 'I' in rhythm_leads and 'II' in rhythm_leads:
-                rhythm_leads['III'] = np.subtract(rhythm_leads['II'], rhythm_leads['I'])
-                rhythm_leads['aVR'] = -(rhythm_leads['I'] + rhythm_leads['II']) / 2
-                rhythm_leads['aVL'] = rhythm_leads['I'] - (rhythm_leads['II'] / 2)
-                rhythm_leads['aVF'] = rhythm_leads['II'] - (rhythm_leads['I'] / 2)
-
-                rhythm_lead_filters['III'] = rhythm_lead_filters.get('II', {})
-                rhythm_lead_filters['aVR'] = rhythm_lead_filters.get('I', {})
-                rhythm_lead_filters['aVL'] = rhythm_lead_filters.get('I', {})
-                rhythm_lead_filters['aVF'] = rhythm_lead_filters.get('II', {})
-            else:
-                logging.warning("Leads I and II are required to derive III, aVR, aVL, aVF for Rhythm waveform.")
-        else:
-            logging.warning("No 'Rhythm' waveform found in the XML.")
-
-        if found_median_waveform:
-            if 'I' in median_leads and 'II' in median_leads:
-                median_leads['III'] = np.subtract(median_leads['II'], median_leads['I'])
-                median_leads['aVR'] = -(median_leads['I'] + median_leads['II']) / 2
-                median_leads['aVL'] = median_leads['I'] - (median_leads['II'] / 2)
-                median_leads['aVF'] = median_leads['II'] - (median_leads['I'] / 2)
-
-                median_lead_filters['III'] = median_lead_filters.get('II', {})
-                median_lead_filters['aVR'] = median_lead_filters.get('I', {})
-                median_lead_filters['aVL'] = median_lead_filters.get('I', {})
-                median_lead_filters['aVF'] = median_lead_filters.get('II', {})
-            else:
-                logging.warning("Leads I and II are required to derive III, aVR, aVL, aVF for Median waveform.")
-        else:
-            logging.warning("No 'Median' waveform found in the XML.")
+def iterparse_muse_xml(file_path, metrics=None, section_tags=(), backend=None):
+    """
+    Stream a Muse XML file with iterparse instead of building the full tree.
+    Every LeadData is decoded to int16 as soon as it closes and then cleared, so
+    the base64 text of at most one lead is held at a time. Returns the root
+    element (whose Waveform elements are emptied), a list of
+    (waveform_type, filters, [(lead_id, samples, amplitude_units, sample_count), ...])
+    and a dict mapping each of `section_tags` to its elements below the root, in document order.
+    Decoding time is recorded as the 'base64_decode' stage of `metrics`, if given.
+    backend selects the XML parser (see XML_BACKENDS).
+    """
+    root = None
+    stack = []
+    waveforms = []
+    pending_leads = []
+    sections = {}
+    for event, elem in iterparse_events(file_path, backend):
+        if event == 'start':
+            if root is None:
+                root = elem
+            elif elem.tag in section_tags:
+                sections.setdefault(elem.tag, []).append(elem)
+            stack.append(elem)
+            continue
 
-        # Metadata extraction
-        metadata = {
-            'PatientID': '',
-            'RhythmLeadFilters': rhythm_lead_filters,
-            'RhythmCount': rhythm_lead_sample_count,
-            'MedianLeadFilters': median_lead_filters,
-            'MedianCount': median_lead_sample_count
-        }
-
-        patient = root.find('.//PatientDemographics')
-        if patient is not None:
-            metadata['PatientID'] = patient.findtext('PatientID', '')
-            last_name = patient.findtext('PatientLastName')
-            first_name = patient.findtext('PatientFirstName')
-            if last_name and first_name:
-                metadata['PatientName'] = f"{last_name}^{first_name}".strip('^')
-            metadata['PatientAge'] = patient.findtext('PatientAge')
-            metadata['Gender'] = patient.findtext('Gender')
-            metadata['DateofBirth'] = patient.findtext('DateofBirth')
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if elem.tag == 'LeadData' and parent is not None and parent.tag == 'Waveform':
+            # Waveform types other than Rhythm/Median are never decoded
+            if parent.findtext('WaveformType') in (None, 'Rhythm', 'Median'):
+                lead_id = elem.find('LeadID').text
+                amplitude_units = convert_to_float(elem.find('LeadAmplitudeUnitsPerBit').text)
+                waveform_data = elem.find('WaveFormData').text
+                with measure_stage(metrics, 'base64_decode'):
+                    samples = decode_waveform_samples(waveform_data)
+                if metrics is not None:
+                    metrics.add_bytes('base64_decode', bytes_in=len(waveform_data), bytes_out=samples.nbytes)
+                sample_count = int(elem.findtext('LeadSampleCountTotal', 0))
+                pending_leads.append((lead_id, samples, amplitude_units, sample_count))
+            elem.clear()
+        elif elem.tag == 'Waveform':
+            filters = {
+                'HighPassFilter': elem.findtext('HighPassFilter', '0'),
+                'LowPassFilter': elem.findtext('LowPassFilter', '0'),
+                'ACFilter': elem.findtext('ACFilter', '0')
+            }
+            waveforms.append((elem.findtext('WaveformType'), filters, pending_leads))
+            pending_leads = []
+            elem.clear()
+
+    return root, waveforms, sections
+
+
+# Metadata fields read from the sections of a Muse XML:
+# (section, metadata key, child element, default if the child is missing).
+# A section is read from its first occurrence, and only if it exists; 'group.key' stores the value
+# in the nested dict metadata['group']. New fields are added here, the sections are located
+# in the same iterparse pass as the waveforms.
+METADATA_FIELDS = [
+    ('PatientDemographics', 'PatientID', 'PatientID', ''),
+    ('PatientDemographics', 'PatientAge', 'PatientAge', None),
+    ('PatientDemographics', 'Gender', 'Gender', None),
+    ('PatientDemographics', 'DateofBirth', 'DateofBirth', None),
+    ('TestDemographics', 'AcquisitionDate', 'AcquisitionDate', None),
+    ('TestDemographics', 'AcquisitionTime', 'AcquisitionTime', None),
+    ('TestDemographics', 'AcquisitionDevice', 'AcquisitionDevice', None),
+    ('TestDemographics', 'SiteName', 'SiteName', None),
+    ('TestDemographics', 'LocationName', 'LocationName', None),
+    ('Order', 'AdmitTime', 'AdmitTime', None),
+    ('Order', 'AdmitDate', 'AdmitDate', None),
+    ('Order', 'EditTime', 'EditTime', None),
+    ('Order', 'EditDate', 'EditDate', None),
+] + [('RestingECGMeasurements', f'measurements.{name}', name, None)
+     for name in ['VentricularRate', 'AtrialRate', 'PRInterval', 'QRSDuration', 'QTInterval', 'QTCorrected', 'PAxis',
+                  'RAxis', 'TAxis', 'QRSCount', 'QOnset', 'QOffset', 'POnset', 'POffset', 'TOffset']]
+
+# Sections located during parsing: the ones of METADATA_FIELDS and those read by extract_metadata itself
+METADATA_SECTIONS = frozenset([field[0] for field in METADATA_FIELDS] + ['Diagnosis', 'QRSTimesTypes'])
+
+
+def read_metadata_fields(sections, metadata, fields=METADATA_FIELDS):
+    """Fill metadata from the first element of every section according to the field table."""
+    for section, key, path, default in fields:
+        elements = sections.get(section)
+        if not elements:
+            continue
+        value = elements[0].findtext(path, default)
+        if '.' in key:
+            group, key = key.split('.', 1)
+            metadata.setdefault(group, {})[key] = value
         else:
-            warnings.warn("No PatientDemographics section found in XML.")
-
-        test = root.find('.//TestDemographics')
-        if test is not None:
-            metadata.update({
-                'AcquisitionDate': test.findtext('AcquisitionDate'),
-                'AcquisitionTime': test.findtext('AcquisitionTime'),
-                'AcquisitionDevice': test.findtext('AcquisitionDevice'),
-                'SiteName': test.findtext('SiteName'),
-                'LocationName': test.findtext('LocationName')
-            })
+            metadata[key] = value
+
+
+def extract_metadata(sections, metadata):
+    """Add the metadata of the sections collected by iterparse_muse_xml to `metadata`."""
+    read_metadata_fields(sections, metadata)
 
-        order = root.find('.//Order')
-        if order is not None:
-            metadata.update({
-                'AdmitTime': order.findtext('AdmitTime'),
-                'AdmitDate': order.findtext('AdmitDate'),
-                'EditTime': order.findtext('EditTime'),
-                'EditDate': order.findtext('EditDate')
+    patient = sections.get('PatientDemographics', [None])[0]
+    if patient is not None:
+        last_name = patient.findtext('PatientLastName')
+        first_name = patient.findtext('PatientFirstName')
+        if last_name and first_name:
+            metadata['PatientName'] = f"{last_name}^{first_name}".strip('^')
+    else:
+        warn('missing_section', "No PatientDemographics section found in XML.", 'PatientDemographics')
+
+    measurements = sections.get('RestingECGMeasurements', [None])[0]
+    if measurements is not None:
+        base = measurements.findtext('ECGSampleBase')
+        exp = measurements.findtext('ECGSampleExponent')
+        if base and exp:
+            metadata['SampleFrequency'] = float(base) * (10 ** float(exp))
+
+    # Diagnoses
+    diagnosis = sections.get('Diagnosis', [None])[0]
+    metadata['diagnosis'] = [d.findtext('StmtText').strip()
+                             for d in diagnosis.findall('.//DiagnosisStatement')
+                             if d.findtext('StmtText')]
+
+    # QRS Times
+    qrs_times_types = sections.get('QRSTimesTypes', [])
+    metadata['QRSTimes'] = []
+    for qrs in (qrs for section in qrs_times_types for qrs in section.findall('QRS')):
+        try:
+            metadata['QRSTimes'].append({
+                'number': int(qrs.findtext('Number', 0)),
+                'type': int(qrs.findtext('Type', 0)),
+                'time': int(qrs.findtext('Time', 0))
             })
+        except Exception as e:
+            warn('invalid_value', f"Failed to parse QRS time: {e}", 'QRSTimes')
 
-        measurements = root.find('.//RestingECGMeasurements')
-        if measurements is not None:
-            metadata['measurements'] = {
-                'VentricularRate': measurements.findtext('VentricularRate'),
-                'AtrialRate': measurements.findtext('AtrialRate'),
-                'PRInterval': measurements.findtext('PRInterval'),
-                'QRSDuration': measurements.findtext('QRSDuration'),
-                'QTInterval': measurements.findtext('QTInterval'),
-                'QTCorrected': measurements.findtext('QTCorrected'),
-                'PAxis': measurements.findtext('PAxis'),
-                'RAxis': measurements.findtext('RAxis'),
-                'TAxis': measurements.findtext('TAxis'),
-                'QRSCount': measurements.findtext('QRSCount'),
-                'QOnset': measurements.findtext('QOnset'),
-                'QOffset': measurements.findtext('QOffset'),
-                'POnset': measurements.findtext('POnset'),
-                'POffset': measurements.findtext('POffset'),
-                'TOffset': measurements.findtext('TOffset')
-            }
-            base = measurements.findtext('ECGSampleBase')
-            exp = measurements.findtext('ECGSampleExponent')
-            if base and exp:
-                metadata['SampleFrequency'] = float(base) * (10 ** float(exp))
-
-        # Diagnoses
-        diagnosis = root.find('.//Diagnosis')
-        metadata['diagnosis'] = [d.findtext('StmtText').strip()
-                                 for d in diagnosis.findall('.//DiagnosisStatement')
-                                 if d.findtext('StmtText')]
-
-        # QRS Times
-        metadata['QRSTimes'] = []
-        for qrs in root.findall('.//QRSTimesTypes/QRS'):
-            try:
-                metadata['QRSTimes'].append({
-                    'number': int(qrs.findtext('Number', 0)),
-                    'type': int(qrs.findtext('Type', 0)),
-                    'time': int(qrs.findtext('Time', 0))
-                })
-            except Exception as e:
-                logging.warning(f"Failed to parse QRS time: {e}")
-
-        rr = root.findtext('.//QRSTimesTypes/GlobalRR')
-        metadata['RRInterval'] = int(rr) if rr else None
-
-        qtrggr = root.findtext('.//QRSTimesTypes/QTRGGR')
-        metadata['qtrggr'] = int(qtrggr) if qtrggr else None
-
-        # Final return: two-lead list and metadata
-        return rhythm_leads, median_leads, metadata
+    rr = next((section.findtext('GlobalRR') for section in qrs_times_types
+               if section.find('GlobalRR') is not None), None)
+    metadata['RRInterval'] = int(rr) if rr else None
+
+    qtrggr = next((section.findtext('QTRGGR') for section in qrs_times_types
+                   if section.find('QTRGGR') is not None), None)
+    metadata['qtrggr'] = int(qtrggr) if qtrggr else None
+    return metadata
+
+
+def extract_muse_xml_data(file_path, metrics=None, derivation=LIMB_LEAD_DERIVATION, backend=None):
+    """
+    Return the ECGRecord of a Muse XML file. The leads keep the int16 samples decoded while parsing
+    and are scaled to mV when first read. The record unpacks as (rhythm_leads, median_leads, metadata).
+    """
+    try:
+        with measure_stage(metrics, 'xml_parse'):
+            _, waveforms, sections = iterparse_muse_xml(file_path, metrics, METADATA_SECTIONS, backend)
+        groups = {"Rhythm": LazyLeads(), "Median": LazyLeads()}
+        found = set()
+
+        for waveform_type, filters, lead_data in waveforms:
+            leads = groups.get(waveform_type)
+            if leads is None:
+                continue
+            found.add(waveform_type)
+            for lead_id, samples, amplitude_units, sample_count in lead_data:
+                leads.add_raw(lead_id, samples, amplitude_units, filters, sample_count)
+
+        # Derived leads (only if their source leads are present), computed when first read
+        for label, leads in groups.items():
+            if label not in found:
+                warn('missing_waveform', f"No '{label}' waveform found in the XML.", label)
+            elif derivation.can_derive(leads):
+                leads.derive_with(derivation)
+            else:
+                warn('missing_leads', f"Leads {' and '.join(derivation.source_leads)} are required to derive "
+                                      f"{', '.join(derivation.derived_leads)} for {label} waveform.", label)
+
+        # Metadata extraction
+        metadata = {'PatientID': ''}
+        extract_metadata(sections, metadata)
+        return ECGRecord.from_metadata(groups["Rhythm"], groups["Median"], metadata)
 
     except Exception as e:
-        raise ValueError(f"Error extracting Muse XML data from {file_path}: {str(e)}")
+        raise ValueError(f"Error extracting Muse XML data from {source_name(file_path)}: {str(e)}")
+
+
+def source_name(source):
+    """Name of a path or stream for messages."""
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    return getattr(source, 'name', '<stream>')
 
 
-def extract_data(file_path):
+def extract_data(file_path, metrics=None, derivation=LIMB_LEAD_DERIVATION, backend=None):
+    """
+    Extract leads and metadata from a Muse XML file as an ECGRecord, which also unpacks as
+    rhythm_leads, median_leads, metadata = extract_data(path).
+    Besides a path ending in .xml, the XML may be given as bytes or a binary file-like object.
+    Paths and bytes are rejected after a look at their first bytes if the root element is not RestingECG.
+    """
     try:
-        if file_path.endswith('.xml'):
-            return extract_muse_xml_data(file_path)
+        if isinstance(file_path, (bytes, bytearray, memoryview)):
+            check_muse_xml(file_path, 'The document')
+            return extract_muse_xml_data(io.BytesIO(file_path), metrics, derivation, backend)
+        if hasattr(file_path, 'read'):
+            return extract_muse_xml_data(file_path, metrics, derivation, backend)
+        if os.fspath(file_path).lower().endswith('.xml'):
+            check_muse_xml_file(file_path)
+            return extract_muse_xml_data(file_path, metrics, derivation, backend)
         else:
             raise ValueError(f"Unsupported file format in {file_path}. Please provide a Muse XML (.xml) file.")
     except Exception as e:
-        raise ValueError(f"Error extracting data from {file_path}: {str(e)}")
+        raise ValueError(f"Error extracting data from {source_name(file_path)}: {str(e)}")
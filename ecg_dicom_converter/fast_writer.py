@@ -0,0 +1,290 @@
+"""
+Direct Explicit VR Little Endian writer for the fixed 12-lead ECG layout.
+
+create_dicom_ecg builds several hundred pydicom Dataset objects per file and
+serializes them generically. Most of that structure is the same for every ECG,
+so FastECGWriter encodes the invariant parts (channel definitions, acquisition
+context, annotation code sequences, constant waveform attributes) once into
+byte blocks and per file only encodes the few changing values and appends the
+waveform buffer. The bytes are identical to what ds.save_as writes for the same
+dataset.
+"""
+import struct
+
+from pydicom import charset, dataset, uid, valuerep
+from pydicom.datadict import dictionary_VR
+from pydicom.multival import MultiValue
+from pydicom.valuerep import PersonName
+
+from ecg_dicom_converter.deflate import DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN, check_deflate_level, deflate_dataset
+from ecg_dicom_converter.instrumentation import measure_stage
+from ecg_dicom_converter.load_to_dicom import (
+    LEAD_ORDER, ConverterSession, add_patient_study_info, assemble_waveform, build_channel_definition_sequence,
+    build_heart_rate_item, build_lead_system_item, channel_definition_key, write_bytes
+)
+
+ECG_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.9.1.1"
+PREAMBLE = b"\0" * 128 + b"DICM"
+
+# VRs with a reserved field and a 4 byte length in Explicit VR
+_LONG_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'UC', 'UN', 'UR', 'UT'}
+_TEXT_VRS = {'LO', 'LT', 'SH', 'ST', 'UC', 'UT'}
+_NUMBER_FORMATS = {'US': '<H', 'UL': '<L', 'SS': '<h', 'SL': '<l', 'FL': '<f', 'FD': '<d'}
+
+_ITEM_TAG = struct.pack('<HH', 0xFFFE, 0xE000)
+
+TAG_WAVEFORM_SEQUENCE = 0x54000100
+TAG_ACQUISITION_CONTEXT_SEQUENCE = 0x00400555
+TAG_WAVEFORM_ANNOTATION_SEQUENCE = 0x0040B020
+
+
+def encode_element(tag, vr, value):
+    """Encode one element from its tag, VR and already encoded (even length) value bytes."""
+    if vr in _LONG_VRS:
+        return struct.pack('<HH2sHL', tag >> 16, tag & 0xFFFF, vr.encode('ascii'), 0, len(value)) + value
+    return struct.pack('<HH2sH', tag >> 16, tag & 0xFFFF, vr.encode('ascii'), len(value)) + value
+
+
+def encode_sequence(tag, items):
+    """Encode a sequence with defined lengths from already encoded item datasets."""
+    value = b''.join(_ITEM_TAG + struct.pack('<L', len(item)) + item for item in items)
+    return encode_element(tag, 'SQ', value)
+
+
+def encode_value(vr, value, encodings):
+    """Encode a value the way pydicom's filewriter does for this VR."""
+    if value is None:
+        return b''
+    if vr in _NUMBER_FORMATS:
+        values = value if isinstance(value, (list, tuple, MultiValue)) else [value]
+        return b''.join(struct.pack(_NUMBER_FORMATS[vr], v) for v in values)
+    if vr in ('OB', 'OW', 'UN'):
+        value = bytes(value)
+        return value + b'\0' if len(value) % 2 else value
+    if vr in ('DS', 'IS'):
+        if isinstance(value, (list, tuple, MultiValue)):
+            text = '\\'.join(getattr(v, 'original_string', str(v)) for v in value)
+        else:
+            text = getattr(value, 'original_string', str(value))
+        if len(text) % 2:
+            text += ' '
+        return text.encode('iso8859')
+    if vr == 'PN':
+        names = value if isinstance(value, (list, tuple, MultiValue)) else [value]
+        encoded = b'\\'.join(PersonName(name).encode(encodings) for name in names)
+        return encoded + b' ' if len(encoded) % 2 else encoded
+    if vr in _TEXT_VRS:
+        if isinstance(value, (list, tuple, MultiValue)):
+            encoded = b'\\'.join(charset.encode_string(v, encodings) for v in value)
+        else:
+            encoded = charset.encode_string(value, encodings) if isinstance(value, str) else bytes(value)
+        return encoded + b' ' if len(encoded) % 2 else encoded
+    # Remaining string VRs (AE, AS, CS, DA, DT, TM, UI, ...) are plain ASCII
+    text = '\\'.join(value) if isinstance(value, (list, tuple, MultiValue)) else str(value)
+    if len(text) % 2:
+        text += '\0' if vr == 'UI' else ' '
+    return text.encode('iso8859')
+
+
+def encode_dataset(ds, encodings):
+    """Encode a pydicom Dataset (used once per run for templates and for small per-file parts)."""
+    parts = []
+    for elem in ds:
+        if elem.VR == 'SQ':
+            parts.append(encode_sequence(elem.tag, [encode_dataset(item, encodings) for item in elem.value]))
+        else:
+            parts.append(encode_element(elem.tag, elem.VR, encode_value(elem.VR, elem.value, encodings)))
+    return b''.join(parts)
+
+
+def encode_file_meta(sop_instance_uid, implementation_uid, transfer_syntax_uid=uid.ExplicitVRLittleEndian):
+    """Encode the preamble and group 0002 the way create_file_meta + save_as do."""
+    elements = b''.join([
+        encode_element(0x00020001, 'OB', b'\x00\x01'),
+        encode_element(0x00020002, 'UI', encode_value('UI', ECG_SOP_CLASS_UID, None)),
+        encode_element(0x00020003, 'UI', encode_value('UI', sop_instance_uid, None)),
+        encode_element(0x00020010, 'UI', encode_value('UI', transfer_syntax_uid, None)),
+        encode_element(0x00020012, 'UI', encode_value('UI', implementation_uid, None)),
+    ])
+    return PREAMBLE + encode_element(0x00020000, 'UL', struct.pack('<L', len(elements))) + elements
+
+
+_KEYWORD_TAGS = {
+    'MultiplexGroupTimeOffset': 0x00181068,
+    'TriggerTimeOffset': 0x00181069,
+    'WaveformOriginality': 0x003A0004,
+    'NumberOfWaveformChannels': 0x003A0005,
+    'NumberOfWaveformSamples': 0x003A0010,
+    'SamplingFrequency': 0x003A001A,
+    'MultiplexGroupLabel': 0x003A0020,
+    'ChannelDefinitionSequence': 0x003A0200,
+    'WaveformBitsAllocated': 0x54001004,
+    'WaveformSampleInterpretation': 0x54001006,
+    'WaveformData': 0x54001010,
+    'MeasurementUnitsCodeSequence': 0x004008EA,
+    'ConceptNameCodeSequence': 0x0040A043,
+    'ReferencedWaveformChannels': 0x0040A0B0,
+    'AnnotationGroupNumber': 0x0040A180,
+    'NumericValue': 0x0040A30A,
+    'UnformattedTextValue': 0x00700006,
+}
+
+
+class FastECGWriter:
+    """
+    Writes ECG DICOM files directly as Explicit VR Little Endian bytes.
+    Built once per ConverterSession; all invariant element blocks are compiled in
+    the constructor, per-filter-setting channel definitions on first use.
+    Only the default character set (ISO_IR 192) of add_patient_study_info is supported.
+    """
+
+    def __init__(self, session=None, character_set='ISO_IR 192'):
+        self.session = session if session is not None else ConverterSession()
+        self.character_set = character_set
+        self.encodings = charset.convert_encodings(character_set)
+        encodings = self.encodings
+
+        def element(keyword, value):
+            tag = _KEYWORD_TAGS[keyword]
+            vr = dictionary_VR(tag)
+            return encode_element(tag, vr, encode_value(vr, value, encodings))
+
+        self._element = element
+        zero = valuerep.DSfloat(0)
+        self._waveform_head = (element('MultiplexGroupTimeOffset', zero) + element('TriggerTimeOffset', zero) +
+                               element('WaveformOriginality', 'ORIGINAL') +
+                               element('NumberOfWaveformChannels', len(LEAD_ORDER)))
+        self._waveform_tail = element('WaveformBitsAllocated', 16) + element('WaveformSampleInterpretation', 'SS')
+
+        self._acquisition_context = encode_sequence(
+            TAG_ACQUISITION_CONTEXT_SEQUENCE,
+            [encode_dataset(build_lead_system_item(), encodings), encode_dataset(build_heart_rate_item(), encodings)]
+        )
+        self._annotation_code_blocks = {
+            measurement: (encode_sequence(_KEYWORD_TAGS['MeasurementUnitsCodeSequence'], [encode_dataset(units[0], encodings)]) +
+                          encode_sequence(_KEYWORD_TAGS['ConceptNameCodeSequence'], [encode_dataset(concept[0], encodings)]))
+            for measurement, (units, concept) in self.session.annotation_code_sequences.items()
+        }
+        self._annotation_head = element('ReferencedWaveformChannels', 0)
+        self._channel_definitions = {}
+
+    def channel_definitions_block(self, lead_filters, sensitivities=None):
+        key = channel_definition_key(lead_filters, sensitivities)
+        block = self._channel_definitions.get(key)
+        if block is None:
+            if len(self._channel_definitions) >= self.session.max_cached_channel_definitions:
+                self._channel_definitions.clear()
+            items = build_channel_definition_sequence(lead_filters, sensitivities)
+            block = encode_sequence(
+                _KEYWORD_TAGS['ChannelDefinitionSequence'], [encode_dataset(item, self.encodings) for item in items]
+            )
+            self._channel_definitions[key] = block
+        return block
+
+    def encode_waveforms(self, waveform_dict, metadata):
+        element = self._element
+        items = []
+        for label in ["Rhythm", "Median"]:
+            if label not in waveform_dict or not waveform_dict[label]:
+                continue
+            data = waveform_dict[label]
+            num_samples = len(next(iter(data.values())))
+            sampling_frequency = metadata.get('SampleFrequency', '')
+            if sampling_frequency not in (None, ''):
+                sampling_frequency = valuerep.DSfloat(sampling_frequency)
+            waveform_data, sensitivities = assemble_waveform(data, num_samples, label)
+            items.append(b''.join([
+                self._waveform_head,
+                element('NumberOfWaveformSamples', num_samples),
+                element('SamplingFrequency', sampling_frequency),
+                element('MultiplexGroupLabel', label.upper()),
+                self.channel_definitions_block(metadata.get(f'{label}LeadFilters', {}), sensitivities),
+                self._waveform_tail,
+                # Joined straight from the sample buffer, without an intermediate bytes copy
+                encode_element(_KEYWORD_TAGS['WaveformData'], 'OW',
+                               memoryview(waveform_data).cast('B')),
+            ]))
+        return encode_sequence(TAG_WAVEFORM_SEQUENCE, items)
+
+    def encode_annotations(self, metadata):
+        element = self._element
+        items = []
+        for diagnosis in metadata.get('diagnosis', []):
+            items.append(self._annotation_head + element('AnnotationGroupNumber', 0) +
+                         element('UnformattedTextValue', diagnosis))
+
+        def numeric(measurement, value):
+            # Code sequences sort before the numeric elements of the item
+            return (self._annotation_code_blocks[measurement] + self._annotation_head +
+                    element('AnnotationGroupNumber', 1) + element('NumericValue', valuerep.DSfloat(value)))
+
+        measurements = metadata.get('measurements', {})
+        if metadata.get('RRInterval'):
+            items.append(numeric("RRInterval", metadata.get('RRInterval')))
+        for measurement in self._annotation_code_blocks:
+            if measurement in measurements:
+                items.append(numeric(measurement, measurements[measurement]))
+        return encode_sequence(TAG_WAVEFORM_ANNOTATION_SEQUENCE, items)
+
+    def encode_acquisition_context(self, metadata):
+        ventricular_rate = metadata.get('measurements').get('ventricular_rate', None)
+        if not ventricular_rate:
+            return self._acquisition_context
+        return encode_sequence(
+            TAG_ACQUISITION_CONTEXT_SEQUENCE,
+            [encode_dataset(build_lead_system_item(), self.encodings),
+             encode_dataset(build_heart_rate_item(ventricular_rate), self.encodings)]
+        )
+
+    def encode(self, rhythm_leads, median_leads, metadata, deflate_level=None, metrics=None):
+        """
+        Return the complete DICOM file as bytes; with a deflate_level (0-9) as Deflated Explicit VR
+        Little Endian.
+        """
+        sop_instance_uid = uid.generate_uid()
+        file_meta = {"MediaStorageSOPClassUID": ECG_SOP_CLASS_UID, "MediaStorageSOPInstanceUID": sop_instance_uid}
+
+        # Patient and study attributes keep their conditional logic and warnings,
+        # they are collected in a small flat dataset and encoded directly
+        try:
+            info = dataset.Dataset()
+            add_patient_study_info(info, metadata, file_meta, character_set=self.character_set)
+        except KeyError as e:
+            raise RuntimeError(f"Missing required patient or study metadata: {str(e)}")
+        except Exception as e:
+            raise RuntimeError(f"Error adding patient/study info: {str(e)}")
+
+        try:
+            waveforms = self.encode_waveforms({"Rhythm": rhythm_leads, "Median": median_leads}, metadata)
+        except KeyError as e:
+            raise RuntimeError(f"Missing required waveform data: {str(e)}")
+        except Exception as e:
+            raise RuntimeError(f"Error adding waveform data: {str(e)}")
+
+        try:
+            acquisition_context = self.encode_acquisition_context(metadata)
+        except Exception as e:
+            raise RuntimeError(f"Error adding acquisition context sequence: {str(e)}")
+
+        try:
+            annotations = self.encode_annotations(metadata)
+        except KeyError as e:
+            raise RuntimeError(f"Missing required annotation data: {str(e)}")
+        except Exception as e:
+            raise RuntimeError(f"Error adding annotations: {str(e)}")
+
+        # All patient/study tags sort before the acquisition context, annotations and waveforms
+        body = [encode_dataset(info, self.encodings), acquisition_context, annotations, waveforms]
+        if deflate_level is None:
+            return b''.join([encode_file_meta(sop_instance_uid, self.session.implementation_uid)] + body)
+        check_deflate_level(deflate_level)
+        with measure_stage(metrics, 'compress'):
+            return b''.join([
+                encode_file_meta(sop_instance_uid, self.session.implementation_uid, DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN),
+                deflate_dataset(b''.join(body), deflate_level),
+            ])
+
+    def write(self, rhythm_leads, median_leads, metadata, output_file, metrics=None, deflate_level=None):
+        with measure_stage(metrics, 'dataset_build'):
+            data = self.encode(rhythm_leads, median_leads, metadata, deflate_level, metrics)
+        write_bytes(output_file, data, metrics)
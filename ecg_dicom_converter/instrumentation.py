@@ -0,0 +1,230 @@
+import cProfile
+import heapq
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+# Stages recorded along the conversion path, in pipeline order
+STAGES = ['xml_parse', 'base64_decode', 'extract', 'dataset_build', 'compress', 'save', 'verify']
+
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def measure_stage(metrics, name):
+    """Context manager timing a stage on `metrics`; does nothing if metrics is None."""
+    if metrics is None:
+        return _NO_STAGE
+    return metrics.stage(name)
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'wall_start', 'cpu_start', 'child_wall', 'child_cpu')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+        self.metrics._stack.append(self)
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        stack = self.metrics._stack
+        stack.pop()
+        # Stages are exclusive: time of nested stages is only counted for the nested stage
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+        entry = self.metrics.entry(self.name)
+        entry['wall_s'] += wall - self.child_wall
+        entry['cpu_s'] += cpu - self.child_cpu
+        entry['calls'] += 1
+        return False
+
+
+class FileMetrics:
+    """
+    Wall time, CPU time and bytes in/out per conversion stage of one file.
+    Nested stages are exclusive, so the stage times add up to the total.
+    """
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.stages = {}
+        self._stack = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def entry(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {'wall_s': 0.0, 'cpu_s': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'calls': 0}
+        return entry
+
+    def add_bytes(self, name, bytes_in=0, bytes_out=0):
+        entry = self.entry(name)
+        entry['bytes_in'] += bytes_in
+        entry['bytes_out'] += bytes_out
+
+    def to_dict(self):
+        return {
+            'input_file': self.input_file,
+            'wall_s': sum(entry['wall_s'] for entry in self.stages.values()),
+            'cpu_s': sum(entry['cpu_s'] for entry in self.stages.values()),
+            'stages': self.stages,
+        }
+
+
+def _histogram_bucket(seconds):
+    # Power of two buckets in milliseconds, labelled by their upper bound
+    milliseconds = seconds * 1000
+    if milliseconds <= 0.125:
+        return 0.125
+    return 2.0 ** math.ceil(math.log2(milliseconds))
+
+
+class RunMetrics:
+    """
+    Collects the FileMetrics records of a batch run.
+    Each record is written as one JSON line; a summary line with per-stage totals and
+    wall time histograms is appended by close(). Only aggregates and the `keep_slowest`
+    slowest files are held in memory.
+    """
+
+    def __init__(self, path=None, keep_slowest=10):
+        self.path = path
+        self.keep_slowest = keep_slowest
+        self.files = 0
+        self.failed = 0
+        self.stages = {}
+        self.total_histogram = {}
+        self._slowest = []
+        self._file = open(path, 'w') if path else None
+
+    def add(self, record, error=None):
+        self.files += 1
+        if error is not None:
+            self.failed += 1
+        if self._file is not None:
+            line = dict(record, type='file', error=error)
+            self._file.write(json.dumps(line) + '\n')
+
+        for name, entry in record['stages'].items():
+            aggregate = self.stages.get(name)
+            if aggregate is None:
+                aggregate = self.stages[name] = {'wall_s': 0.0, 'cpu_s': 0.0, 'bytes_in': 0, 'bytes_out': 0,
+                                                 'max_wall_s': 0.0, 'histogram_ms': {}}
+            aggregate['wall_s'] += entry['wall_s']
+            aggregate['cpu_s'] += entry['cpu_s']
+            aggregate['bytes_in'] += entry['bytes_in']
+            aggregate['bytes_out'] += entry['bytes_out']
+            aggregate['max_wall_s'] = max(aggregate['max_wall_s'], entry['wall_s'])
+            bucket = _histogram_bucket(entry['wall_s'])
+            aggregate['histogram_ms'][bucket] = aggregate['histogram_ms'].get(bucket, 0) + 1
+
+        bucket = _histogram_bucket(record['wall_s'])
+        self.total_histogram[bucket] = self.total_histogram.get(bucket, 0) + 1
+
+        if self.keep_slowest:
+            item = (record['wall_s'], record['input_file'])
+            if len(self._slowest) < self.keep_slowest:
+                heapq.heappush(self._slowest, item)
+            elif item > self._slowest[0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def slowest(self):
+        """Return (wall_s, input_file) of the slowest files, slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    def summary(self):
+        stages = {}
+        for name in sorted(self.stages, key=lambda n: STAGES.index(n) if n in STAGES else len(STAGES)):
+            aggregate = dict(self.stages[name])
+            aggregate['histogram_ms'] = {str(k): v for k, v in sorted(aggregate['histogram_ms'].items())}
+            aggregate['mean_wall_s'] = aggregate['wall_s'] / self.files if self.files else 0.0
+            stages[name] = aggregate
+        return {
+            'files': self.files,
+            'failed': self.failed,
+            'stages': stages,
+            'total_histogram_ms': {str(k): v for k, v in sorted(self.total_histogram.items())},
+            'slowest': [{'input_file': f, 'wall_s': w} for w, f in self.slowest()],
+        }
+
+    def format_summary(self):
+        lines = [f"{'stage':15s} {'wall s':>10s} {'cpu s':>10s} {'mean ms':>9s} {'max ms':>9s} {'MB in':>9s} {'MB out':>9s}"]
+        for name, aggregate in self.summary()['stages'].items():
+            lines.append(f"{name:15s} {aggregate['wall_s']:10.3f} {aggregate['cpu_s']:10.3f} "
+                         f"{aggregate['mean_wall_s'] * 1000:9.2f} {aggregate['max_wall_s'] * 1000:9.2f} "
+                         f"{aggregate['bytes_in'] / 1e6:9.2f} {aggregate['bytes_out'] / 1e6:9.2f}")
+        lines.append('files per total wall time bucket (ms): ' +
+                     ', '.join(f'<={k}: {v}' for k, v in sorted(self.total_histogram.items())))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(json.dumps(dict(self.summary(), type='summary')) + '\n')
+            self._file.close()
+            self._file = None
+
+
+def profile_files(input_files, convert, profile_dir, top=25):
+    """
+    Convert the given files again under cProfile and tracemalloc.
+    convert(input_file, output_dir) performs one conversion; the outputs go to a temporary
+    directory. For every file <name>.prof (pstats format) and <name>.tracemalloc.txt
+    (top allocation sites) are written to profile_dir. Returns the written paths.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    written = []
+    scratch_dir = tempfile.mkdtemp(prefix='ecg_profile_')
+    try:
+        for input_file in input_files:
+            name = os.path.splitext(os.path.basename(input_file))[0]
+
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(convert, input_file, scratch_dir)
+            except Exception:
+                pass  # the profile of a failing file is still useful
+            profile_path = os.path.join(profile_dir, name + '.prof')
+            profiler.dump_stats(profile_path)
+
+            tracemalloc.start()
+            try:
+                convert(input_file, scratch_dir)
+            except Exception:
+                pass
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            tracemalloc_path = os.path.join(profile_dir, name + '.tracemalloc.txt')
+            with open(tracemalloc_path, 'w') as file:
+                file.write(f'{input_file}\npeak traced memory: {peak} bytes\n\n')
+                for statistic in snapshot.statistics('lineno')[:top]:
+                    file.write(f'{statistic}\n')
+            written += [profile_path, tracemalloc_path]
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return written
@@ -0,0 +1,88 @@
+import numpy as np
+
+# Largest power of two derive_scaled multiplies a derived lead by to make its coefficients integers
+MAX_INTEGER_SCALE = 16
+
+
+class LeadDerivation:
+    """
+    Derives leads from recorded ones as one linear transform: derived = matrix @ stack(source leads).
+    Other lead systems are configured with their own definitions, e.g. the inverted aVR of the
+    Cabrera display with LeadDerivation({'-aVR': {'I': 0.5, 'II': 0.5}}).
+
+    definitions maps every derived lead to {source lead: coefficient}.
+    filter_sources maps a derived lead to the lead whose filter settings it takes over
+    (default: its first source lead).
+    """
+
+    def __init__(self, definitions, filter_sources=None):
+        self.derived_leads = list(definitions)
+        self.source_leads = []
+        for coefficients in definitions.values():
+            for lead in coefficients:
+                if lead not in self.source_leads:
+                    self.source_leads.append(lead)
+
+        self.matrix = np.zeros((len(self.derived_leads), len(self.source_leads)))
+        for i, coefficients in enumerate(definitions.values()):
+            for lead, coefficient in coefficients.items():
+                self.matrix[i, self.source_leads.index(lead)] = coefficient
+
+        # Per derived lead, the smallest power of two that makes its coefficients integers (None if there is
+        # none up to MAX_INTEGER_SCALE): the lead times this scale is an exact sum of integer source samples
+        self.integer_scales = {}
+        for lead, row in zip(self.derived_leads, self.matrix):
+            scale = 1
+            while scale <= MAX_INTEGER_SCALE and np.any(row * scale != np.round(row * scale)):
+                scale *= 2
+            self.integer_scales[lead] = scale if scale <= MAX_INTEGER_SCALE else None
+
+        self.filter_sources = {lead: next(iter(coefficients)) for lead, coefficients in definitions.items()}
+        if filter_sources:
+            self.filter_sources.update(filter_sources)
+
+    def can_derive(self, leads):
+        return all(lead in leads for lead in self.source_leads)
+
+    def derive(self, leads):
+        """Return {derived lead: samples} computed from the source leads in `leads`."""
+        derived = np.matmul(self.matrix, np.stack([leads[lead] for lead in self.source_leads]))
+        return dict(zip(self.derived_leads, derived))
+
+    def derive_scaled(self, lead, sources):
+        """
+        Return the int32 samples of one derived lead times its integer scale, computed from the integer
+        samples {source lead: samples} of source leads of the same amplitude units; None if the lead has
+        no integer scale.
+        """
+        scale = self.integer_scales[lead]
+        if scale is None:
+            return None
+        row = self.matrix[self.derived_leads.index(lead)]
+        derived = None
+        for source, coefficient in zip(self.source_leads, row):
+            if coefficient:
+                term = np.multiply(sources[source], int(coefficient * scale), dtype=np.int32)
+                derived = term if derived is None else np.add(derived, term, out=derived)
+        return derived
+
+    def apply(self, leads, lead_filters=None):
+        """Add the derived leads to `leads` (and their filter settings to `lead_filters`) in place."""
+        leads.update(self.derive(leads))
+        if lead_filters is not None:
+            for lead in self.derived_leads:
+                lead_filters[lead] = lead_filters.get(self.filter_sources[lead], {})
+
+
+# Einthoven III and Goldberger augmented leads from I and II; the coefficients are powers of two,
+# so the results are identical to evaluating the formulas one by one.
+LIMB_LEAD_DERIVATION = LeadDerivation(
+    {
+        'III': {'I': -1.0, 'II': 1.0},
+        'aVR': {'I': -0.5, 'II': -0.5},
+        'aVL': {'I': 1.0, 'II': -0.5},
+        'aVF': {'I': -0.5, 'II': 1.0},
+    },
+    filter_sources={'III': 'II', 'aVR': 'I', 'aVL': 'I', 'aVF': 'II'},
+)
+
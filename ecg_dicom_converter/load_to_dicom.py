@@ -1,11 +1,15 @@
 import csv
+import io
+import os
 from pydicom import uid, valuerep, dataset, sequence
 from datetime import datetime, timedelta
 import numpy as np
 import uuid
 import hashlib
 import socket
-import warnings
+from ecg_dicom_converter.deflate import check_deflate_level, deflate_dicom
+from ecg_dicom_converter.diagnostics import warn
+from ecg_dicom_converter.instrumentation import measure_stage
 
 DEFAULT_ANNOTATIONS = {
     "PRInterval": {
@@ -126,14 +130,14 @@ def generate_implementation_uid():
 
     return implementation_uid
 
-def create_file_meta():
+def create_file_meta(implementation_uid=None):
     file_meta = dataset.FileMetaDataset()
     file_meta.FileMetaInformationGroupLength = 202
     file_meta.FileMetaInformationVersion = b'\x00\x01'
     file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.9.1.1" # ID = "12-lead ECG Waveform Storage" https://dicom.nema.org/dicom/2013/output/chtml/part04/sect_i.4.html
     file_meta.MediaStorageSOPInstanceUID = uid.generate_uid()
     file_meta.TransferSyntaxUID = uid.ExplicitVRLittleEndian
-    file_meta.ImplementationClassUID = generate_implementation_uid() # ID of the system which created the file
+    file_meta.ImplementationClassUID = implementation_uid or generate_implementation_uid() # ID of the system which created the file
     return file_meta
 
 
@@ -213,29 +217,30 @@ def add_patient_study_info(ds, metadata, file_meta, character_set='ISO_IR 192',
     # AcquisitionDateTime
     ds.AcquisitionDateTime = format_datetime(acquisition_date, acquisition_time)
     if not acquisition_date or not acquisition_time:
-        warnings.warn("Incomplete or missing 'AcquisitionDate'/'AcquisitionTime'. 'AcquisitionDateTime' may be incomplete.")
+        warn('incomplete_datetime', "Incomplete or missing 'AcquisitionDate'/'AcquisitionTime'. 'AcquisitionDateTime' may be incomplete.",
+             'AcquisitionDateTime')
 
     # StudyDate / SeriesDate
     if admit_date:
         ds.StudyDate = format_date(admit_date)
         ds.SeriesDate = format_date(admit_date)
     elif acquisition_date:
-        warnings.warn("'AdmitDate' missing. Using 'AcquisitionDate' instead for Study/Series Date.")
+        warn('fallback_value', "'AdmitDate' missing. Using 'AcquisitionDate' instead for Study/Series Date.", 'AdmitDate')
         ds.StudyDate = format_date(acquisition_date)
         ds.SeriesDate = format_date(acquisition_date)
     else:
-        warnings.warn("Neither 'AdmitDate' nor 'AcquisitionDate' available. Cannot set Study/Series Date.")
+        warn('missing_value', "Neither 'AdmitDate' nor 'AcquisitionDate' available. Cannot set Study/Series Date.", 'StudyDate')
 
     # StudyTime / SeriesTime
     if admit_time:
         ds.StudyTime = format_time(admit_time)
         ds.SeriesTime = format_time(admit_time)
     elif acquisition_time:
-        warnings.warn("'AdmitTime' missing. Using 'AcquisitionTime' instead for Study/Series Time.")
+        warn('fallback_value', "'AdmitTime' missing. Using 'AcquisitionTime' instead for Study/Series Time.", 'AdmitTime')
         ds.StudyTime = format_time(acquisition_time)
         ds.SeriesTime = format_time(acquisition_time)
     else:
-        warnings.warn("Neither 'AdmitTime' nor 'AcquisitionTime' available. Cannot set Study/Series Time.")
+        warn('missing_value', "Neither 'AdmitTime' nor 'AcquisitionTime' available. Cannot set Study/Series Time.", 'StudyTime')
 
     # Rest of the metadata with warnings
     ds.AccessionNumber = ''
@@ -244,11 +249,11 @@ def add_patient_study_info(ds, metadata, file_meta, character_set='ISO_IR 192',
     ds.ManufacturerModelName = metadata.get('AcquisitionDevice', 'Unknown')
     ds.StationName = metadata.get('LocationName', 'Unknown')
     if not metadata.get('AcquisitionDevice'):
-        warnings.warn("The tag 'AcquisitionDevice' is not in the XML")
+        warn('missing_tag', "The tag 'AcquisitionDevice' is not in the XML", 'AcquisitionDevice')
 
     ds.InstitutionName = metadata.get('SiteName', 'Unknown')
     if not metadata.get('SiteName'):
-        warnings.warn("The tag 'SiteName' is not in the XML")
+        warn('missing_tag', "The tag 'SiteName' is not in the XML", 'SiteName')
 
     ds.StudyDescription = 'RestingECG'
     ds.ProcedureCodeSequence = [dataset.Dataset()]
@@ -259,17 +264,17 @@ def add_patient_study_info(ds, metadata, file_meta, character_set='ISO_IR 192',
 
     ds.PatientID = metadata.get('PatientID', '')
     if not metadata.get('PatientID'):
-        warnings.warn("The tag 'PatientID' is not in the XML")
+        warn('missing_tag', "The tag 'PatientID' is not in the XML", 'PatientID')
 
     PatientAge = metadata.get('PatientAge')
     if not PatientAge:
-        warnings.warn("The tag 'PatientAge' is not in the XML")
+        warn('missing_tag', "The tag 'PatientAge' is not in the XML", 'PatientAge')
     ds.PatientAge = (PatientAge.zfill(3) + 'Y') if PatientAge else ''
 
     Sex = metadata.get('Gender', '')
 
     if not Sex:
-        warnings.warn("The tag 'Gender' is not in the XML")
+        warn('missing_tag', "The tag 'Gender' is not in the XML", 'Gender')
     else:
         if Sex.lower() == "male":
             Sex = 'M'
@@ -281,11 +286,11 @@ def add_patient_study_info(ds, metadata, file_meta, character_set='ISO_IR 192',
 
     ds.PatientName = metadata.get('PatientName', 'Unknown^Patient')
     if not metadata.get('PatientName'):
-        warnings.warn("The tags of the patient names are not in the XML")
+        warn('missing_tag', "The tags of the patient names are not in the XML", 'PatientName')
 
     ds.PatientBirthDate = format_date(metadata.get('DateofBirth', ''))
     if not metadata.get('DateofBirth'):
-        warnings.warn("The tag 'DateofBirth' is not in the XML")
+        warn('missing_tag', "The tag 'DateofBirth' is not in the XML", 'DateofBirth')
 
     ds.PerformedProcedureStepStartDate = format_date(metadata.get('AcquisitionDate', ''))
     ds.PerformedProcedureStepStartTime = format_time(metadata.get('AcquisitionTime', ''))
@@ -340,7 +345,145 @@ def get_performed_procedure_step_end_time(metadata):
     sampling_frequency = metadata['SampleFrequency']
     start_time = metadata['AcquisitionTime']
 
-def add_waveform_data(ds, waveform_dict, metadata):
+LEAD_ORDER = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+LEAD_CODE_VALUES = ['2:1', '2:2', '2:61', '2:62', '2:63', '2:64', '2:3', '2:4', '2:5', '2:6', '2:7', '2:8']
+
+# Leads extracted from the XML keep their int16 ADC samples, ChannelSensitivity being their
+# LeadAmplitudeUnitsPerBit (uV). Leads only available as floats in mV are stored as microvolt:
+# ChannelSensitivity 1 uV per bit, scaled by SAMPLES_PER_MV and clipped to the int16 range (about +-32.8 mV).
+CHANNEL_SENSITIVITY_UV = 1
+SAMPLES_PER_MV = 1000 // CHANNEL_SENSITIVITY_UV
+SAMPLE_MIN, SAMPLE_MAX = np.iinfo(np.int16).min, np.iinfo(np.int16).max
+
+
+def format_sensitivity(sensitivity):
+    # At most 16 characters, as DS allows
+    return f'{sensitivity:.10g}'
+
+
+def build_channel_definition_sequence(lead_filters, sensitivities=None):
+    """
+    Build the ChannelDefinitionSequence of the 12 leads with their filter settings and ChannelSensitivity
+    in uV per bit (sensitivities in LEAD_ORDER, default CHANNEL_SENSITIVITY_UV).
+    """
+    if sensitivities is None:
+        sensitivities = [CHANNEL_SENSITIVITY_UV] * len(LEAD_ORDER)
+    channel_definitions = sequence.Sequence()
+    for i, lead_id in enumerate(LEAD_ORDER):
+        channel_def_item = dataset.Dataset()
+        channel_def_item.ChannelNumber = i + 1
+        channel_def_item.ChannelLabel = f'Lead_{lead_id}'
+        channel_def_item.ChannelStatus = 'OK'
+        channel_def_item.WaveformBitsStored = 16
+        channel_def_item.ChannelSourceSequence = sequence.Sequence([dataset.Dataset()])
+        source = channel_def_item.ChannelSourceSequence[0]
+        source.CodeValue = LEAD_CODE_VALUES[i]
+        source.CodingSchemeDesignator = 'MDC'
+        source.CodeMeaning = lead_id
+        channel_def_item.ChannelSensitivity = format_sensitivity(sensitivities[i])
+        channel_def_item.ChannelSensitivityCorrectionFactor = '1'
+        channel_def_item.ChannelBaseline = '0'
+        channel_def_item.ChannelSampleSkew = '0'
+        channel_def_item.ChannelSensitivityUnitsSequence = sequence.Sequence([dataset.Dataset()])
+        channel_def_item.ChannelSensitivityUnitsSequence[0].CodeValue = 'uV'
+        channel_def_item.ChannelSensitivityUnitsSequence[0].CodingSchemeDesignator = 'UCUM'
+        channel_def_item.ChannelSensitivityUnitsSequence[0].CodingSchemeVersion = '1.4'
+        channel_def_item.ChannelSensitivityUnitsSequence[0].CodeMeaning = 'microvolt'
+
+        # Add filter info
+        channel_def_item.FilterLowFrequency = lead_filters.get(lead_id, {}).get('HighPassFilter', '0')
+        channel_def_item.FilterHighFrequency = lead_filters.get(lead_id, {}).get('LowPassFilter', '0')
+        channel_def_item.NotchFilterFrequency = lead_filters.get(lead_id, {}).get('ACFilter', '0')
+
+        channel_definitions.append(channel_def_item)
+    return channel_definitions
+
+
+def channel_definition_key(lead_filters, sensitivities=None):
+    """Cache key of the ChannelDefinitionSequence built for these filter settings and sensitivities."""
+    filters = tuple(
+        (lead_filters.get(lead_id, {}).get('HighPassFilter', '0'),
+         lead_filters.get(lead_id, {}).get('LowPassFilter', '0'),
+         lead_filters.get(lead_id, {}).get('ACFilter', '0'))
+        for lead_id in LEAD_ORDER
+    )
+    return filters, tuple(sensitivities) if sensitivities is not None else None
+
+
+def _store_microvolt(samples, column):
+    """Store float samples in mV into an int16 column as microvolt truncated towards zero; True if clipped."""
+    # Two reductions over the source instead of a scaled copy of every lead
+    clipped = samples.max() * SAMPLES_PER_MV > SAMPLE_MAX or samples.min() * SAMPLES_PER_MV < SAMPLE_MIN
+    if clipped:
+        samples = np.clip(samples, SAMPLE_MIN / SAMPLES_PER_MV, SAMPLE_MAX / SAMPLES_PER_MV)
+    np.multiply(samples, SAMPLES_PER_MV, out=column, casting='unsafe')
+    return clipped
+
+
+def _store_integer(samples, column):
+    """Store integer samples into an int16 column; True if they exceed the int16 range and were clipped."""
+    clipped = samples.dtype != np.int16 and (samples.max() > SAMPLE_MAX or samples.min() < SAMPLE_MIN)
+    if clipped:
+        samples = np.clip(samples, SAMPLE_MIN, SAMPLE_MAX)
+    column[:] = samples
+    return clipped
+
+
+def _warn_saturated(label, saturated):
+    if saturated and label is not None:
+        warn('waveform_saturated', f"{label} lead(s) {', '.join(saturated)} exceed the int16 sample range "
+                                   f"and were clipped", label)
+
+
+def interleave_leads(data, num_samples, label=None):
+    """
+    Return the leads of one waveform group as an int16 (num_samples, 12) array in LEAD_ORDER, in
+    microvolt truncated towards zero; missing leads are zero. Every lead is scaled straight into its
+    column of the preallocated array. Samples beyond the int16 range are clipped and, if a label
+    ('Rhythm', 'Median') is given, reported with a 'waveform_saturated' warning.
+    """
+    waveform_data = np.zeros((num_samples, len(LEAD_ORDER)), dtype=np.int16)
+    saturated = []
+    for i, lead_id in enumerate(LEAD_ORDER):
+        samples = data.get(lead_id)
+        if samples is None or len(samples) == 0:
+            continue
+        if _store_microvolt(samples, waveform_data[:, i]):
+            saturated.append(lead_id)
+    _warn_saturated(label, saturated)
+    return waveform_data
+
+
+def assemble_waveform(data, num_samples, label=None):
+    """
+    Return (int16 (num_samples, 12) array in LEAD_ORDER, ChannelSensitivity of every column in uV per bit)
+    for the leads of one waveform group. Leads of a LazyLeads are copied as their int16 ADC samples, the
+    derived ones computed in int32 from those (see LazyLeads.integer_samples), without float intermediates.
+    Leads only available as floats (plain dicts, assigned leads, sources of different amplitude units) are
+    stored as microvolt like interleave_leads does. Missing leads are zero. Samples beyond the int16 range
+    are clipped and, if a label is given, reported with a 'waveform_saturated' warning.
+    """
+    waveform_data = np.zeros((num_samples, len(LEAD_ORDER)), dtype=np.int16)
+    sensitivities = [CHANNEL_SENSITIVITY_UV] * len(LEAD_ORDER)
+    integer_samples = getattr(data, 'integer_samples', None)
+    saturated = []
+    for i, lead_id in enumerate(LEAD_ORDER):
+        if lead_id not in data:
+            continue
+        integer = integer_samples(lead_id) if integer_samples is not None else None
+        if integer is not None:
+            samples, sensitivities[i] = integer
+            if len(samples) and _store_integer(samples, waveform_data[:, i]):
+                saturated.append(lead_id)
+            continue
+        samples = data[lead_id]
+        if len(samples) and _store_microvolt(samples, waveform_data[:, i]):
+            saturated.append(lead_id)
+    _warn_saturated(label, saturated)
+    return waveform_data, sensitivities
+
+
+def add_waveform_data(ds, waveform_dict, metadata, session=None):
     """
     Add both rhythm and median waveform data to the DICOM file.
     waveform_dict should be like:
@@ -348,19 +491,17 @@ def add_waveform_data(ds, waveform_dict, metadata):
             "Rhythm": {...},
             "Median": {...}
         }
+    If a ConverterSession is given, its cached channel definitions are reused.
     """
     ds.WaveformSequence = sequence.Sequence()
 
-    lead_order = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
-    code_values = ['2:1', '2:2', '2:61', '2:62', '2:63', '2:64', '2:3', '2:4', '2:5', '2:6', '2:7', '2:8']
-
     for label in ["Rhythm", "Median"]:
         if label not in waveform_dict or not waveform_dict[label]:
             continue  # Skip if missing
 
         data = waveform_dict[label]
         num_samples = len(next(iter(data.values())))
-        num_leads = len(lead_order)
+        num_leads = len(LEAD_ORDER)
 
         waveform_item = dataset.Dataset()
         waveform_item.MultiplexGroupTimeOffset = 0
@@ -372,41 +513,15 @@ def add_waveform_data(ds, waveform_dict, metadata):
         waveform_item.SamplingFrequency = metadata.get('SampleFrequency', '')
         waveform_item.WaveformBitsAllocated = 16
         waveform_item.WaveformSampleInterpretation = 'SS'
-        waveform_data = np.zeros((num_samples, num_leads))
-        waveform_item.ChannelDefinitionSequence = sequence.Sequence()
 
+        waveform_data, sensitivities = assemble_waveform(data, num_samples, label)
         lead_filters = metadata.get(f'{label}LeadFilters', {})
+        if session is not None:
+            waveform_item.ChannelDefinitionSequence = session.channel_definition_sequence(lead_filters, sensitivities)
+        else:
+            waveform_item.ChannelDefinitionSequence = build_channel_definition_sequence(lead_filters, sensitivities)
 
-        for i, lead_id in enumerate(lead_order):
-            channel_def_item = dataset.Dataset()
-            channel_def_item.ChannelNumber = i + 1
-            channel_def_item.ChannelLabel = f'Lead_{lead_id}'
-            channel_def_item.ChannelStatus = 'OK'
-            channel_def_item.WaveformBitsStored = 16
-            channel_def_item.ChannelSourceSequence = sequence.Sequence([dataset.Dataset()])
-            source = channel_def_item.ChannelSourceSequence[0]
-            source.CodeValue = code_values[i]
-            source.CodingSchemeDesignator = 'MDC'
-            source.CodeMeaning = lead_id
-            channel_def_item.ChannelSensitivityUnitsSequence = sequence.Sequence([dataset.Dataset()])
-            channel_def_item.ChannelSensitivityUnitsSequence[0].CodeValue = 'uV'
-            channel_def_item.ChannelSensitivityUnitsSequence[0].CodingSchemeDesignator = 'UCUM'
-            channel_def_item.ChannelSensitivityUnitsSequence[0].CodingSchemeVersion = '1.4'
-            channel_def_item.ChannelSensitivityUnitsSequence[0].CodeMeaning = 'microvolt'
-
-            # Add filter info
-            channel_def_item.FilterLowFrequency = lead_filters.get(lead_id, {}).get('HighPassFilter', '0')
-            channel_def_item.FilterHighFrequency = lead_filters.get(lead_id, {}).get('LowPassFilter', '0')
-            channel_def_item.NotchFilterFrequency = lead_filters.get(lead_id, {}).get('ACFilter', '0')
-
-            waveform_item.ChannelDefinitionSequence.append(channel_def_item)
-
-            if lead_id in data:
-                waveform_data[:, i] = data[lead_id] * 1000  # uV to mV
-            else:
-                waveform_data[:, i] = 0  # Fill with zeros if lead missing
-
-        waveform_item.WaveformData = waveform_data.astype(np.int16).tobytes()
+        waveform_item.WaveformData = waveform_data.tobytes()
         ds.WaveformSequence.append(waveform_item)
 
 
@@ -437,13 +552,14 @@ def merge_annotations(default_annotations, csv_annotations):
 
 # Existing code for adding ECG data and annotations (unchanged)...
 
-def create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, annotations):
+def build_dicom_ecg(rhythm_leads, median_leads, metadata, annotations, session=None, output_file=None):
+    """Build the DICOM dataset of an ECG without writing it."""
     ds = None
     file_meta = None
 
     # Handle file meta creation
     try:
-        file_meta = create_file_meta()
+        file_meta = create_file_meta(session.implementation_uid if session is not None else None)
     except Exception as e:
         raise RuntimeError(f"Error creating file meta information: {str(e)}")
 
@@ -466,7 +582,7 @@ def create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, annotati
         add_waveform_data(ds, {
             "Rhythm": rhythm_leads,
             "Median": median_leads
-        }, metadata)
+        }, metadata, session)
 
     except KeyError as e:
         raise RuntimeError(f"Missing required waveform data: {str(e)}")
@@ -475,27 +591,87 @@ def create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, annotati
 
     # Add acquisition context
     try:
-        add_acquisition_context_sequence(ds, metadata)
+        add_acquisition_context_sequence(ds, metadata, session)
     except Exception as e:
         raise RuntimeError(f"Error adding acquisition context sequence: {str(e)}")
 
     # Add annotations
     try:
-        add_annotations(ds, metadata, annotations)
+        add_annotations(ds, metadata, annotations, session)
     except KeyError as e:
         raise RuntimeError(f"Missing required annotation data: {str(e)}")
     except Exception as e:
         raise RuntimeError(f"Error adding annotations: {str(e)}")
 
+    return ds
+
+
+WRITER_ENGINES = ['pydicom', 'fast']
+
+
+def create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, annotations, session=None, metrics=None,
+                     engine='pydicom', deflate_level=None):
+    """
+    Build and write the DICOM ECG to output_file, a path or a writable binary file-like object.
+    engine='fast' writes the bytes directly with the FastECGWriter of the session instead
+    of building and saving a pydicom dataset.
+    deflate_level: zlib level (0-9) to write Deflated Explicit VR Little Endian instead of
+    Explicit VR Little Endian; defaults to the deflate_level of the session.
+    """
+    if deflate_level is None and session is not None:
+        deflate_level = session.deflate_level
+    if engine == 'fast':
+        if session is None:
+            session = ConverterSession(annotations)
+        return session.fast_writer.write(rhythm_leads, median_leads, metadata, output_file, metrics, deflate_level)
+    if engine != 'pydicom':
+        raise ValueError(f"Unknown writer engine '{engine}', expected one of {WRITER_ENGINES}")
+
+    with measure_stage(metrics, 'dataset_build'):
+        ds = build_dicom_ecg(rhythm_leads, median_leads, metadata, annotations, session, output_file)
+
+    if deflate_level is not None:
+        # pydicom deflates with a fixed level, so the dataset is saved uncompressed and deflated here
+        buffer = io.BytesIO()
+        with measure_stage(metrics, 'save'):
+            try:
+                ds.save_as(buffer, little_endian=True, implicit_vr=False)
+            except Exception as e:
+                raise RuntimeError(f"Error saving DICOM file: {str(e)}")
+        with measure_stage(metrics, 'compress'):
+            data = deflate_dicom(buffer.getbuffer(), deflate_level)
+        write_bytes(output_file, data, metrics)
+        return
+
     # Save the DICOM file
-    try:
-        ds.save_as(output_file, little_endian=True, implicit_vr=False)
-        print(f'DICOM file saved as {output_file}')
-    except Exception as e:
-        raise RuntimeError(f"Error saving DICOM file: {str(e)}")
+    is_stream = hasattr(output_file, 'write')
+    with measure_stage(metrics, 'save'):
+        try:
+            start = output_file.tell() if is_stream and metrics is not None else 0
+            ds.save_as(output_file, little_endian=True, implicit_vr=False)
+        except Exception as e:
+            raise RuntimeError(f"Error saving DICOM file: {str(e)}")
+    if metrics is not None:
+        bytes_out = output_file.tell() - start if is_stream else os.path.getsize(output_file)
+        metrics.add_bytes('save', bytes_out=bytes_out)
+
+
+def write_bytes(output_file, data, metrics=None):
+    """Write encoded DICOM bytes to a path or a writable binary file-like object."""
+    with measure_stage(metrics, 'save'):
+        try:
+            if hasattr(output_file, 'write'):
+                output_file.write(data)
+            else:
+                with open(output_file, 'wb') as file:
+                    file.write(data)
+        except Exception as e:
+            raise RuntimeError(f"Error saving DICOM file: {str(e)}")
+    if metrics is not None:
+        metrics.add_bytes('save', bytes_out=len(data))
 
 
-def add_annotations(ds, metadata, annotations):
+def add_annotations(ds, metadata, annotations, session=None):
     ds.WaveformAnnotationSequence = sequence.Sequence()
     measurements = metadata.get('measurements', {})
 
@@ -506,6 +682,15 @@ def add_annotations(ds, metadata, annotations):
         annotation_item.UnformattedTextValue = diagnosis
         ds.WaveformAnnotationSequence.append(annotation_item)
 
+    if session is not None:
+        # Coded parts of the annotations were resolved once by the session
+        if metadata.get('RRInterval'):
+            append_ecg_annotation(ds, 1, metadata.get('RRInterval'), *session.annotation_code_sequences["RRInterval"])
+        for measurement, code_sequences in session.annotation_code_sequences.items():
+            if measurement in measurements:
+                append_ecg_annotation(ds, 1, measurements[measurement], *code_sequences)
+        return
+
     if metadata.get('RRInterval'):
         annotation_rrinterval = annotations["RRInterval"]
         create_ecg_annotation(
@@ -534,62 +719,46 @@ def add_annotations(ds, metadata, annotations):
                 annotation["scheme_version"]
             )
 
-def create_ecg_annotation(ds, annotation_group_number, value, code_value, code_meaning, unit_code_value,
-                          unit_code_meaning, codingschemedesignator, codeschemeversion):
-    annotation_item = dataset.Dataset()
-    annotation_item.AnnotationGroupNumber = annotation_group_number
-    annotation_item.NumericValue = valuerep.DSfloat(value)
-
+def build_annotation_code_sequences(code_value, code_meaning, unit_code_value, unit_code_meaning,
+                                    codingschemedesignator, codeschemeversion):
+    """Build the MeasurementUnitsCodeSequence and ConceptNameCodeSequence of an annotation."""
     # Define the Measurement Units Code Sequence using the provided units
     mu_item = dataset.Dataset()
-    mu_item.CodeValue = unit_code_value
+    mu_item.CodeValue = unit_code_value  # Measurement unit code, e.g., 'ms', '{H.B.}/min', 'deg'
     mu_item.CodingSchemeDesignator = 'UCUM'
     mu_item.CodingSchemeVersion = "1.4"
-    mu_item.CodeMeaning = unit_code_meaning
-    annotation_item.MeasurementUnitsCodeSequence = Sequence([mu_item])
+    mu_item.CodeMeaning = unit_code_meaning  # The meaning, e.g., 'millisecond', 'heart beats per minute', 'degrees'
 
     # Define the Concept Name Code Sequence with MDC information
     conceptnamecodesequence = dataset.Dataset()
-    conceptnamecodesequence.CodeValue = code_value
+    conceptnamecodesequence.CodeValue = code_value  # The specific MDC code
     conceptnamecodesequence.CodingSchemeDesignator = codingschemedesignator
     conceptnamecodesequence.CodingSchemeVersion = codeschemeversion
-    conceptnamecodesequence.CodeMeaning = code_meaning
-    annotation_item.ConceptNameCodeSequence = Sequence([conceptnamecodesequence])
+    conceptnamecodesequence.CodeMeaning = code_meaning  # Description of the interval
 
-    ds.WaveformAnnotationSequence.append(annotation_item)
-def create_ecg_annotation(ds, annotation_group_number, value, code_value, code_meaning, unit_code_value,
-                          unit_code_meaning, codingschemedesignator, codeschemeversion):
+    return sequence.Sequence([mu_item]), sequence.Sequence([conceptnamecodesequence])
+
+def append_ecg_annotation(ds, annotation_group_number, value, measurement_units_sequence, concept_name_sequence):
     annotation_item = dataset.Dataset()
     # Reference the correct waveform channels
     annotation_item.ReferencedWaveformChannels = 0
     annotation_item.AnnotationGroupNumber = annotation_group_number
     # Set the numeric value for the interval
     annotation_item.NumericValue = valuerep.DSfloat(value)
-
-    # Define the Measurement Units Code Sequence using the provided units
-    mu_item = dataset.Dataset()
-    mu_item.CodeValue = unit_code_value  # Measurement unit code, e.g., 'ms', '{H.B.}/min', 'deg'
-    mu_item.CodingSchemeDesignator = 'UCUM'
-    mu_item.CodingSchemeVersion = "1.4"
-    mu_item.CodeMeaning = unit_code_meaning  # The meaning, e.g., 'millisecond', 'heart beats per minute', 'degrees'
-    annotation_item.MeasurementUnitsCodeSequence = sequence.Sequence([mu_item])
-
-    # Define the Concept Name Code Sequence with MDC information
-    conceptnamecodesequence = dataset.Dataset()
-    conceptnamecodesequence.CodeValue = code_value  # The specific MDC code
-    conceptnamecodesequence.CodingSchemeDesignator = codingschemedesignator
-    conceptnamecodesequence.CodingSchemeVersion = codeschemeversion
-    conceptnamecodesequence.CodeMeaning = code_meaning  # Description of the interval
-    annotation_item.ConceptNameCodeSequence = sequence.Sequence([conceptnamecodesequence])
+    annotation_item.MeasurementUnitsCodeSequence = measurement_units_sequence
+    annotation_item.ConceptNameCodeSequence = concept_name_sequence
 
     # Append to the dataset
     ds.WaveformAnnotationSequence.append(annotation_item)
 
+def create_ecg_annotation(ds, annotation_group_number, value, code_value, code_meaning, unit_code_value,
+                          unit_code_meaning, codingschemedesignator, codeschemeversion):
+    code_sequences = build_annotation_code_sequences(code_value, code_meaning, unit_code_value, unit_code_meaning,
+                                                     codingschemedesignator, codeschemeversion)
+    append_ecg_annotation(ds, annotation_group_number, value, *code_sequences)
 
-def add_acquisition_context_sequence(ds, metadata):
-    # Create the Acquisition Context Sequence
-    acq_context_seq = sequence.Sequence()
 
+def build_lead_system_item():
     # First item (Lead System)
     item1 = dataset.Dataset()
     item1.ValueType = 'CODE'
@@ -605,10 +774,9 @@ def add_acquisition_context_sequence(ds, metadata):
     item1.ConceptCodeSequence[0].CodeValue = '10:11265'
     item1.ConceptCodeSequence[0].CodingSchemeDesignator = 'MDC'
     item1.ConceptCodeSequence[0].CodeMeaning = 'Standard 12-lead'
+    return item1
 
-    # Append the first item (Lead System) to the sequence
-    acq_context_seq.append(item1)
-
+def build_heart_rate_item(ventricular_rate=None):
     # Second item (Heart Rate)
     item2 = dataset.Dataset()
     item2.ValueType = 'NUMERIC'
@@ -627,13 +795,80 @@ def add_acquisition_context_sequence(ds, metadata):
     item2.MeasurementUnitsCodeSequence[0].CodingSchemeVersion = '1.4'
     item2.MeasurementUnitsCodeSequence[0].CodeMeaning = 'Heart beat per minute'
 
-    # Set the heart rate value from metadata
-    ventricular_rate = metadata.get('measurements').get('ventricular_rate', None)
     if ventricular_rate:
         item2.NumericValue = valuerep.DSfloat(ventricular_rate)
+    return item2
+
+def add_acquisition_context_sequence(ds, metadata, session=None):
+    # Set the heart rate value from metadata
+    ventricular_rate = metadata.get('measurements').get('ventricular_rate', None)
 
-    # Append the second item (Heart Rate) to the sequence
-    acq_context_seq.append(item2)
+    if session is not None and not ventricular_rate:
+        # Nothing file specific, reuse the prebuilt items of the session
+        ds.AcquisitionContextSequence = session.acquisition_context_sequence
+        return
+
+    # Create the Acquisition Context Sequence
+    acq_context_seq = sequence.Sequence()
+    acq_context_seq.append(build_lead_system_item())
+    acq_context_seq.append(build_heart_rate_item(ventricular_rate))
 
     # Add the sequence to the dataset
     ds.AcquisitionContextSequence = acq_context_seq
+
+
+class ConverterSession:
+    """
+    Holds everything create_dicom_ecg needs that is identical for every file of a run:
+    the implementation UID, the resolved annotations and prebuilt template sequences.
+    Build it once and call create_dicom_ecg on it for every file.
+    The template items are shared between the generated datasets and must not be modified.
+    """
+
+    # Distinct filter settings whose channel definitions are kept
+    max_cached_channel_definitions = 32
+
+    def __init__(self, annotations=None, deflate_level=None):
+        if deflate_level is not None:
+            check_deflate_level(deflate_level)
+        self.annotations = annotations if annotations is not None else DEFAULT_ANNOTATIONS.copy()
+        # zlib level of Deflated Explicit VR Little Endian output, None for Explicit VR Little Endian
+        self.deflate_level = deflate_level
+        self.implementation_uid = generate_implementation_uid()
+        self.annotation_code_sequences = {
+            measurement: build_annotation_code_sequences(
+                annotation["code"],
+                annotation["description"],
+                annotation["unit"],
+                annotation["unit_description"],
+                annotation["scheme"],
+                annotation["scheme_version"]
+            )
+            for measurement, annotation in self.annotations.items()
+        }
+        self.acquisition_context_sequence = sequence.Sequence([build_lead_system_item(), build_heart_rate_item()])
+        self._channel_definitions = {}
+        self._fast_writer = None
+
+    @property
+    def fast_writer(self):
+        """FastECGWriter compiled from this session, created on first use."""
+        if self._fast_writer is None:
+            from ecg_dicom_converter.fast_writer import FastECGWriter
+            self._fast_writer = FastECGWriter(self)
+        return self._fast_writer
+
+    def channel_definition_sequence(self, lead_filters, sensitivities=None):
+        """Return the ChannelDefinitionSequence for these filters and sensitivities, building it on first use."""
+        key = channel_definition_key(lead_filters, sensitivities)
+        channel_definitions = self._channel_definitions.get(key)
+        if channel_definitions is None:
+            if len(self._channel_definitions) >= self.max_cached_channel_definitions:
+                self._channel_definitions.clear()
+            channel_definitions = build_channel_definition_sequence(lead_filters, sensitivities)
+            self._channel_definitions[key] = channel_definitions
+        return channel_definitions
+
+    def create_dicom_ecg(self, rhythm_leads, median_leads, metadata, output_file, metrics=None, engine='pydicom'):
+        return create_dicom_ecg(rhythm_leads, median_leads, metadata, output_file, self.annotations, session=self,
+                                metrics=metrics, engine=engine)
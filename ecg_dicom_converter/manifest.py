@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+MANIFEST_FILENAME = '.ecg_dicom_converter_manifest.sqlite'
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Journal file descriptors of this process per journal path, opened on first use
+_journal_fds = {}
+
+
+def file_fingerprint(path, content_hash=True, chunk_size=1024 * 1024):
+    """Return (size, mtime_ns, sha256 hex digest) of a file; the digest is None without content_hash."""
+    stat = os.stat(path)
+    if not content_hash:
+        return stat.st_size, stat.st_mtime_ns, None
+    hash_object = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            hash_object.update(chunk)
+    return stat.st_size, stat.st_mtime_ns, hash_object.hexdigest()
+
+
+class OutputClaims:
+    """
+    Journal of the output files created for the inputs of a run, kept next to the manifest.
+    A new output name is entered (with its input) before the file is created under it, so the owner
+    of a file written by an interrupted run is known even if its manifest record was not committed.
+    Workers append to the journal themselves; it is removed once all records of a run are committed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def claim(self, input_file, output_file):
+        fd = _journal_fds.get(self.path)
+        if fd is None:
+            fd = _journal_fds[self.path] = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        entry = json.dumps([os.path.abspath(input_file), os.path.abspath(output_file)]) + '\n'
+        # One write per entry, so the appends of concurrent workers do not interleave
+        os.write(fd, entry.encode('ascii'))
+
+    def owners(self):
+        """Return {output file: set of the inputs that claimed it}."""
+        owners = {}
+        try:
+            with open(self.path, encoding='ascii') as file:
+                for line in file:
+                    try:
+                        input_file, output_file = json.loads(line)
+                    except ValueError:
+                        continue  # cut off by the interruption
+                    owners.setdefault(output_file, set()).add(input_file)
+        except FileNotFoundError:
+            pass
+        return owners
+
+    def clear(self):
+        fd = _journal_fds.pop(self.path, None)
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ConversionManifest:
+    """
+    Checkpoint manifest of a batch run, stored as a SQLite file in the output directory.
+    For every input it records size, mtime, content hash (if computed), output file and status,
+    so an interrupted run can be resumed without converting finished files again.
+    Lookups go through the primary key index and stay fast for millions of entries.
+    The manifest may be used from several threads (e.g. a pool's task feeder thread).
+    Records are committed every commit_interval records or commit_seconds seconds, whichever comes
+    first, so a crash loses at most a few seconds of records. The outputs written in that time are
+    known from the OutputClaims journal `claims` (see previous_output).
+    """
+
+    def __init__(self, output_dir, filename=MANIFEST_FILENAME, commit_interval=100, commit_seconds=2.0):
+        self.path = os.path.join(output_dir, filename)
+        self.commit_interval = commit_interval
+        self.commit_seconds = commit_seconds
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'input_path TEXT PRIMARY KEY, '
+            'size INTEGER, '
+            'mtime_ns INTEGER, '
+            'sha256 TEXT, '
+            'output_file TEXT, '
+            'status TEXT, '
+            'error TEXT, '
+            'updated REAL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS files_output_file ON files (output_file)')
+        self._connection.commit()
+        self.claims = OutputClaims(self.path + '.claims')
+        # Outputs of an interrupted run claimed by exactly one input: input -> output file
+        self._claimed = {}
+        for output_file, inputs in self.claims.owners().items():
+            if len(inputs) == 1:
+                self._claimed[inputs.pop()] = output_file
+
+    @staticmethod
+    def key(input_file):
+        return os.path.abspath(input_file)
+
+    def get(self, input_file):
+        """Return the manifest entry of an input as a dict, or None."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime_ns, sha256, output_file, status, error FROM files WHERE input_path = ?',
+                (self.key(input_file),)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('size', 'mtime_ns', 'sha256', 'output_file', 'status', 'error'), row))
+
+    def previous_output(self, input_file):
+        """
+        Return the output file an earlier run wrote for this input, which its reconversion may replace:
+        the one recorded in the manifest or else the one the input alone claimed in the journal of an
+        interrupted run, unless another input is recorded with it. None if there is none.
+        """
+        entry = self.get(input_file)
+        if entry is not None and entry['output_file']:
+            return entry['output_file']
+        output_file = self._claimed.get(self.key(input_file))
+        if output_file is None:
+            return None
+        with self._lock:
+            other = self._connection.execute(
+                'SELECT 1 FROM files WHERE output_file = ? AND input_path != ? LIMIT 1',
+                (output_file, self.key(input_file))
+            ).fetchone()
+        return output_file if other is None else None
+
+    def is_done(self, input_file):
+        """
+        True if the input was converted successfully and has not changed since.
+        Size and mtime are compared first; the content hash is only computed when they differ,
+        and an entry recorded without one counts as changed then.
+        """
+        entry = self.get(input_file)
+        if entry is None or entry['status'] != STATUS_DONE:
+            return False
+        if not entry['output_file'] or not os.path.exists(entry['output_file']):
+            return False
+
+        try:
+            stat = os.stat(input_file)
+        except OSError:
+            return False
+        if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+            return True
+        if entry['sha256'] is None:
+            return False
+
+        size, mtime_ns, sha256 = file_fingerprint(input_file)
+        if size != entry['size'] or sha256 != entry['sha256']:
+            return False
+        # Same content with a new mtime (e.g. copied or touched), remember the new stat
+        self.record(input_file, STATUS_DONE, entry['output_file'], (size, mtime_ns, sha256))
+        return True
+
+    def record(self, input_file, status, output_file=None, fingerprint=None, error=None):
+        if fingerprint is None:
+            fingerprint = file_fingerprint(input_file)
+        size, mtime_ns, sha256 = fingerprint
+        if output_file is not None:
+            output_file = os.path.abspath(output_file)
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.key(input_file), size, mtime_ns, sha256, output_file, status, error, time.time())
+            )
+            self._pending += 1
+            if (self._pending >= self.commit_interval or
+                    time.monotonic() - self._last_commit >= self.commit_seconds):
+                self.commit()
+
+    def counts(self):
+        """Return the number of entries per status."""
+        with self._lock:
+            return dict(self._connection.execute('SELECT status, COUNT(*) FROM files GROUP BY status').fetchall())
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+            self._pending = 0
+            self._last_commit = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
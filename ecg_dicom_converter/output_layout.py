@@ -0,0 +1,184 @@
+import errno
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+import uuid
+
+from ecg_dicom_converter.load_to_dicom import format_date
+
+# Where the DICOM file of a record goes below the output directory:
+#   flat     <name>.dcm
+#   mirror   <directory of the input relative to the input root>/<name>.dcm
+#   hash     <2 hex digits>/<2 hex digits>/<name>.dcm from the SHA-1 of the name, ~65k evenly filled directories
+#   patient  <PatientID>/<StudyDate>/<name>.dcm
+OUTPUT_LAYOUTS = ['flat', 'mirror', 'hash', 'patient']
+
+# What happens if the output file already exists (also one written earlier in the same run):
+#   error      the record fails, the existing file is kept
+#   rename     the new file is written as <name>-1.dcm, <name>-2.dcm, ...
+#   overwrite  the existing file is replaced
+COLLISION_POLICIES = ['error', 'rename', 'overwrite']
+
+_UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9._-]')
+
+# mkstemp creates files readable by the owner only; output files get the usual permissions
+_umask = os.umask(0)
+os.umask(_umask)
+_FILE_MODE = 0o666 & ~_umask
+
+
+class OutputCollisionError(ValueError):
+    pass
+
+
+def remove_all_extensions(filename):
+    while True:
+        filename, ext = os.path.splitext(filename)
+        if ext == '':
+            return filename
+
+
+def safe_path_component(value, default='unknown'):
+    """Return value usable as a single directory name (no separators, no leading dots)."""
+    value = _UNSAFE_CHARACTERS.sub('_', str(value or '').strip()).lstrip('.')
+    return value or default
+
+
+def candidate_names(path):
+    """Yield path, then <stem>-1<ext>, <stem>-2<ext>, ... for the rename policy."""
+    yield path
+    stem, ext = os.path.splitext(path)
+    number = 1
+    while True:
+        yield f'{stem}-{number}{ext}'
+        number += 1
+
+
+class OutputLayout:
+    """
+    Maps records to paths below output_dir and writes them atomically: the file is written to a hidden
+    temporary file in the target directory and renamed once it is complete, so readers never see a partial
+    DICOM. New names are claimed with a hard link, which fails if the name exists, so concurrent workers
+    cannot overwrite each other's files. On file systems without hard links an existence check followed
+    by a rename is used instead.
+    claims: an OutputClaims journal every new name is entered into, with the input it is written for,
+            before the file is created under it (not with the overwrite policy).
+    """
+
+    def __init__(self, output_dir, layout='flat', on_collision='error', input_root=None, hash_levels=2,
+                 claims=None):
+        if layout not in OUTPUT_LAYOUTS:
+            raise ValueError(f"Unknown output layout {layout!r}, expected one of {', '.join(OUTPUT_LAYOUTS)}")
+        if on_collision not in COLLISION_POLICIES:
+            raise ValueError(f"Unknown collision policy {on_collision!r}, expected one of {', '.join(COLLISION_POLICIES)}")
+        self.output_dir = output_dir
+        self.layout = layout
+        self.on_collision = on_collision
+        self.input_root = input_root
+        self.hash_levels = hash_levels
+        self.claims = claims
+
+    def relative_path(self, source, metadata=None):
+        """
+        Return the '/'-separated output path of a record relative to output_dir.
+        source is the input file path or the archive member name the record was read from.
+        """
+        name = remove_all_extensions(posixpath.basename(source.replace(os.sep, '/'))) + '.dcm'
+        if self.layout == 'mirror':
+            directory = self._source_directory(source)
+            return posixpath.join(directory, name) if directory else name
+        if self.layout == 'hash':
+            digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+            return posixpath.join(*[digest[2 * i:2 * i + 2] for i in range(self.hash_levels)], name)
+        if self.layout == 'patient':
+            metadata = metadata or {}
+            study_date = format_date(metadata.get('AdmitDate') or metadata.get('AcquisitionDate'))
+            return posixpath.join(safe_path_component(metadata.get('PatientID')), safe_path_component(study_date), name)
+        return name
+
+    def _source_directory(self, source):
+        if self.input_root is not None:
+            directory = os.path.relpath(os.path.dirname(os.path.abspath(source)), os.path.abspath(self.input_root))
+        else:
+            directory = os.path.dirname(source)
+        parts = [part for part in directory.replace(os.sep, '/').split('/') if part not in ('', '.', '..')]
+        return '/'.join(parts)
+
+    def write(self, relative_path, write_function, replace=None, owner=None):
+        """
+        Write one record to relative_path (see relative_path()) with write_function(file) and return
+        the path of the file.
+        replace: a path the record may overwrite despite the collision policy, e.g. its own output
+                 of an earlier run recorded in the manifest.
+        owner: the input file of the record, entered into the claims journal with the new name.
+        Raises OutputCollisionError if the policy is 'error' and the path exists.
+        """
+        path = os.path.join(self.output_dir, *relative_path.split('/'))
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                write_function(file)
+            os.chmod(temp_path, _FILE_MODE)
+            return self._commit(temp_path, path, replace, owner)
+        finally:
+            if os.path.lexists(temp_path):
+                os.unlink(temp_path)
+
+    def link(self, relative_path, target_file, replace=None, owner=None):
+        """
+        Create relative_path as a relative symbolic link to target_file (a hard link where symbolic
+        links are not available), with the same collision handling as write. Returns the path.
+        """
+        path = os.path.join(self.output_dir, *relative_path.split('/'))
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, f'.{os.path.basename(path)}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp')
+        try:
+            try:
+                os.symlink(os.path.relpath(os.path.abspath(target_file), os.path.abspath(directory)), temp_path)
+            except (OSError, NotImplementedError):
+                os.link(target_file, temp_path)
+            return self._commit(temp_path, path, replace, owner)
+        finally:
+            if os.path.lexists(temp_path):
+                os.unlink(temp_path)
+
+    def _commit(self, temp_path, path, replace, owner=None):
+        if self.on_collision == 'overwrite':
+            os.replace(temp_path, path)
+            return path
+        replace = os.path.abspath(replace) if replace else None
+        for candidate in candidate_names(path):
+            if os.path.abspath(candidate) == replace:
+                os.replace(temp_path, candidate)
+                return candidate
+            if self.claims is not None and owner is not None and not os.path.lexists(candidate):
+                # Entered before the name is taken, so a resumed run knows whose file it is
+                self.claims.claim(owner, candidate)
+            if self._claim(temp_path, candidate):
+                return candidate
+            if self.on_collision == 'error':
+                raise OutputCollisionError(f"Output file {candidate} already exists")
+
+    @staticmethod
+    def _claim(temp_path, path):
+        """Move temp_path to path unless path exists; return False if it does."""
+        try:
+            # Not following symbolic links, so links made by link() are claimed as links
+            os.link(temp_path, path, follow_symlinks=False)
+        except FileExistsError:
+            return False
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV, errno.EMLINK):
+                raise
+            # No hard links on this file system
+            if os.path.lexists(path):
+                return False
+            os.replace(temp_path, path)
+            return True
+        os.unlink(temp_path)
+        return True
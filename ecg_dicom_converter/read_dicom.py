@@ -0,0 +1,307 @@
+import mmap
+import struct
+
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# Reads the waveforms of DICOM ECGs without parsing the rest of the dataset.
+# Files in Explicit VR Little Endian (as written by this package) are memory-mapped and only the
+# element headers up to the WaveformSequence are looked at; everything else is skipped by its length.
+# Other transfer syntaxes fall back to pydicom.
+
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+
+WAVEFORM_SEQUENCE = (0x5400, 0x0100)
+ITEM = (0xFFFE, 0xE000)
+ITEM_DELIMITER = (0xFFFE, 0xE00D)
+SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# VRs with a 2 byte reserved field and a 4 byte length in explicit VR encoding
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+# Waveform item attributes needed to interpret WaveformData
+_WAVEFORM_ITEM_TAGS = {
+    (0x003A, 0x0020): 'label',                # MultiplexGroupLabel
+    (0x003A, 0x0005): 'channels',             # NumberOfWaveformChannels
+    (0x003A, 0x0010): 'samples',              # NumberOfWaveformSamples
+    (0x003A, 0x001A): 'sampling_frequency',   # SamplingFrequency
+    (0x5400, 0x1004): 'bits_allocated',       # WaveformBitsAllocated
+    (0x5400, 0x1006): 'interpretation',       # WaveformSampleInterpretation
+}
+WAVEFORM_DATA = (0x5400, 0x1010)
+CHANNEL_DEFINITION_SEQUENCE = (0x003A, 0x0200)
+CHANNEL_SENSITIVITY = (0x003A, 0x0210)
+CHANNEL_SENSITIVITY_CORRECTION_FACTOR = (0x003A, 0x0212)
+
+SAMPLE_DTYPES = {
+    ('SS', 16): '<i2', ('US', 16): '<u2',
+    ('SB', 8): 'i1', ('UB', 8): 'u1',
+    ('SL', 32): '<i4', ('UL', 32): '<u4',
+}
+
+_TAG = struct.Struct('<HH')
+_SHORT_HEADER = struct.Struct('<HH2sH')
+_LONG_HEADER = struct.Struct('<HH2s2xI')
+_ITEM_HEADER = struct.Struct('<HHI')
+
+
+def _read_element_header(buffer, offset):
+    """Return (tag, vr, value_offset, length) of the explicit VR element at offset."""
+    group, element = _TAG.unpack_from(buffer, offset)
+    if group == 0xFFFE:
+        _, _, length = _ITEM_HEADER.unpack_from(buffer, offset)
+        return (group, element), None, offset + 8, length
+    vr = bytes(buffer[offset + 4:offset + 6])
+    if vr in _LONG_VRS:
+        _, _, _, length = _LONG_HEADER.unpack_from(buffer, offset)
+        return (group, element), vr, offset + 12, length
+    _, _, _, length = _SHORT_HEADER.unpack_from(buffer, offset)
+    return (group, element), vr, offset + 8, length
+
+
+def _skip_undefined_length(buffer, offset):
+    """Return the offset after the delimiter of an undefined length sequence or item starting at offset."""
+    while True:
+        tag, vr, value_offset, length = _read_element_header(buffer, offset)
+        if tag in (SEQUENCE_DELIMITER, ITEM_DELIMITER):
+            return value_offset
+        if length == UNDEFINED_LENGTH:
+            offset = _skip_undefined_length(buffer, value_offset)
+        else:
+            offset = value_offset + length
+
+
+def _parse_channel_definitions(buffer, offset, length):
+    """Return ([(ChannelSensitivity, correction factor) per item], offset after the ChannelDefinitionSequence)."""
+    channels = []
+    end = None if length == UNDEFINED_LENGTH else offset + length
+    while end is None or offset < end:
+        tag, _, value_offset, item_length = _read_element_header(buffer, offset)
+        if tag == SEQUENCE_DELIMITER:
+            return channels, value_offset
+        item_end = None if item_length == UNDEFINED_LENGTH else value_offset + item_length
+        values = {}
+        offset = value_offset
+        while item_end is None or offset < item_end:
+            tag, _, value_offset, element_length = _read_element_header(buffer, offset)
+            if tag == ITEM_DELIMITER:
+                offset = value_offset
+                break
+            if element_length == UNDEFINED_LENGTH:
+                offset = _skip_undefined_length(buffer, value_offset)
+                continue
+            if tag in (CHANNEL_SENSITIVITY, CHANNEL_SENSITIVITY_CORRECTION_FACTOR):
+                values[tag] = bytes(buffer[value_offset:value_offset + element_length]).decode('ascii').strip(' \0')
+            offset = value_offset + element_length
+        channels.append((values.get(CHANNEL_SENSITIVITY), values.get(CHANNEL_SENSITIVITY_CORRECTION_FACTOR)))
+    return channels, offset
+
+
+def _parse_waveform_item(buffer, offset, end):
+    """Parse one WaveformSequence item between offset and end (None: up to the item delimiter)."""
+    info = {}
+    while end is None or offset < end:
+        tag, vr, value_offset, length = _read_element_header(buffer, offset)
+        if tag == ITEM_DELIMITER:
+            return info, value_offset
+        if tag == CHANNEL_DEFINITION_SEQUENCE:
+            info['channel_sensitivities'], offset = _parse_channel_definitions(buffer, value_offset, length)
+            continue
+        if length == UNDEFINED_LENGTH:
+            offset = _skip_undefined_length(buffer, value_offset)
+            continue
+        key = _WAVEFORM_ITEM_TAGS.get(tag)
+        if key is not None:
+            value = bytes(buffer[value_offset:value_offset + length])
+            if vr == b'US':
+                info[key] = struct.unpack('<H', value)[0]
+            elif vr == b'UL':
+                info[key] = struct.unpack('<I', value)[0]
+            else:
+                info[key] = value.decode('ascii').strip(' \0')
+        elif tag == WAVEFORM_DATA:
+            info['data_offset'] = value_offset
+            info['data_length'] = length
+        offset = value_offset + length
+    return info, offset
+
+
+def _parse_waveform_sequence(buffer, offset, length):
+    groups = []
+    end = None if length == UNDEFINED_LENGTH else offset + length
+    while end is None or offset < end:
+        tag, _, value_offset, item_length = _read_element_header(buffer, offset)
+        if tag == SEQUENCE_DELIMITER:
+            break
+        if tag != ITEM:
+            raise ValueError(f"Unexpected element {tag} in WaveformSequence")
+        item_end = None if item_length == UNDEFINED_LENGTH else value_offset + item_length
+        info, offset = _parse_waveform_item(buffer, value_offset, item_end)
+        groups.append(info)
+    return groups
+
+
+def _transfer_syntax(buffer):
+    """Return (transfer syntax UID, offset of the dataset) of a DICOM file with preamble, or (None, 0)."""
+    if len(buffer) < 132 or bytes(buffer[128:132]) != b'DICM':
+        return None, 0
+    offset = 132
+    transfer_syntax = None
+    while offset + 8 <= len(buffer):
+        tag, vr, value_offset, length = _read_element_header(buffer, offset)
+        if tag[0] != 0x0002:
+            break
+        if tag == (0x0002, 0x0010):
+            transfer_syntax = bytes(buffer[value_offset:value_offset + length]).decode('ascii').strip(' \0')
+        offset = value_offset + length
+    return transfer_syntax, offset
+
+
+def _sample_dtype(info, source):
+    key = (info.get('interpretation', 'SS'), info.get('bits_allocated', 16))
+    if key not in SAMPLE_DTYPES:
+        raise ValueError(f"Unsupported waveform sample format {key} in {source}")
+    return np.dtype(SAMPLE_DTYPES[key])
+
+
+def _sensitivity(info):
+    """ChannelSensitivity times its correction factor per channel, 1.0 where either is absent."""
+    sensitivity = np.ones(info['channels'])
+    for i, (value, correction) in enumerate(info.get('channel_sensitivities', [])[:info['channels']]):
+        if value not in (None, ''):
+            sensitivity[i] = float(value) * (float(correction) if correction not in (None, '') else 1.0)
+    return sensitivity
+
+
+def _group_info(info, data):
+    return {
+        'label': info.get('label'),
+        'channels': info['channels'],
+        'samples': info['samples'],
+        'sampling_frequency': float(info['sampling_frequency']) if info.get('sampling_frequency') else None,
+        'sensitivity': _sensitivity(info),
+        'data': data,
+    }
+
+
+def _read_with_pydicom(path):
+    try:
+        ds = pydicom.dcmread(path, specific_tags=['WaveformSequence'])
+    except InvalidDicomError as e:
+        raise ValueError(f"{path} is not a DICOM file: {e}")
+    groups = []
+    for item in ds.get('WaveformSequence', []):
+        info = {
+            'label': item.get('MultiplexGroupLabel'),
+            'channels': item.NumberOfWaveformChannels,
+            'samples': item.NumberOfWaveformSamples,
+            'sampling_frequency': item.get('SamplingFrequency'),
+            'interpretation': item.get('WaveformSampleInterpretation', 'SS'),
+            'bits_allocated': item.get('WaveformBitsAllocated', 16),
+            'channel_sensitivities': [
+                (channel.get('ChannelSensitivity'), channel.get('ChannelSensitivityCorrectionFactor'))
+                for channel in item.get('ChannelDefinitionSequence', [])
+            ],
+        }
+        dtype = _sample_dtype(info, path)
+        data = np.frombuffer(item.WaveformData, dtype=dtype, count=info['samples'] * info['channels'])
+        groups.append(_group_info(info, data.reshape(info['samples'], info['channels'])))
+    return groups
+
+
+def read_waveform_groups(path):
+    """
+    Return one dict per WaveformSequence item with 'label', 'channels', 'samples', 'sampling_frequency',
+    'sensitivity' (ChannelSensitivity times correction factor per channel, 1.0 where absent) and 'data',
+    a read-only (samples, channels) array of the stored samples. For Explicit VR Little Endian files the array is a
+    view into a memory map of the file, so no sample is read before it is used.
+    """
+    with open(path, 'rb') as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            raise ValueError(f"{path} is not a DICOM file")
+
+    transfer_syntax, offset = _transfer_syntax(buffer)
+    if transfer_syntax != EXPLICIT_VR_LITTLE_ENDIAN:
+        buffer.close()
+        return _read_with_pydicom(path)
+
+    groups = []
+    try:
+        # Top level elements are sorted by tag, so everything up to the WaveformSequence is skipped
+        while offset + 8 <= len(buffer):
+            tag, _, value_offset, length = _read_element_header(buffer, offset)
+            if tag == WAVEFORM_SEQUENCE:
+                groups = _parse_waveform_sequence(buffer, value_offset, length)
+                break
+            if tag > WAVEFORM_SEQUENCE:
+                break
+            if length == UNDEFINED_LENGTH:
+                offset = _skip_undefined_length(buffer, value_offset)
+            else:
+                offset = value_offset + length
+    except struct.error:
+        raise ValueError(f"Truncated DICOM file: {path}")
+
+    result = []
+    for info in groups:
+        if 'data_offset' not in info:
+            continue
+        dtype = _sample_dtype(info, path)
+        count = info['samples'] * info['channels']
+        if count * dtype.itemsize > info['data_length']:
+            raise ValueError(f"WaveformData of {path} is shorter than {info['samples']} x {info['channels']} samples")
+        data = np.frombuffer(buffer, dtype=dtype, count=count, offset=info['data_offset'])
+        result.append(_group_info(info, data.reshape(info['samples'], info['channels'])))
+    # The arrays keep the memory map alive; it is unmapped once they are garbage collected
+    return result
+
+
+def select_group(groups, group, source=''):
+    """Return the group with the given MultiplexGroupLabel (e.g. 'RHYTHM', 'MEDIAN') or index."""
+    if isinstance(group, int):
+        if group < len(groups):
+            return groups[group]
+    else:
+        for info in groups:
+            if info['label'] is not None and info['label'].upper() == group.upper():
+                return info
+    raise ValueError(f"No waveform group {group!r} in {source}")
+
+
+def read_waveform(path, group='RHYTHM'):
+    """Return the (samples, channels) samples of one multiplex group as a zero-copy read-only array."""
+    return select_group(read_waveform_groups(path), group, path)['data']
+
+
+def read_waveforms(paths, group='RHYTHM', out=None, errors='raise'):
+    """
+    Read one multiplex group of many files into a (files, samples, channels) array.
+    out: preallocated array to fill; if omitted, it is allocated with the shape of the first file.
+         Longer recordings are truncated, shorter ones zero padded.
+    errors: 'raise' or 'skip'; skipped files leave their row zeroed.
+    Returns (out, lengths) where lengths holds the number of samples copied per file.
+    """
+    paths = list(paths)
+    lengths = np.zeros(len(paths), dtype=np.int64)
+    for i, path in enumerate(paths):
+        try:
+            data = read_waveform(path, group)
+        except (OSError, ValueError):
+            if errors == 'raise':
+                raise
+            if out is not None:
+                out[i] = 0
+            continue
+        if out is None:
+            out = np.zeros((len(paths),) + data.shape, dtype=data.dtype)
+        if data.shape[1] != out.shape[2]:
+            raise ValueError(f"{path} has {data.shape[1]} channels, expected {out.shape[2]}")
+        samples = min(data.shape[0], out.shape[1])
+        out[i, :samples] = data[:samples]
+        out[i, samples:] = 0
+        lengths[i] = samples
+    return out, lengths
@@ -0,0 +1,98 @@
+import hashlib
+
+import numpy as np
+import pydicom
+from pydicom.uid import UID
+
+from ecg_dicom_converter.load_to_dicom import LEAD_ORDER
+from ecg_dicom_converter.read_dicom import read_waveform_groups, select_group
+
+# Round-trip verification of written files against the leads still in memory from the extraction.
+# The samples read back are scaled by their ChannelSensitivity. Leads stored as their ADC samples match
+# the source exactly, leads stored as microvolt truncated towards zero differ by less than one microvolt.
+VERIFY_TOLERANCE_UV = 1.0
+
+UID_KEYWORDS = ['SOPClassUID', 'SOPInstanceUID', 'StudyInstanceUID', 'SeriesInstanceUID']
+
+
+def should_verify(input_file, fraction):
+    """
+    Return True if input_file belongs to the sample of the given fraction (0.0-1.0).
+    The choice depends on the file name only, so a rerun checks the same files.
+    """
+    if fraction >= 1.0:
+        return True
+    if fraction <= 0.0:
+        return False
+    digest = hashlib.sha1(str(input_file).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') < fraction * 2 ** 64
+
+
+def expected_annotation_count(metadata, annotations):
+    """Number of WaveformAnnotationSequence items add_annotations writes for this record."""
+    measurements = metadata.get('measurements', {})
+    count = len(metadata.get('diagnosis', []))
+    if metadata.get('RRInterval'):
+        count += 1
+    return count + sum(1 for measurement in annotations if measurement in measurements)
+
+
+def _expected_samples(leads, num_samples):
+    """The source leads (mV) as a float (num_samples, 12) array in microvolt, zero for missing leads."""
+    expected = np.zeros((num_samples, len(LEAD_ORDER)))
+    for i, lead_id in enumerate(LEAD_ORDER):
+        if lead_id in leads:
+            expected[:, i] = leads[lead_id]
+    expected *= 1000
+    return expected
+
+
+def compare_waveforms(groups, rhythm_leads, median_leads, source='', tolerance=VERIFY_TOLERANCE_UV):
+    """Return a list of differences between the waveform groups read back and the source leads."""
+    problems = []
+    for label, leads in (('RHYTHM', rhythm_leads), ('MEDIAN', median_leads)):
+        if not leads:
+            continue
+        try:
+            group = select_group(groups, label, source)
+        except ValueError as e:
+            problems.append(str(e))
+            continue
+        num_samples = len(next(iter(leads.values())))
+        data = group['data']
+        if data.shape != (num_samples, len(LEAD_ORDER)):
+            problems.append(f"{label} has shape {data.shape}, expected {(num_samples, len(LEAD_ORDER))}")
+            continue
+        deviation = np.abs(data * group['sensitivity'] - _expected_samples(leads, num_samples))
+        deviation = deviation.max(axis=0, initial=0.0)
+        wrong = np.flatnonzero(deviation > tolerance)
+        if wrong.size:
+            leads_text = ', '.join(LEAD_ORDER[i] for i in wrong)
+            problems.append(f"{label} lead(s) {leads_text} differ from the source by up to {deviation.max():.1f} uV")
+    return problems
+
+
+def verify_dicom(path, rhythm_leads, median_leads, metadata, annotations, tolerance=VERIFY_TOLERANCE_UV):
+    """
+    Read a written DICOM ECG back and compare it with the data it was converted from: the samples
+    of both waveform groups within tolerance microvolt, the presence of valid UIDs and of all
+    waveform annotations. Raises ValueError listing every difference.
+    """
+    problems = compare_waveforms(read_waveform_groups(path), rhythm_leads, median_leads, path, tolerance)
+
+    ds = pydicom.dcmread(path, specific_tags=UID_KEYWORDS + ['WaveformAnnotationSequence'])
+    for keyword in UID_KEYWORDS:
+        value = ds.get(keyword)
+        if not value:
+            problems.append(f"{keyword} is missing")
+        elif not UID(str(value)).is_valid:
+            problems.append(f"{keyword} {value} is not a valid UID")
+    if ds.get('SOPInstanceUID') != ds.file_meta.get('MediaStorageSOPInstanceUID'):
+        problems.append("SOPInstanceUID differs from MediaStorageSOPInstanceUID")
+    annotation_count = len(ds.get('WaveformAnnotationSequence', []))
+    expected_count = expected_annotation_count(metadata, annotations)
+    if annotation_count != expected_count:
+        problems.append(f"{annotation_count} waveform annotation(s), expected {expected_count}")
+
+    if problems:
+        raise ValueError(f"Verification of {path} failed: {'; '.join(problems)}")
@@ -0,0 +1,322 @@
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import shutil
+import signal
+import struct
+import time
+from multiprocessing import Pool
+
+from ecg_dicom_converter.cli import _init_worker, _process_file_in_worker
+from ecg_dicom_converter.extract_ecg_and_metadata import get_xml_backend
+from ecg_dicom_converter.dedup import DEDUP_INDEX_FILENAME, DedupIndex
+from ecg_dicom_converter.output_layout import OutputLayout
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+
+
+def is_xml_file(name):
+    return name.lower().endswith('.xml')
+
+
+def _is_excluded(path, excluded):
+    return any(path == directory or path.startswith(directory + os.sep) for directory in excluded)
+
+
+class InotifyWatcher:
+    """
+    Reports XML files that were closed after writing or moved into a directory tree (Linux inotify).
+    New subdirectories are watched as they appear, so the tree is only listed once at startup.
+    """
+    name = 'inotify'
+
+    def __init__(self, root, excluded=()):
+        self.root = root
+        self.excluded = [os.path.abspath(directory) for directory in excluded]
+        self.rescan_needed = False
+        self._watches = {}
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"Cannot watch {directory}: {os.strerror(error)}")
+        self._watches[wd] = directory
+
+    def scan(self, directory=None):
+        """Watch `directory` (default: the root) and its subdirectories, yielding the XML files already present."""
+        directory = directory or self.root
+        self._add_watch(directory)
+        # Watches are added before a directory is listed, so no file can slip in between
+        for current, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not _is_excluded(os.path.abspath(os.path.join(current, d)), self.excluded)]
+            for d in dirs:
+                self._add_watch(os.path.join(current, d))
+            for file in files:
+                if is_xml_file(file):
+                    yield os.path.join(current, file)
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds and return the paths of XML files that are complete."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped by the kernel; the daemon has to look at the tree again
+                self.rescan_needed = True
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not _is_excluded(os.path.abspath(path), self.excluded):
+                    try:
+                        paths.extend(self.scan(path))
+                    except OSError:
+                        pass  # removed again before it could be watched
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_xml_file(name):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """
+    Fallback for systems or network shares without inotify.
+    Only the directories are stat()ed on every poll; a directory is listed again only if its
+    modification time changed (or is too recent to rule out a change within the timestamp granularity).
+    """
+    name = 'polling'
+    recent_window = 3.0
+
+    def __init__(self, root, excluded=()):
+        self.root = root
+        self.excluded = [os.path.abspath(directory) for directory in excluded]
+        self.rescan_needed = False
+        self._directories = {}
+
+    def _list(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            self._directories.pop(directory, None)
+            return []
+        self._directories[directory] = mtime
+        paths = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in self._directories and not _is_excluded(os.path.abspath(entry.path), self.excluded):
+                    paths.extend(self._list(entry.path))
+            elif is_xml_file(entry.name):
+                paths.append(entry.path)
+        return paths
+
+    def scan(self, directory=None):
+        self._directories = {}
+        return self._list(directory or self.root)
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        paths = []
+        now = time.time_ns()
+        for directory, mtime in list(self._directories.items()):
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                self._directories.pop(directory, None)
+                continue
+            if current != mtime or now - current < self.recent_window * 1e9:
+                paths.extend(self._list(directory))
+        return paths
+
+    def close(self):
+        pass
+
+
+def create_watcher(input_dir, excluded=(), polling=False):
+    """Return an InotifyWatcher if available (and not disabled), otherwise a PollingWatcher."""
+    if not polling:
+        try:
+            return InotifyWatcher(input_dir, excluded)
+        except (OSError, AttributeError):
+            pass  # no inotify on this platform (AttributeError: libc without inotify_init1)
+    return PollingWatcher(input_dir, excluded)
+
+
+def move_into(path, source_root, target_root):
+    """Move `path` from below `source_root` to the same relative location below `target_root`."""
+    target = os.path.join(target_root, os.path.relpath(path, source_root))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.move(path, target)
+    return target
+
+
+def _init_watch_worker(annotations, engine, xml_backend=None, deflate_level=None, dedup=None):
+    # Ctrl+C is handled by the daemon, which lets the workers finish their current file
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(annotations, engine, xml_backend, deflate_level, dedup)
+
+
+def watch_folder(input_dir, output_dir, annotations, done_dir, failed_dir, jobs=1, engine='pydicom', settle=1.0,
+                 poll_interval=2.0, polling=False, layout='flat', on_collision='error',
+                 deflate_level=None, dedup=None, dedup_index=None):
+    """
+    Convert XML files as they appear in input_dir until SIGINT or SIGTERM.
+    A file is queued once it has been closed or moved in and its size and modification time did not
+    change for `settle` seconds. Converted files are moved to done_dir, failing ones to failed_dir
+    together with a <name>.error.txt, keeping their path relative to input_dir.
+    layout and on_collision select the OutputLayout of the DICOM files, deflate_level (0-9) writes
+    Deflated Explicit VR Little Endian files. dedup ('skip' or 'link') skips recordings converted
+    before according to the fingerprint index dedup_index (default in output_dir), or links them.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if dedup is not None:
+        dedup_index = dedup_index or os.path.join(output_dir, DEDUP_INDEX_FILENAME)
+        # Creates the index and checks the mode before the workers open it
+        DedupIndex(dedup_index, dedup).close()
+    output_layout = OutputLayout(output_dir, layout, on_collision, input_root=input_dir)
+    watcher = create_watcher(input_dir, excluded=(done_dir, failed_dir), polling=polling)
+    tick = min(settle, poll_interval) if watcher.name == 'polling' else min(settle, 0.5)
+    print(f"Watching {input_dir} ({watcher.name}), writing to {output_dir}")
+
+    stop = []
+
+    def request_stop(signum, frame):
+        stop.append(signum)
+
+    previous_handlers = {signum: signal.signal(signum, request_stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+
+    pending = {}   # path -> [(size, mtime_ns), time of the last change]
+    in_flight = {}  # path -> (size, mtime_ns) when it was queued
+    stale_outputs = {}  # path -> output of a conversion that was outdated by a rewrite of the file
+    stuck = set()  # files that could not be moved away, never queued again
+    results = queue.Queue()
+    converted = failed = 0
+
+    def add_candidates(paths):
+        now = time.monotonic()
+        for path in paths:
+            if path not in stuck and path not in pending and path not in in_flight:
+                pending[path] = [None, now]
+
+    worker_dedup = (dedup_index, dedup) if dedup is not None else None
+    pool = Pool(processes=jobs, initializer=_init_watch_worker,
+                initargs=(annotations, engine, get_xml_backend(), deflate_level, worker_dedup))
+    try:
+        add_candidates(watcher.scan())
+        while not stop or in_flight:
+            if not stop:
+                add_candidates(watcher.wait(tick))
+                if watcher.rescan_needed:
+                    watcher.rescan_needed = False
+                    add_candidates(watcher.scan())
+            else:
+                time.sleep(0.1)
+
+            # Queue files whose size and modification time settled
+            now = time.monotonic()
+            for path, state in list(pending.items()):
+                if stop:
+                    break
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    del pending[path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if signature != state[0]:
+                    state[0], state[1] = signature, now
+                elif now - state[1] >= settle:
+                    del pending[path]
+                    in_flight[path] = signature
+                    # The conversion of a rewritten file replaces the output of the outdated one
+                    task = (path, output_layout, False, False, False, stale_outputs.get(path))
+                    pool.apply_async(_process_file_in_worker, (task,),
+                                     callback=results.put,
+                                     error_callback=lambda e, path=path: results.put((path, None, str(e), None, None, None, [])))
+
+            while True:
+                try:
+                    input_file, output_file, error, _, _, _, events = results.get_nowait()
+                except queue.Empty:
+                    break
+                signature = in_flight.pop(input_file, None)
+                try:
+                    stat = os.stat(input_file)
+                    if (stat.st_size, stat.st_mtime_ns) != signature:
+                        # Written again while it was converted, convert once more
+                        pending[input_file] = [None, time.monotonic()]
+                        if output_file is not None:
+                            stale_outputs[input_file] = output_file
+                        continue
+                except OSError:
+                    pass
+                stale_output = stale_outputs.pop(input_file, None)
+                try:
+                    if error is None:
+                        if stale_output is not None and os.path.abspath(stale_output) != os.path.abspath(output_file):
+                            # The new content maps elsewhere (e.g. another patient), the outdated file goes
+                            os.remove(stale_output)
+                        converted += 1
+                        move_into(input_file, input_dir, done_dir)
+                        print(f"Converted {input_file} -> {output_file}")
+                        for event in events:
+                            print(f"  [{event['severity']}] {event['code']}: {event['message']}")
+                    else:
+                        failed += 1
+                        target = move_into(input_file, input_dir, failed_dir)
+                        with open(target + '.error.txt', 'w') as file:
+                            file.write(error + '\n')
+                        print(f"Failed to convert {input_file}: {error}")
+                except OSError as e:
+                    stuck.add(input_file)
+                    print(f"Error moving {input_file}: {e}")
+    finally:
+        pool.close()
+        pool.join()
+        watcher.close()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    print(f"Stopped watching {input_dir}. Converted {converted} file(s), {failed} failed.")
+    return converted, failed
@@ -8,6 +8,9 @@ setup(
         'numpy>=1.18.4',
         'pydicom==3.0.1'
     ],
+    extras_require={
+        'lxml': ['lxml'],  # faster XML parsing, used automatically if installed
+    },
     entry_points={
         'console_scripts': [
             'ecg_dicom_converter=ecg_dicom_converter.cli:main',  # This should match the actual package and module names
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The synthetic Muse XML generator of the benchmarks provides the test records
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
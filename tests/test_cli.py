@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import zipfile
+
+import pytest
+
+from synthetic_muse_xml import generate_muse_xml
+from ecg_dicom_converter.cli import main
+from ecg_dicom_converter.manifest import MANIFEST_FILENAME, OutputClaims
+
+# Incomplete synthetic records warn about every missing tag
+pytestmark = pytest.mark.filterwarnings('ignore::ecg_dicom_converter.diagnostics.ConversionWarning')
+
+
+def write_xml(path, seed):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(generate_muse_xml(seed=seed, duration=1.0), encoding='ISO-8859-1')
+    return path
+
+
+def manifest_hashes(output_dir):
+    with sqlite3.connect(str(output_dir / MANIFEST_FILENAME)) as connection:
+        return dict(connection.execute('SELECT input_path, sha256 FROM files'))
+
+
+def manifest_entries(output_dir):
+    with sqlite3.connect(str(output_dir / MANIFEST_FILENAME)) as connection:
+        return {input_path: (status, output_file) for input_path, status, output_file in
+                connection.execute('SELECT input_path, status, output_file FROM files')}
+
+
+def test_single_file_rerun_replaces_its_output(tmp_path):
+    input_file = write_xml(tmp_path / 'x.xml', seed=1)
+    output_dir = tmp_path / 'out'
+    main([str(input_file), str(output_dir)])
+    (output_dir / 'x.dcm').write_bytes(b'stale')
+    main([str(input_file), str(output_dir)])
+
+    assert (output_dir / 'x.dcm').read_bytes() != b'stale'
+    assert sorted(path.name for path in output_dir.iterdir()) == ['x.dcm']
+
+
+def test_resume_keeps_the_output_of_another_input(tmp_path):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    first = write_xml(input_dir / 'a' / 'x.xml', seed=1)
+    second = write_xml(input_dir / 'b' / 'x.xml', seed=2)
+
+    main([str(input_dir), str(output_dir), '-r'])
+    written = (output_dir / 'x.dcm').read_bytes()
+    main([str(input_dir), str(output_dir), '-r', '--resume'])
+
+    assert (output_dir / 'x.dcm').read_bytes() == written
+    entries = manifest_entries(output_dir)
+    assert entries[str(first)] == ('done', str(output_dir / 'x.dcm'))
+    assert entries[str(second)][0] == 'failed'
+
+
+def test_resume_replaces_an_unrecorded_output_of_the_same_input(tmp_path):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    input_file = write_xml(input_dir / 'x.xml', seed=1)
+    main([str(input_dir), str(output_dir), '-r'])
+
+    # Interrupted before the record was committed: the output and its claim exist, the record does not
+    with sqlite3.connect(str(output_dir / MANIFEST_FILENAME)) as connection:
+        connection.execute('DELETE FROM files')
+    claims = OutputClaims(str(output_dir / MANIFEST_FILENAME) + '.claims')
+    claims.claim(str(input_file), str(output_dir / 'x.dcm'))
+    main([str(input_dir), str(output_dir), '-r', '--resume'])
+
+    assert manifest_entries(output_dir)[str(input_file)] == ('done', str(output_dir / 'x.dcm'))
+    assert not (output_dir / (MANIFEST_FILENAME + '.claims')).exists()
+
+
+def test_unreadable_directory_is_in_the_diagnostics_report(tmp_path, monkeypatch):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    write_xml(input_dir / 'x.xml', seed=1)
+    write_xml(input_dir / 'locked' / 'y.xml', seed=2)
+    scandir = os.scandir
+
+    def locked_scandir(path):
+        if os.path.basename(path) == 'locked':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', locked_scandir)
+    report = tmp_path / 'report.jsonl'
+    main([str(input_dir), str(output_dir), '-r', '--diagnostics', str(report)])
+
+    lines = [json.loads(line) for line in report.read_text().splitlines()]
+    events = [line for line in lines if line['type'] == 'event' and line['code'] == 'unreadable_directory']
+    assert [event['file'] for event in events] == [str(input_dir / 'locked')]
+    assert lines[-1]['counts']['unreadable_directory'] == 1
+    assert lines[-1]['files'] == 1
+
+
+def test_output_archive_in_a_new_directory(tmp_path):
+    input_archive = tmp_path / 'in.zip'
+    with zipfile.ZipFile(input_archive, 'w') as archive:
+        archive.writestr('a/x.xml', generate_muse_xml(seed=1, duration=1.0).encode('ISO-8859-1'))
+    output_archive = tmp_path / 'new' / 'out.zip'
+    main([str(input_archive), str(output_archive)])
+
+    with zipfile.ZipFile(output_archive) as archive:
+        assert archive.namelist() == ['a/x.dcm']
+
+
+def test_diagnostics_report_in_a_new_output_directory(tmp_path):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    write_xml(input_dir / 'x.xml', seed=1)
+    report = output_dir / 'reports' / 'diagnostics.jsonl'
+    main([str(input_dir), str(output_dir), '-r', '--no-manifest', '--diagnostics', str(report)])
+
+    assert json.loads(report.read_text().splitlines()[-1])['files'] == 1
+
+
+def test_only_resumed_runs_hash_the_inputs(tmp_path, capsys):
+    input_dir, output_dir = tmp_path / 'in', tmp_path / 'out'
+    unchanged = write_xml(input_dir / 'x.xml', seed=1)
+    touched = write_xml(input_dir / 'y.xml', seed=2)
+    main([str(input_dir), str(output_dir), '-r'])
+    assert manifest_hashes(output_dir) == {str(unchanged): None, str(touched): None}
+
+    # Without a recorded hash a new mtime counts as a change
+    os.utime(touched, ns=(0, 0))
+    capsys.readouterr()
+    main([str(input_dir), str(output_dir), '-r', '--resume'])
+    assert 'Skipped 1 file(s)' in capsys.readouterr().out
+    hashes = manifest_hashes(output_dir)
+    assert hashes[str(unchanged)] is None and hashes[str(touched)] is not None
@@ -0,0 +1,67 @@
+import io
+import itertools
+from datetime import datetime
+
+import pytest
+from pydicom import uid
+
+from synthetic_muse_xml import generate_muse_xml
+from ecg_dicom_converter import load_to_dicom
+from ecg_dicom_converter.extract_ecg_and_metadata import extract_data
+from ecg_dicom_converter.load_to_dicom import ConverterSession, create_dicom_ecg
+
+# Incomplete synthetic records warn about every missing tag
+pytestmark = pytest.mark.filterwarnings('ignore::ecg_dicom_converter.diagnostics.ConversionWarning')
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2024, 5, 17, 10, 30, 15)
+
+
+@pytest.fixture
+def fixed_uids(monkeypatch):
+    """Make the generated UIDs and the instance creation time reproducible; call the fixture to restart."""
+    counter = []
+
+    def restart():
+        counter[:] = [itertools.count(1)]
+
+    def generate_uid(prefix=uid.PYDICOM_ROOT_UID, entropy_srcs=None):
+        return uid.UID(f'{prefix}{next(counter[0])}')
+
+    restart()
+    monkeypatch.setattr(uid, 'generate_uid', generate_uid)
+    monkeypatch.setattr(load_to_dicom, 'datetime', FixedDatetime)
+    return restart
+
+
+def synthetic_record(seed, completeness):
+    xml = generate_muse_xml(seed=seed, duration=2.0, completeness=completeness).encode('ISO-8859-1')
+    return extract_data(xml)
+
+
+@pytest.mark.parametrize('deflate_level', [None, 1, 6])
+@pytest.mark.parametrize('seed, completeness', [(0, 1.0), (1, 0.5), (2, 0.0), (3, 0.8)])
+def test_fast_writer_matches_pydicom(fixed_uids, seed, completeness, deflate_level):
+    session = ConverterSession()
+    rhythm_leads, median_leads, metadata = synthetic_record(seed, completeness)
+
+    fixed_uids()
+    buffer = io.BytesIO()
+    create_dicom_ecg(rhythm_leads, median_leads, metadata, buffer, session.annotations, session=session,
+                     deflate_level=deflate_level)
+    fixed_uids()
+    fast = session.fast_writer.encode(rhythm_leads, median_leads, metadata, deflate_level)
+
+    assert fast == buffer.getvalue()
+
+
+def test_fixed_uids_are_used(fixed_uids):
+    session = ConverterSession()
+    fixed_uids()
+    first = session.fast_writer.encode(*synthetic_record(0, 1.0))
+    fixed_uids()
+    second = session.fast_writer.encode(*synthetic_record(0, 1.0))
+    assert first == second
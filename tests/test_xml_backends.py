@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from synthetic_muse_xml import generate_muse_xml
+from ecg_dicom_converter.extract_ecg_and_metadata import extract_data
+
+pytest.importorskip('lxml')
+
+# Incomplete synthetic records warn about every missing tag
+pytestmark = pytest.mark.filterwarnings('ignore::ecg_dicom_converter.diagnostics.ConversionWarning')
+
+
+def assert_same_leads(etree_leads, lxml_leads):
+    assert list(etree_leads) == list(lxml_leads)
+    for lead_id in etree_leads:
+        etree_integer, lxml_integer = etree_leads.integer_samples(lead_id), lxml_leads.integer_samples(lead_id)
+        assert etree_integer[0].dtype == lxml_integer[0].dtype
+        np.testing.assert_array_equal(etree_integer[0], lxml_integer[0])
+        assert etree_integer[1] == lxml_integer[1]
+        assert etree_leads[lead_id].dtype == lxml_leads[lead_id].dtype
+        np.testing.assert_array_equal(etree_leads[lead_id], lxml_leads[lead_id])
+    assert etree_leads.filters == lxml_leads.filters
+    assert etree_leads.sample_counts == lxml_leads.sample_counts
+
+
+@pytest.mark.parametrize('seed, leads, completeness', [(0, 8, 1.0), (1, 8, 0.5), (2, 14, 0.8), (3, 8, 0.0)])
+def test_backends_extract_the_same_record(tmp_path, seed, leads, completeness):
+    path = tmp_path / 'record.xml'
+    path.write_text(generate_muse_xml(seed=seed, leads=leads, duration=2.0, completeness=completeness),
+                    encoding='ISO-8859-1')
+
+    etree_record = extract_data(str(path), backend='etree')
+    lxml_record = extract_data(str(path), backend='lxml')
+
+    assert_same_leads(etree_record.rhythm, lxml_record.rhythm)
+    assert_same_leads(etree_record.median, lxml_record.median)
+    assert etree_record.metadata == lxml_record.metadata